@@ -1,22 +1,44 @@
 import logging
 import os
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import asyncio
+import functools
+import threading
+import time
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import datetime as dt
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    CallbackContext,
+    TypeHandler,
+    PersistenceInput,
 )
 import telegram.error
 import uuid
+import json
+import pickle
+import sys
+import httpx
+import weakref
 import pytz
+from zoneinfo import ZoneInfo
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,14 +53,51 @@ DEFAULT_ADMIN_ID = 536587863  # Changed to integer
 # Supported languages
 langs = {"فارسی": "fa", "English": "en"}
 
+# Referral program: profit rate per level (level 1 = direct referrer); levels deeper than the
+# rate list are still tracked, up to REFERRAL_MAX_DEPTH, but earn nothing
+REFERRAL_PROFIT_RATES = {
+    level: Decimal(rate)
+    for level, rate in enumerate(os.getenv("REFERRAL_PROFIT_RATES", "0.05,0.03,0.01").split(","), start=1)
+}
+REFERRAL_MAX_DEPTH = int(os.getenv("REFERRAL_MAX_DEPTH", str(len(REFERRAL_PROFIT_RATES))))
+
+def fa_digits(value):
+    """Render a number with Persian digits."""
+    return str(value).translate(str.maketrans("0123456789", "۰۱۲۳۴۵۶۷۸۹"))
+
+REFERRAL_START_PREFIX = "ref_"
+
+def build_referral_link(bot, user_id):
+    """Deep link that starts the bot with the user's referral code.
+    The username comes from the get_me() result cached when the application initialised."""
+    return f"https://t.me/{bot.username}?start={REFERRAL_START_PREFIX}{user_id}"
+
+def referral_level_lines(level_counts, lang, show_rates=True):
+    """One line per referral level with its head count (and profit rate)."""
+    lines = []
+    for level in range(1, REFERRAL_MAX_DEPTH + 1):
+        rate = REFERRAL_PROFIT_RATES.get(level)
+        percent = f"{(rate * 100).normalize():f}" if rate else None
+        count = level_counts.get(level, 0)
+        if lang == "fa":
+            line = f"  📌 سطح {fa_digits(level)}: `{count}` نفر"
+            if show_rates and percent:
+                line += f" ({fa_digits(percent)}٪ سود)"
+        else:
+            line = f"  📌 Level {level}: `{count}` workers"
+            if show_rates and percent:
+                line += f" ({percent}% profit)"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
 # 🌱 **لیست بذرهای مزرعه** 🌾
 SEEDS = [
-    {"name": "Tomato", "name_fa": "گوجه", "price": 15, "daily_profit_rate": 0.04, "emoji": "🍅"},
-    {"name": "Cucumber", "name_fa": "خیار", "price": 30, "daily_profit_rate": 0.043333, "emoji": "🥒"},
-    {"name": "Orange", "name_fa": "پرتقال", "price": 50, "daily_profit_rate": 0.042, "emoji": "🍊"},
-    {"name": "Apple", "name_fa": "سیب", "price": 120, "daily_profit_rate": 0.0375, "emoji": "🍎"},
-    {"name": "Banana", "name_fa": "موز", "price": 320, "daily_profit_rate": 0.034375, "emoji": "🍌"},
-    {"name": "Mango", "name_fa": "انبه", "price": 550, "daily_profit_rate": 0.036364, "emoji": "🥭"},
+    {"name": "Tomato", "name_fa": "گوجه", "price": Decimal("15"), "daily_profit_rate": Decimal("0.04"), "emoji": "🍅"},
+    {"name": "Cucumber", "name_fa": "خیار", "price": Decimal("30"), "daily_profit_rate": Decimal("0.043333"), "emoji": "🥒"},
+    {"name": "Orange", "name_fa": "پرتقال", "price": Decimal("50"), "daily_profit_rate": Decimal("0.042"), "emoji": "🍊"},
+    {"name": "Apple", "name_fa": "سیب", "price": Decimal("120"), "daily_profit_rate": Decimal("0.0375"), "emoji": "🍎"},
+    {"name": "Banana", "name_fa": "موز", "price": Decimal("320"), "daily_profit_rate": Decimal("0.034375"), "emoji": "🍌"},
+    {"name": "Mango", "name_fa": "انبه", "price": Decimal("550"), "daily_profit_rate": Decimal("0.036364"), "emoji": "🥭"},
 ]
 
 # Localized messages
@@ -228,14 +287,12 @@ messages = {
             f"📜 *تراکنش‌ها*:\n{transactions or 'بدون تراکنش'}\n"
             f"╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌"
         ),
-        "referral_info": lambda link, level1, level2, level3, total_profit, transactions: (
+        "referral_info": lambda link, level_counts, total_profit, transactions: (
             f"🤝 *کارگرهای مزرعه*\n"
             f"────────────────────\n"
             f"🔗 *لینک دعوت شما*: `{link}`\n"
             f"👥 *کارگرهای دعوت‌شده*:\n"
-            f"  📌 سطح ۱: `{level1}` نفر (۵٪ سود)\n"
-            f"  📌 سطح ۲: `{level2}` نفر (۳٪ سود)\n"
-            f"  📌 سطح ۳: `{level3}` نفر (۱٪ سود)\n"
+            f"{referral_level_lines(level_counts, 'fa')}"
             f"💰 *کل سود کسب‌شده*: `{total_profit}` تتر\n"
             f"────────────────────\n"
             f"📜 *تراکنش‌های کارگرها*:\n{transactions}\n"
@@ -283,6 +340,28 @@ messages = {
             "⚠️ *خطا*: هنوز نمی‌تونید سود این زمین‌ها رو برداشت کنید!\n"
             "📌 لطفاً بعد از ساعت 00:00 یا پس از کاشت زمین‌ها دوباره تلاش کنید."
         ),
+        "plant_all": "🌿 کاشت همه",
+        "harvest_all": "🚜 برداشت همه",
+        "plant_all_success": lambda count: (
+            f"🏞️ *زمین‌ها کاشته شدن!*\n"
+            f"🌿 *تعداد*: `{count}` زمین\n"
+            f"📌 می‌تونید بعد از ساعت 00:00 سودشون رو برداشت کنید."
+        ),
+        "harvest_all_success": lambda count, amount: (
+            f"🎉 *سود همه زمین‌ها برداشت شد!*\n"
+            f"🚜 *تعداد*: `{count}` زمین\n"
+            f"💰 *مقدار*: `{amount}` تتر\n"
+            f"📌 سود به موجودی مزرعه‌تون اضافه شد."
+        ),
+        "auto_harvest": "🤖 برداشت خودکار",
+        "auto_harvest_on": (
+            "🤖 *برداشت خودکار فعال شد!*\n"
+            "📌 هر شب ساعت 00:00 سود زمین‌های کاشته‌شده خودکار به موجودی‌تون اضافه می‌شه."
+        ),
+        "auto_harvest_off": (
+            "🤖 *برداشت خودکار غیرفعال شد.*\n"
+            "📌 از این به بعد سودها رو خودتون برداشت کنید."
+        ),
         "no_seeds": (
             "🏞️ *بدون زمین*\n"
             "شما هنوز هیچ زمینی ندارید.\n"
@@ -529,14 +608,12 @@ messages = {
             f"📜 *Transactions*:\n{transactions or 'No transactions'}\n"
             f"╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌"
         ),
-        "referral_info": lambda link, level1, level2, level3, total_profit, transactions: (
+        "referral_info": lambda link, level_counts, total_profit, transactions: (
             f"🤝 *Farm Workers*\n"
             f"────────────────────\n"
             f"🔗 *Your Referral Link*: `{link}`\n"
             f"👥 *Invited Workers*:\n"
-            f"  📌 Level 1: `{level1}` workers (5% profit)\n"
-            f"  📌 Level 2: `{level2}` workers (3% profit)\n"
-            f"  📌 Level 3: `{level3}` workers (1% profit)\n"
+            f"{referral_level_lines(level_counts, 'en')}"
             f"💰 *Total Profit Earned*: `{total_profit}` USDT\n"
             f"────────────────────\n"
             f"📜 *Workers' Transactions*:\n{transactions}\n"
@@ -584,6 +661,28 @@ messages = {
             "⚠️ *Error*: You can't harvest these lands yet!\n"
             "📌 Please try after 00:00 or after planting the lands."
         ),
+        "plant_all": "🌿 Plant All",
+        "harvest_all": "🚜 Harvest All",
+        "plant_all_success": lambda count: (
+            f"🏞️ *Lands Planted!*\n"
+            f"🌿 *Count*: `{count}` lands\n"
+            f"📌 You can harvest their profit after 00:00."
+        ),
+        "harvest_all_success": lambda count, amount: (
+            f"🎉 *All Profits Harvested!*\n"
+            f"🚜 *Count*: `{count}` lands\n"
+            f"💰 *Amount*: `{amount}` USDT\n"
+            f"📌 The profit has been added to your farm balance."
+        ),
+        "auto_harvest": "🤖 Auto-Harvest",
+        "auto_harvest_on": (
+            "🤖 *Auto-Harvest Enabled!*\n"
+            "📌 Every night at 00:00 the profit of your planted lands is added to your balance automatically."
+        ),
+        "auto_harvest_off": (
+            "🤖 *Auto-Harvest Disabled.*\n"
+            "📌 From now on, harvest your profits yourself."
+        ),
         "no_seeds": (
             "🏞️ *No Lands*\n"
             "You don't have any lands yet.\n"
@@ -659,6 +758,1013 @@ if not DATABASE_URL:
     logger.error("DATABASE_URL not found in environment variables")
     exit(1)
 
+# Connection pool configuration
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))  # close connections idle this long, down to min size
+
+class DatabasePool:
+    """Process-wide psycopg2 connection pool with health checks and usage stats.
+
+    Opens up to max_size connections on demand and closes those idle for longer than
+    max_idle seconds until only min_size remain open (checked whenever a connection is returned).
+    """
+
+    def __init__(self, dsn, min_size, max_size, timeout, healthcheck_idle, max_idle=DB_POOL_MAX_IDLE):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self.max_idle = max_idle
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                logger.info(f"Opening database pool (min {self.min_size}, max {self.max_size})")
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.min_size, self.max_size, self.dsn)
+                # psycopg2 would close every connection returned above minconn, reopening them under
+                # load; keep them on return and let _trim_idle close the ones that stay unused
+                self._pool.minconn = self.max_size
+            return self._pool
+
+    def _trim_idle(self, pool):
+        """Close connections idle longer than max_idle while more than min_size are open."""
+        cutoff = time.monotonic() - self.max_idle
+        closed = 0
+        with pool._lock:
+            idle = pool._pool
+            # psycopg2 hands out the most recently returned connection, so the oldest idle one is first
+            while (idle and len(idle) + len(pool._used) > self.min_size
+                   and self._last_used.get(id(idle[0]), 0.0) < cutoff):
+                conn = idle.pop(0)
+                self._last_used.pop(id(conn), None)
+                conn.close()
+                closed += 1
+        if closed:
+            logger.info(f"Closed {closed} idle database connections")
+
+    def _is_healthy(self, conn):
+        """Check that a pooled connection survived since its last checkout."""
+        if conn.closed:
+            return False
+        idle = time.monotonic() - self._last_used.get(id(conn), 0.0)
+        if idle < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Discarding broken pooled connection: {e}")
+            return False
+
+    def getconn(self):
+        """Check out a healthy connection, waiting up to the pool timeout for a free slot."""
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise psycopg2.pool.PoolError(f"Timed out after {self.timeout}s waiting for a database connection")
+        waited = time.monotonic() - started
+        try:
+            pool = self._get_pool()
+            # Each retry replaces a dead connection (e.g. after a server restart) with a fresh one
+            for _ in range(self.max_size + 1):
+                conn = pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                self._last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+                with self._lock:
+                    self._reconnects += 1
+            else:
+                raise psycopg2.OperationalError("Could not obtain a healthy database connection")
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait = max(self._max_wait, waited)
+            if waited > 0.001:
+                self._waits += 1
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, closing it if it is no longer usable."""
+        try:
+            broken = discard or conn.closed or (
+                conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+            )
+            if not broken and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            pool = self._get_pool()
+            pool.putconn(conn, close=broken)
+            self._trim_idle(pool)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Yield a pooled connection; commits on success and rolls back on error."""
+        conn = self.getconn()
+        discard = False
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self):
+        """Return a snapshot of pool usage counters."""
+        with self._lock:
+            pool = self._pool
+            open_connections = len(pool._pool) + len(pool._used) if pool and not pool.closed else 0
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "open": open_connections,
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "avg_wait_ms": (self._wait_time / self._checkouts * 1000) if self._checkouts else 0.0,
+                "max_wait_ms": self._max_wait * 1000,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+            }
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+                logger.info("Closed database pool")
+            self._pool = None
+            self._last_used.clear()
+
+db_pool = DatabasePool(DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE)
+
+def db_connection():
+    """Check out a connection from the shared pool."""
+    return db_pool.connection()
+
+def format_pool_stats():
+    """Render database pool stats for the admin stats command."""
+    stats = db_pool.stats()
+    return (
+        f"🗄️ Database pool\n"
+        f"Size: {stats['open']} open / {stats['min_size']}-{stats['max_size']}\n"
+        f"In use: {stats['in_use']}\n"
+        f"Checkouts: {stats['checkouts']} (waited: {stats['waits']}, timeouts: {stats['timeouts']})\n"
+        f"Wait time: avg {stats['avg_wait_ms']:.1f} ms, max {stats['max_wait_ms']:.1f} ms\n"
+        f"Reconnects: {stats['reconnects']}"
+    )
+
+# Async database access
+DB_ASYNC_POOL_SIZE = int(os.getenv("DB_ASYNC_POOL_SIZE", "20"))
+
+async def wait_async_connection(conn):
+    """Drive a non-blocking psycopg2 connection until its current operation completes."""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        fd = conn.fileno()
+        waiter = loop.create_future()
+
+        def wake():
+            if not waiter.done():
+                waiter.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, wake)
+            remove = loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, wake)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll state {state}")
+        try:
+            await waiter
+        finally:
+            remove(fd)
+
+class AsyncCursor:
+    """Awaitable wrapper around a cursor of a non-blocking connection."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    async def execute(self, query, params=None):
+        self._cursor.execute(query, params)
+        await wait_async_connection(self._cursor.connection)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def connection(self):
+        return self._cursor.connection
+
+class AsyncDatabasePool:
+    """Pool of non-blocking psycopg2 connections driven by the asyncio event loop."""
+
+    def __init__(self, dsn, max_size, timeout, healthcheck_idle):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._idle = []
+        self._slots = None
+        self._open = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+
+    async def _connect(self):
+        conn = psycopg2.connect(self.dsn, async_=True)
+        try:
+            await wait_async_connection(conn)
+        except BaseException:
+            conn.close()
+            raise
+        self._open += 1
+        return conn
+
+    def _close(self, conn):
+        if not conn.closed:
+            conn.close()
+        self._open -= 1
+
+    async def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_idle:
+            return True
+        try:
+            await AsyncCursor(conn.cursor()).execute('SELECT 1')
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Discarding broken async connection: {e}")
+            return False
+
+    async def acquire(self):
+        """Check out a connection, waiting up to the pool timeout for a free slot."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_size)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise psycopg2.pool.PoolError(f"Timed out after {self.timeout}s waiting for an async database connection")
+        waited = time.monotonic() - started
+        try:
+            conn = None
+            while self._idle:
+                candidate, idle_since = self._idle.pop()
+                if await self._is_healthy(candidate, idle_since):
+                    conn = candidate
+                    break
+                self._close(candidate)
+                self._reconnects += 1
+            if conn is None:
+                conn = await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._in_use += 1
+        self._checkouts += 1
+        self._wait_time += waited
+        self._max_wait = max(self._max_wait, waited)
+        return conn
+
+    def release(self, conn, discard=False):
+        """Return a connection, closing it if it was interrupted or left mid-transaction."""
+        try:
+            if (discard or conn.closed or conn.isexecuting()
+                    or conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._in_use -= 1
+            self._slots.release()
+
+    @asynccontextmanager
+    async def cursor(self):
+        """Yield an autocommit cursor on a pooled connection."""
+        conn = await self.acquire()
+        discard = False
+        try:
+            yield AsyncCursor(conn.cursor())
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, asyncio.CancelledError):
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Yield a cursor inside BEGIN/COMMIT, rolling back on error."""
+        async with self.cursor() as c:
+            await c.execute('BEGIN')
+            try:
+                yield c
+            except BaseException:
+                if not c.connection.closed and not c.connection.isexecuting():
+                    await c.execute('ROLLBACK')
+                raise
+            await c.execute('COMMIT')
+
+    def stats(self):
+        return {
+            "max_size": self.max_size,
+            "open": self._open,
+            "idle": len(self._idle),
+            "in_use": self._in_use,
+            "checkouts": self._checkouts,
+            "avg_wait_ms": (self._wait_time / self._checkouts * 1000) if self._checkouts else 0.0,
+            "max_wait_ms": self._max_wait * 1000,
+            "timeouts": self._timeouts,
+            "reconnects": self._reconnects,
+        }
+
+    async def close(self):
+        while self._idle:
+            conn, _ = self._idle.pop()
+            self._close(conn)
+        logger.info("Closed async database pool")
+
+async_db = AsyncDatabasePool(DATABASE_URL, DB_ASYNC_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE)
+
+# Thread-pool offload for blocking helpers
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX_SIZE)))
+DB_ASYNC_MODE = os.getenv("DB_ASYNC_MODE", "native").lower()  # "native" or "thread"
+
+class DatabaseExecutor:
+    """Bounded thread pool that runs blocking helpers via run_in_executor and times them."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._max_queued = 0
+        self._helpers = {}
+
+    def _call(self, name, submitted, func, args, kwargs):
+        started = time.monotonic()
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self._active -= 1
+                calls, total, slowest, queue_wait = self._helpers.get(name, (0, 0.0, 0.0, 0.0))
+                self._helpers[name] = (
+                    calls + 1,
+                    total + (finished - started),
+                    max(slowest, finished - started),
+                    queue_wait + (started - submitted),
+                )
+
+    async def run(self, func, *args, **kwargs):
+        """Run ``func`` on the executor without blocking the event loop."""
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(
+                self._executor,
+                functools.partial(self._call, func.__name__, time.monotonic(), func, args, kwargs),
+            )
+        except RuntimeError:
+            # Submission failed (executor shut down), so _call will never run
+            with self._lock:
+                self._queued -= 1
+            raise
+        return await future
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self._queued,
+                "max_queued": self._max_queued,
+                "active": self._active,
+                "helpers": dict(self._helpers),
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+db_executor = DatabaseExecutor(DB_EXECUTOR_WORKERS)
+
+def format_executor_stats():
+    """Render executor queue depth and per-helper timings for the admin stats command."""
+    stats = db_executor.stats()
+    lines = [
+        f"🧵 DB executor (mode: {DB_ASYNC_MODE})",
+        f"Workers: {stats['workers']}, active: {stats['active']}",
+        f"Queue depth: {stats['queued']} (max {stats['max_queued']})",
+    ]
+    slowest_first = sorted(stats["helpers"].items(), key=lambda item: item[1][1], reverse=True)
+    for name, (calls, total, slowest, queue_wait) in slowest_first[:10]:
+        lines.append(
+            f"{name}: {calls} calls, avg {total / calls * 1000:.1f} ms, "
+            f"max {slowest * 1000:.1f} ms, queued avg {queue_wait / calls * 1000:.1f} ms"
+        )
+    return "\n".join(lines)
+
+class AsyncHelpers:
+    """Awaitable equivalents of the database helpers.
+
+    Helpers with a native implementation run on the async pool. Every other helper is
+    reached through a compatibility shim that runs the blocking version on the bounded
+    DB executor, so call sites can switch to ``await adb.<helper>(...)`` one at a time.
+    With DB_ASYNC_MODE=thread every helper goes through the executor.
+    """
+
+    def __init__(self, mode="native"):
+        self.mode = mode
+        self._sync = {}
+        self._native = {}
+
+    def sync_helper(self, func):
+        """Register a blocking database helper so it is reachable through the shim."""
+        self._sync[func.__name__] = func
+        return func
+
+    def native(self, name):
+        """Register a native async implementation for the helper called ``name``."""
+        def decorator(func):
+            self._native[name] = func
+            return func
+        return decorator
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._native and (self.mode == "native" or name not in self._sync):
+            return self._native[name]
+        func = self._sync.get(name)
+        if func is None:
+            raise AttributeError(f"No database helper named {name}")
+
+        async def shim(*args, **kwargs):
+            return await db_executor.run(func, *args, **kwargs)
+        shim.__name__ = name
+        return shim
+
+adb = AsyncHelpers(DB_ASYNC_MODE)
+
+def format_async_pool_stats():
+    """Render async pool stats for the admin stats command."""
+    stats = async_db.stats()
+    return (
+        f"⚡ Async database pool\n"
+        f"Size: {stats['open']} open / max {stats['max_size']} (idle: {stats['idle']}, in use: {stats['in_use']})\n"
+        f"Checkouts: {stats['checkouts']} (timeouts: {stats['timeouts']})\n"
+        f"Wait time: avg {stats['avg_wait_ms']:.1f} ms, max {stats['max_wait_ms']:.1f} ms\n"
+        f"Reconnects: {stats['reconnects']}"
+    )
+
+# Money: stored as NUMERIC, handled as Decimal, rounded half-up
+MONEY_SCALE = 3
+RATE_SCALE = 6
+MONEY_SQL_TYPE = f"NUMERIC(18, {MONEY_SCALE})"
+RATE_SQL_TYPE = f"NUMERIC(10, {RATE_SCALE})"
+MONEY_ZERO = Decimal("0").scaleb(-MONEY_SCALE)
+
+def to_money(value, places=MONEY_SCALE):
+    """Return value as a Decimal rounded half-up to ``places`` decimals."""
+    if not isinstance(value, Decimal):
+        # str() keeps floats like 0.1 from dragging in their binary expansion
+        value = Decimal(str(value))
+    return value.quantize(Decimal(1).scaleb(-places), rounding=ROUND_HALF_UP)
+
+def parse_money(text):
+    """Parse a user-entered amount; raises ValueError on bad input, like float() did."""
+    try:
+        value = Decimal(text.strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {text!r}")
+    if not value.is_finite():
+        raise ValueError(f"Invalid amount: {text!r}")
+    return to_money(value)
+
+# User profile cache
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+class UserProfileCache:
+    """LRU + TTL cache of (language, balance, is_banned) keyed by user_id.
+
+    Writers in this process update or drop entries as they commit, so the TTL only bounds
+    how long changes made outside the bot (manual SQL, another instance) can go unseen.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, user_id):
+        """Return (language, balance, is_banned) or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self._misses += 1
+                return None
+            profile, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self._hits += 1
+            return profile
+
+    def set(self, user_id, language, balance, is_banned=False):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = ((language, balance, bool(is_banned)), time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def update(self, user_id, **fields):
+        """Write through changed fields of a cached profile; uncached users are left alone."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            (language, balance, is_banned), expires_at = entry
+            profile = (
+                fields.get("language", language),
+                fields.get("balance", balance),
+                fields.get("is_banned", is_banned),
+            )
+            self._entries[user_id] = (profile, expires_at)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups * 100 if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+user_cache = UserProfileCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def format_user_cache_stats():
+    """Render user cache stats for the admin stats command."""
+    stats = user_cache.stats()
+    return (
+        f"👤 User profile cache\n"
+        f"Entries: {stats['size']} / {stats['max_size']} (TTL {stats['ttl']:.0f}s)\n"
+        f"Hits: {stats['hits']}, misses: {stats['misses']} ({stats['hit_rate']:.1f}% hit rate)\n"
+        f"Evictions: {stats['evictions']}, expirations: {stats['expirations']}"
+    )
+
+def cached_user_profile(user_id, cached):
+    """Turn a cached profile into get_user's return value."""
+    language, balance, is_banned = cached
+    if is_banned:
+        logger.warning(f"User {user_id} is banned")
+        return None
+    return (language, balance)
+
+# Outbound notification queue
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))  # messages per second, whole bot
+NOTIFY_CHAT_INTERVAL = float(os.getenv("NOTIFY_CHAT_INTERVAL", "1.0"))  # seconds between messages to one chat
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "3"))
+NOTIFY_DRAIN_TIMEOUT = float(os.getenv("NOTIFY_DRAIN_TIMEOUT", "5"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+class NotificationDispatcher:
+    """Central queue for messages to users other than the one being served.
+
+    ``enqueue`` only records the message and returns a ``concurrent.futures.Future``, so
+    it never blocks the caller and is safe to call from DB executor threads. A pool of
+    worker tasks sends the messages, keeping under a global messages-per-second budget
+    and a minimum interval per chat. Messages waiting for the same chat are coalesced
+    into one send; ``RetryAfter`` pauses every worker for the time Telegram asks for.
+    """
+
+    def __init__(self, workers=NOTIFY_WORKERS, global_rate=NOTIFY_GLOBAL_RATE,
+                 chat_interval=NOTIFY_CHAT_INTERVAL, max_retries=NOTIFY_MAX_RETRIES):
+        self.workers = workers
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._pending = {}  # chat_id -> [(text, parse_mode, reply_markup, failure_notice, future)]
+        self._scheduled = set()  # chats queued, waiting for their interval, or being sent to
+        self._chat_ready = {}
+        self._global_ready = 0.0
+        self._bot = None
+        self._loop = None
+        self._queue = None
+        self._rate_lock = None
+        self._tasks = []
+        self._sent = 0
+        self._sends = 0
+        self._failed = 0
+        self._retries = 0
+
+    def start(self, bot):
+        """Start the worker tasks on the running loop and flush anything enqueued earlier."""
+        self._bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._rate_lock = asyncio.Lock()
+        with self._lock:
+            for chat_id in self._scheduled:
+                self._queue.put_nowait(chat_id)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"notifier-{i}") for i in range(self.workers)
+        ]
+        logger.info(f"Notification dispatcher started with {self.workers} workers")
+
+    async def stop(self):
+        """Give queued messages a short grace period, then stop the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), NOTIFY_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Notification queue not drained before shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        with self._lock:
+            undelivered = sum(len(items) for items in self._pending.values())
+        if undelivered:
+            logger.warning(f"Notification dispatcher stopped with {undelivered} undelivered messages")
+        logger.info("Notification dispatcher stopped")
+
+    def enqueue(self, chat_id, text, parse_mode="Markdown", reply_markup=None, failure_notice=None):
+        """Queue a message for ``chat_id``. If it cannot be delivered, ``failure_notice`` (if given)
+        is sent to the admin together with the error."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._pending.setdefault(chat_id, []).append((text, parse_mode, reply_markup, failure_notice, future))
+            if chat_id in self._scheduled:
+                return future
+            self._scheduled.add(chat_id)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, chat_id)
+        return future
+
+    def stats(self):
+        with self._lock:
+            queued = sum(len(items) for items in self._pending.values())
+            chats = len(self._pending)
+        return {
+            "workers": len(self._tasks),
+            "queued": queued,
+            "chats": chats,
+            "sent": self._sent,
+            "sends": self._sends,
+            "failed": self._failed,
+            "retries": self._retries,
+        }
+
+    def _take_batch(self, chat_id):
+        """Pop the longest run of pending messages that can go out as one Telegram message."""
+        with self._lock:
+            items = self._pending.get(chat_id, [])
+            batch = items[:1]
+            length = len(batch[0][0]) if batch else 0
+            for item in items[1:]:
+                last = batch[-1]
+                if last[2] is not None or item[1] != last[1]:
+                    break
+                if length + 2 + len(item[0]) > TELEGRAM_MESSAGE_LIMIT:
+                    break
+                batch.append(item)
+                length += 2 + len(item[0])
+            del items[:len(batch)]
+            return batch
+
+    def _reschedule(self, chat_id):
+        """Requeue the chat after its interval if more messages arrived, else release it."""
+        with self._lock:
+            if self._pending.get(chat_id):
+                self._loop.call_later(self.chat_interval, self._queue.put_nowait, chat_id)
+                return
+            self._pending.pop(chat_id, None)
+            self._scheduled.discard(chat_id)
+        if len(self._chat_ready) > 10000:
+            now = time.monotonic()
+            self._chat_ready = {c: t for c, t in self._chat_ready.items() if t > now}
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._queue.get()
+            try:
+                wait = self._chat_ready.get(chat_id, 0.0) - time.monotonic()
+                if wait > 0:
+                    self._loop.call_later(wait, self._queue.put_nowait, chat_id)
+                    continue
+                batch = self._take_batch(chat_id)
+                if batch:
+                    await self._deliver(chat_id, batch)
+                    self._chat_ready[chat_id] = time.monotonic() + self.chat_interval
+                self._reschedule(chat_id)
+            except Exception as e:
+                logger.error(f"Notification worker error for chat {chat_id}: {e}")
+                self._reschedule(chat_id)
+            finally:
+                self._queue.task_done()
+
+    async def _throttle(self):
+        async with self._rate_lock:
+            now = time.monotonic()
+            if self._global_ready > now:
+                await asyncio.sleep(self._global_ready - now)
+            self._global_ready = max(time.monotonic(), self._global_ready) + 1 / self.global_rate
+
+    async def _deliver(self, chat_id, batch):
+        text = "\n\n".join(item[0] for item in batch)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._retries += 1
+            await self._throttle()
+            try:
+                message = await self._bot.send_message(
+                    chat_id=chat_id,
+                    text=text,
+                    parse_mode=batch[0][1],
+                    reply_markup=batch[-1][2]
+                )
+                self._sends += 1
+                self._sent += len(batch)
+                for item in batch:
+                    if not item[4].cancelled():
+                        item[4].set_result(message)
+                return
+            except telegram.error.RetryAfter as e:
+                error = e
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.warning(f"Flood limit hit sending to chat {chat_id}, pausing notifications for {delay}s")
+                self._global_ready = max(self._global_ready, time.monotonic() + delay)
+            except telegram.error.BadRequest as e:
+                if len(batch) > 1:
+                    # یکی از پیام‌های ادغام‌شده خراب است؛ جداگانه بفرست تا بقیه برسند
+                    for item in batch:
+                        await self._deliver(chat_id, [item])
+                    return
+                error = e
+                break
+            except telegram.error.NetworkError as e:
+                error = e
+                await asyncio.sleep(2 ** attempt)
+            except telegram.error.TelegramError as e:
+                error = e
+                break
+        self._failed += len(batch)
+        logger.error(f"Failed to deliver {len(batch)} notifications to chat {chat_id}: {error}")
+        for item in batch:
+            if item[3] and chat_id != DEFAULT_ADMIN_ID:
+                self.enqueue(DEFAULT_ADMIN_ID, f"{item[3]}: {error}")
+            if not item[4].cancelled():
+                item[4].set_exception(error)
+
+notifier = NotificationDispatcher()
+
+def format_notifier_stats():
+    """Render notification queue stats for the admin stats command."""
+    stats = notifier.stats()
+    return (
+        f"📨 Notifications\n"
+        f"Workers: {stats['workers']}, queued: {stats['queued']} for {stats['chats']} chats\n"
+        f"Delivered: {stats['sent']} in {stats['sends']} sends, failed: {stats['failed']}, retries: {stats['retries']}"
+    )
+
+# Per-user locks around flows that change users.balance
+BALANCE_LOCK_BACKEND = os.getenv("BALANCE_LOCK_BACKEND", "local").lower()  # "local" or "postgres" (several workers)
+BALANCE_LOCK_TIMEOUT = float(os.getenv("BALANCE_LOCK_TIMEOUT", "15"))
+ADVISORY_LOCK_POLL = 0.05  # seconds between pg_try_advisory_lock attempts, doubled up to 0.5s
+# Advisory locks live on their own small pool: a holder keeps that session for the whole flow
+# while the flow's queries check out async_db connections, so sharing one pool could starve it.
+# The pool size also caps how many balance flows hold a lock at once and must stay below DB_ASYNC_POOL_SIZE.
+BALANCE_LOCK_POOL_SIZE = int(os.getenv("BALANCE_LOCK_POOL_SIZE", "8"))
+lock_db = AsyncDatabasePool(DATABASE_URL, BALANCE_LOCK_POOL_SIZE, BALANCE_LOCK_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE)
+
+def check_lock_pool_size():
+    """Refuse to start when postgres lock holders could tie up the whole async query pool."""
+    if BALANCE_LOCK_BACKEND == "postgres" and BALANCE_LOCK_POOL_SIZE >= DB_ASYNC_POOL_SIZE:
+        logger.error(
+            f"BALANCE_LOCK_POOL_SIZE ({BALANCE_LOCK_POOL_SIZE}) must be smaller than "
+            f"DB_ASYNC_POOL_SIZE ({DB_ASYNC_POOL_SIZE}) with the postgres lock backend"
+        )
+        return False
+    return True
+
+class LockTimeout(Exception):
+    """Raised when a keyed lock could not be acquired within its timeout."""
+
+class KeyedLockManager:
+    """Async mutex per key (user id), created on demand and dropped when idle.
+
+    Within one process waiters queue on an asyncio.Lock. With the "postgres"
+    backend the holder additionally takes a session advisory lock on a
+    connection from lock_db, so flows for the same key are also serialised
+    across workers; only the head of the local queue ever waits on Postgres.
+    """
+
+    def __init__(self, namespace, backend="local", timeout=BALANCE_LOCK_TIMEOUT):
+        if backend not in ("local", "postgres"):
+            raise ValueError(f"Unknown lock backend {backend!r}")
+        self.namespace = namespace
+        self.backend = backend
+        self.timeout = timeout
+        self._locks = {}  # key -> [asyncio.Lock, holders and waiters]
+        self._acquired = 0
+        self._contended = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._hold_time = 0.0
+
+    @asynccontextmanager
+    async def _advisory(self, key, deadline):
+        try:
+            conn = await lock_db.acquire()
+        except psycopg2.pool.PoolError:
+            raise LockTimeout(f"Timed out waiting for a lock connection for {self.namespace}:{key}")
+        discard = False
+        try:
+            c = AsyncCursor(conn.cursor())
+            lock_key = f"{self.namespace}:{key}"
+            delay = ADVISORY_LOCK_POLL
+            while True:
+                await c.execute('SELECT pg_try_advisory_lock(hashtextextended(%s, 0))', (lock_key,))
+                if c.fetchone()[0]:
+                    break
+                if time.monotonic() + delay > deadline:
+                    raise LockTimeout(f"Timed out waiting for advisory lock {lock_key}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+            try:
+                yield
+            finally:
+                # Closing the session would also release it; unlock so the connection can go back to the pool
+                await c.execute('SELECT pg_advisory_unlock(hashtextextended(%s, 0))', (lock_key,))
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, asyncio.CancelledError):
+            discard = True
+            raise
+        finally:
+            lock_db.release(conn, discard=discard)
+
+    @asynccontextmanager
+    async def hold(self, key):
+        """Hold the lock for key, raising LockTimeout if it is not free within the timeout."""
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        started = time.monotonic()
+        deadline = started + self.timeout
+        if entry[1] > 1:
+            self._contended += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self._timeouts += 1
+                raise LockTimeout(f"Timed out waiting for {self.namespace} lock on {key}")
+            try:
+                if self.backend == "postgres":
+                    try:
+                        async with self._advisory(key, deadline):
+                            acquired_at = self._record_acquire(started)
+                            try:
+                                yield
+                            finally:
+                                self._hold_time += time.monotonic() - acquired_at
+                    except LockTimeout:
+                        self._timeouts += 1
+                        raise
+                else:
+                    acquired_at = self._record_acquire(started)
+                    try:
+                        yield
+                    finally:
+                        self._hold_time += time.monotonic() - acquired_at
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def _record_acquire(self, started):
+        now = time.monotonic()
+        waited = now - started
+        self._acquired += 1
+        self._wait_time += waited
+        self._max_wait = max(self._max_wait, waited)
+        return now
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "held": sum(1 for lock, _ in self._locks.values() if lock.locked()),
+            "keys": len(self._locks),
+            "acquired": self._acquired,
+            "contended": self._contended,
+            "timeouts": self._timeouts,
+            "avg_wait_ms": (self._wait_time / self._acquired * 1000) if self._acquired else 0.0,
+            "max_wait_ms": self._max_wait * 1000,
+            "avg_hold_ms": (self._hold_time / self._acquired * 1000) if self._acquired else 0.0,
+        }
+
+balance_locks = KeyedLockManager("balance", BALANCE_LOCK_BACKEND)
+
+def format_lock_stats():
+    """Render balance lock contention for the admin stats command."""
+    stats = balance_locks.stats()
+    text = (
+        f"🔒 Balance locks ({stats['backend']})\n"
+        f"Held: {stats['held']}, keys: {stats['keys']}\n"
+        f"Acquired: {stats['acquired']}, contended: {stats['contended']}, timeouts: {stats['timeouts']}\n"
+        f"Wait: avg {stats['avg_wait_ms']:.1f} ms, max {stats['max_wait_ms']:.1f} ms; hold avg {stats['avg_hold_ms']:.1f} ms"
+    )
+    if stats["backend"] == "postgres":
+        pool = lock_db.stats()
+        text += f"\nLock connections: {pool['in_use']} in use / {pool['max_size']}, timeouts: {pool['timeouts']}"
+    return text
+
 # Database initialization
 async def notify_admin_error(bot_token, error_message):
     """Send error notification to admin asynchronously."""
@@ -676,14 +1782,14 @@ async def notify_admin_error(bot_token, error_message):
 def init_db():
     """Initialize database tables and update seed profit rates."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 # اضافه کردن ستون‌های username و created_at به جدول users
                 logger.info("Adding username and created_at columns to users table")
                 c.execute('''
                     ALTER TABLE users
                     ADD COLUMN IF NOT EXISTS username TEXT,
-                    ADD COLUMN IF NOT EXISTS created_at TEXT
+                    ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ
                 ''')
                 logger.info("Successfully added username and created_at columns to users table")
 
@@ -691,8 +1797,8 @@ def init_db():
                 logger.info("Adding bonus and fmx_balance columns to users table")
                 c.execute('''
                     ALTER TABLE users
-                    ADD COLUMN IF NOT EXISTS "bonus" REAL DEFAULT 0.0,
-                    ADD COLUMN IF NOT EXISTS fmx_balance REAL DEFAULT 0.0
+                    ADD COLUMN IF NOT EXISTS "bonus" NUMERIC(18, 3) DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS fmx_balance NUMERIC(18, 3) DEFAULT 0
                 ''')
                 logger.info("Successfully added bonus and fmx_balance columns to users table")
 
@@ -702,11 +1808,11 @@ def init_db():
                     CREATE TABLE IF NOT EXISTS users (
                         user_id BIGINT PRIMARY KEY,
                         language TEXT DEFAULT 'en',
-                        balance REAL DEFAULT 0.0,
+                        balance NUMERIC(18, 3) DEFAULT 0,
                         username TEXT,
-                        created_at TEXT,
-                        "bonus" REAL DEFAULT 0.0,
-                        fmx_balance REAL DEFAULT 0.0
+                        created_at TIMESTAMPTZ,
+                        "bonus" NUMERIC(18, 3) DEFAULT 0,
+                        fmx_balance NUMERIC(18, 3) DEFAULT 0
                     )
                 ''')
                 logger.info("Users table created or already exists")
@@ -719,6 +1825,12 @@ def init_db():
                 ''')
                 logger.info("Successfully added is_banned column to users table")
 
+                # اضافه کردن ستون auto_harvest (برداشت خودکار شبانه)
+                c.execute('''
+                    ALTER TABLE users
+                    ADD COLUMN IF NOT EXISTS auto_harvest BOOLEAN NOT NULL DEFAULT FALSE
+                ''')
+
                 # تعریف جدول seeds
                 logger.info("Creating seeds table if not exists")
                 c.execute('''
@@ -726,8 +1838,8 @@ def init_db():
                         seed_id SERIAL PRIMARY KEY,
                         name TEXT NOT NULL,
                         name_fa TEXT NOT NULL,
-                        price REAL NOT NULL,
-                        daily_profit_rate REAL NOT NULL
+                        price NUMERIC(18, 3) NOT NULL,
+                        daily_profit_rate NUMERIC(10, 6) NOT NULL
                     )
                 ''')
                 logger.info("Seeds table created or already exists")
@@ -739,9 +1851,9 @@ def init_db():
                         id SERIAL PRIMARY KEY,
                         user_id BIGINT,
                         seed_id INTEGER,
-                        purchase_date TEXT,
-                        last_planted TEXT,
-                        last_harvested TEXT,
+                        purchase_date TIMESTAMPTZ,
+                        last_planted TIMESTAMPTZ,
+                        last_harvested TIMESTAMPTZ,
                         FOREIGN KEY (user_id) REFERENCES users (user_id),
                         FOREIGN KEY (seed_id) REFERENCES seeds (seed_id)
                     )
@@ -754,11 +1866,11 @@ def init_db():
                     CREATE TABLE IF NOT EXISTS transactions (
                         id SERIAL PRIMARY KEY,
                         user_id BIGINT,
-                        amount REAL,
+                        amount NUMERIC(18, 3),
                         network TEXT,
                         status TEXT,
                         type TEXT,
-                        created_at TEXT,
+                        created_at TIMESTAMPTZ,
                         message_id BIGINT,
                         address TEXT,
                         seed_id INTEGER,
@@ -791,8 +1903,8 @@ def init_db():
                         referred_id BIGINT,
                         transaction_id INTEGER,
                         level INTEGER,
-                        profit_amount REAL,
-                        created_at TEXT,
+                        profit_amount NUMERIC(18, 3),
+                        created_at TIMESTAMPTZ,
                         FOREIGN KEY (referrer_id) REFERENCES users (user_id),
                         FOREIGN KEY (referred_id) REFERENCES users (user_id),
                         FOREIGN KEY (transaction_id) REFERENCES transactions (id)
@@ -807,15 +1919,118 @@ def init_db():
                         id SERIAL PRIMARY KEY,
                         user_id BIGINT,
                         seed_id INTEGER,
-                        amount REAL,
+                        amount NUMERIC(18, 3),
                         period TEXT,
-                        created_at TEXT,
+                        created_at TIMESTAMPTZ,
                         FOREIGN KEY (user_id) REFERENCES users (user_id),
                         FOREIGN KEY (seed_id) REFERENCES seeds (seed_id)
                     )
                 ''')
+                c.execute('ALTER TABLE profits ADD COLUMN IF NOT EXISTS user_seed_id INTEGER')
                 logger.info("Profits table created or already exists")
 
+                # تعریف جدول user_stats (جمع‌های از پیش محاسبه‌شده برای کیف پول)
+                logger.info("Creating user_stats table if not exists")
+                c.execute("SELECT to_regclass('user_stats')")
+                user_stats_exists = c.fetchone()[0] is not None
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS user_stats (
+                        user_id BIGINT PRIMARY KEY,
+                        seed_profit NUMERIC(18, 3) NOT NULL DEFAULT 0,
+                        referral_profit NUMERIC(18, 3) NOT NULL DEFAULT 0,
+                        confirmed_count INTEGER NOT NULL DEFAULT 0,
+                        last_confirmed_at TIMESTAMPTZ,
+                        FOREIGN KEY (user_id) REFERENCES users (user_id)
+                    )
+                ''')
+                if not user_stats_exists:
+                    logger.info("Backfilling user_stats from profits, referral_profits and transactions")
+                    c.execute(REBUILD_USER_STATS_QUERY)
+                    logger.info(f"Backfilled user_stats for {c.rowcount} users")
+                logger.info("User_stats table created or already exists")
+
+                # تعریف جدول accrual_runs (پیشرفت برداشت خودکار روزانه، برای ادامه بعد از کرش)
+                logger.info("Creating accrual_runs table if not exists")
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS accrual_runs (
+                        run_date DATE PRIMARY KEY,
+                        last_user_id BIGINT NOT NULL DEFAULT 0,
+                        users_processed INTEGER NOT NULL DEFAULT 0,
+                        seeds_harvested INTEGER NOT NULL DEFAULT 0,
+                        amount_credited NUMERIC(18, 3) NOT NULL DEFAULT 0,
+                        started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        finished_at TIMESTAMPTZ
+                    )
+                ''')
+                logger.info("Accrual_runs table created or already exists")
+
+                # تعریف جداول broadcasts و broadcast_deliveries (پیام همگانی و نتیجه ارسال به هر کاربر)
+                logger.info("Creating broadcast tables if not exist")
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS broadcasts (
+                        id SERIAL PRIMARY KEY,
+                        text TEXT NOT NULL,
+                        created_by BIGINT,
+                        total INTEGER NOT NULL DEFAULT 0,
+                        last_user_id BIGINT NOT NULL DEFAULT 0,
+                        delivered INTEGER NOT NULL DEFAULT 0,
+                        blocked INTEGER NOT NULL DEFAULT 0,
+                        deleted INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        finished_at TIMESTAMPTZ
+                    )
+                ''')
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                        broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id),
+                        user_id BIGINT NOT NULL,
+                        status TEXT NOT NULL,
+                        error TEXT,
+                        sent_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        PRIMARY KEY (broadcast_id, user_id)
+                    )
+                ''')
+                logger.info("Broadcast tables created or already exist")
+
+                # Append-only record of every balance change; users.balance is its projection
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS ledger (
+                        id BIGSERIAL PRIMARY KEY,
+                        user_id BIGINT NOT NULL REFERENCES users (user_id),
+                        entry_type TEXT NOT NULL,
+                        amount NUMERIC(18, 3) NOT NULL,
+                        reference_id BIGINT,
+                        idempotency_key TEXT UNIQUE,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                ''')
+                c.execute('''
+                    CREATE OR REPLACE FUNCTION ledger_append_only() RETURNS trigger AS $$
+                    BEGIN
+                        RAISE EXCEPTION 'ledger is append-only; record a correcting entry instead';
+                    END
+                    $$ LANGUAGE plpgsql
+                ''')
+                c.execute('DROP TRIGGER IF EXISTS ledger_append_only ON ledger')
+                c.execute('''
+                    CREATE TRIGGER ledger_append_only
+                    BEFORE UPDATE OR DELETE ON ledger
+                    FOR EACH ROW EXECUTE FUNCTION ledger_append_only()
+                ''')
+                logger.info("Ledger table created or already exists")
+
+                # Pickled conversation states and user_data (PostgresPersistence)
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS bot_persistence (
+                        kind TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        data BYTEA NOT NULL,
+                        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        PRIMARY KEY (kind, key)
+                    )
+                ''')
+
                 # پر کردن یا به‌روزرسانی جدول seeds
                 logger.info("Checking and updating seeds table")
                 c.execute('SELECT COUNT(*) FROM seeds')
@@ -867,16 +2082,242 @@ def init_db():
         loop.run_until_complete(notify_admin_error(bot_token, f"Failed to initialize database: {str(e)}"))
         raise
 
+# Legacy ISO TEXT timestamp columns converted to timestamptz: table -> (key column, columns)
+TIMESTAMP_COLUMNS = {
+    "users": ("user_id", ["created_at"]),
+    "user_seeds": ("id", ["purchase_date", "last_planted", "last_harvested"]),
+    "transactions": ("id", ["created_at"]),
+    "referral_profits": ("id", ["created_at"]),
+    "profits": ("id", ["created_at"]),
+    "user_stats": ("user_id", ["last_confirmed_at"]),
+}
+# Legacy REAL money columns converted to NUMERIC: (table, key column, columns, new type, scale, default, not null)
+MONEY_COLUMNS = [
+    ("users", "user_id", ["balance", "bonus", "fmx_balance"], MONEY_SQL_TYPE, MONEY_SCALE, "0", False),
+    ("transactions", "id", ["amount"], MONEY_SQL_TYPE, MONEY_SCALE, None, False),
+    ("profits", "id", ["amount"], MONEY_SQL_TYPE, MONEY_SCALE, None, False),
+    ("referral_profits", "id", ["profit_amount"], MONEY_SQL_TYPE, MONEY_SCALE, None, False),
+    ("user_stats", "user_id", ["seed_profit", "referral_profit"], MONEY_SQL_TYPE, MONEY_SCALE, "0", True),
+    ("seeds", "seed_id", ["price"], MONEY_SQL_TYPE, MONEY_SCALE, None, True),
+    ("seeds", "seed_id", ["daily_profit_rate"], RATE_SQL_TYPE, RATE_SCALE, None, True),
+]
+COLUMN_BACKFILL_BATCH = int(os.getenv("COLUMN_BACKFILL_BATCH", "5000"))
+
+def migrate_column_types():
+    """Convert legacy column types (TEXT timestamps, REAL money) without holding long table locks.
+
+    Each table is migrated by migrate_table_columns; tables that are already converted are skipped,
+    so re-running after an interruption resumes where it left off.
+    """
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                # Unparseable legacy values become NULL instead of failing the batch
+                c.execute('''
+                    CREATE OR REPLACE FUNCTION try_timestamptz(value TEXT) RETURNS TIMESTAMPTZ AS $$
+                    BEGIN
+                        RETURN NULLIF(value, '')::TIMESTAMPTZ;
+                    EXCEPTION WHEN others THEN
+                        RETURN NULL;
+                    END;
+                    $$ LANGUAGE plpgsql STABLE
+                ''')
+        for table, (key, columns) in TIMESTAMP_COLUMNS.items():
+            migrate_table_columns(table, key, columns, ("text",), "TIMESTAMPTZ", "try_timestamptz({value})", "tz")
+        for table, key, columns, sql_type, scale, default, not_null in MONEY_COLUMNS:
+            # Go through float8 so REAL noise (e.g. 15.039999) rounds back to the intended value
+            migrate_table_columns(
+                table, key, columns, ("real", "double precision"), sql_type,
+                f"round({{value}}::float8::numeric, {scale})", "num", default=default, not_null=not_null,
+            )
+    except Exception as e:
+        logger.error(f"Error migrating column types: {e}", exc_info=True)
+        raise
+
+def migrate_table_columns(table, key, columns, legacy_types, new_type, convert, suffix, default=None, not_null=False):
+    """Online type change for some columns of one table.
+
+    Adds <column>_<suffix> shadow columns kept in sync by a trigger, backfills them in keyed
+    batches (one short transaction each), then swaps them in under a brief lock. ``convert`` is
+    an SQL template turning ``{value}`` of the legacy type into the new type.
+    """
+    sync_name = f"{table}_{suffix}_sync"
+    with db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute('''
+                SELECT column_name
+                FROM information_schema.columns
+                WHERE table_name = %s AND column_name = ANY(%s) AND data_type = ANY(%s)
+            ''', (table, columns, list(legacy_types)))
+            pending = [row[0] for row in c.fetchall()]
+            if not pending:
+                return
+            logger.info(f"Migrating {table} ({', '.join(pending)}) to {new_type}")
+            for column in pending:
+                c.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}_{suffix} {new_type}')
+            # Writes from instances still running the old code keep the shadow columns current
+            sync = "\n".join(
+                f"NEW.{column}_{suffix} := {convert.format(value=f'NEW.{column}')};" for column in pending
+            )
+            c.execute(f'''
+                CREATE OR REPLACE FUNCTION {sync_name}() RETURNS trigger AS $$
+                BEGIN
+                    {sync}
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            c.execute(f'DROP TRIGGER IF EXISTS {sync_name} ON {table}')
+            c.execute(f'''
+                CREATE TRIGGER {sync_name}
+                BEFORE INSERT OR UPDATE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION {sync_name}()
+            ''')
+
+    assignments = ", ".join(f"{column}_{suffix} = {convert.format(value=f't.{column}')}" for column in pending)
+    last_key = None
+    migrated = 0
+    started = time.monotonic()
+    while True:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(f'''
+                    WITH batch AS (
+                        SELECT {key} FROM {table}
+                        WHERE %(last_key)s IS NULL OR {key} > %(last_key)s
+                        ORDER BY {key}
+                        LIMIT %(limit)s
+                    )
+                    UPDATE {table} t
+                    SET {assignments}
+                    FROM batch
+                    WHERE t.{key} = batch.{key}
+                    RETURNING t.{key}
+                ''', {"last_key": last_key, "limit": COLUMN_BACKFILL_BATCH})
+                keys = [row[0] for row in c.fetchall()]
+        if not keys:
+            break
+        last_key = max(keys)
+        migrated += len(keys)
+    elapsed = time.monotonic() - started
+    logger.info(f"Backfilled {migrated} rows of {table} in {elapsed:.1f}s ({migrated / max(elapsed, 0.001):.0f} rows/s)")
+
+    with db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SET LOCAL lock_timeout = '10s'")
+            c.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+            c.execute(f'DROP TRIGGER IF EXISTS {sync_name} ON {table}')
+            c.execute(f'DROP FUNCTION IF EXISTS {sync_name}()')
+            for column in pending:
+                # Indexes on the old column go with it; ensure_indexes rebuilds them on the new one
+                c.execute(f'ALTER TABLE {table} DROP COLUMN {column}')
+                c.execute(f'ALTER TABLE {table} RENAME COLUMN {column}_{suffix} TO {column}')
+                if default is not None:
+                    c.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT {default}')
+                if not_null:
+                    c.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL')
+    logger.info(f"Swapped {table} ({', '.join(pending)}) to {new_type}")
+
+# Secondary indexes for the lookups in this file: (name, table, column list[, partial predicate])
+MANAGED_INDEXES = [
+    ("idx_user_seeds_user_id", "user_seeds", "user_id, id"),
+    ("idx_transactions_user_status_created", "transactions", "user_id, status, created_at"),
+    ("idx_transactions_user_message_pending", "transactions", "user_id, message_id", "status = 'pending'"),
+    ("idx_referrals_referred_id", "referrals", "referred_id"),
+    ("idx_referrals_referrer_level", "referrals", "referrer_id, level"),
+    ("idx_profits_user_seed_created", "profits", "user_id, seed_id, created_at"),
+    ("idx_referral_profits_referrer_referred", "referral_profits", "referrer_id, referred_id"),
+    ("idx_ledger_user_id", "ledger", "user_id, amount"),
+]
+
+def ensure_indexes():
+    """Create any missing managed index without blocking writes (CREATE INDEX CONCURRENTLY)."""
+    conn = db_pool.getconn()
+    discard = False
+    try:
+        # CONCURRENTLY can't run inside a transaction block
+        conn.autocommit = True
+        with conn.cursor() as c:
+            for name, table, columns, *predicate in MANAGED_INDEXES:
+                # A failed concurrent build leaves an INVALID index behind; drop it and retry
+                c.execute('''
+                    SELECT i.indisvalid
+                    FROM pg_index i
+                    JOIN pg_class ic ON ic.oid = i.indexrelid
+                    WHERE ic.relname = %s
+                ''', (name,))
+                row = c.fetchone()
+                if row and row[0]:
+                    continue
+                if row:
+                    logger.warning(f"Dropping invalid index {name} before rebuilding it")
+                    c.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+                where = f" WHERE {predicate[0]}" if predicate else ""
+                logger.info(f"Creating index {name} on {table} ({columns}){where}")
+                started = time.monotonic()
+                c.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns}){where}')
+                logger.info(f"Created index {name} in {time.monotonic() - started:.1f}s")
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    except Exception as e:
+        logger.error(f"Error creating indexes: {e}", exc_info=True)
+        raise
+    finally:
+        if not conn.closed:
+            conn.autocommit = False
+        db_pool.putconn(conn, discard=discard)
+
+@adb.sync_helper
+def get_db_report():
+    """Collect index usage, per-table scan counts and (if installed) the slowest statements."""
+    report = {"indexes": [], "tables": [], "statements": None}
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    SELECT relname, indexrelname, idx_scan, pg_size_pretty(pg_relation_size(indexrelid))
+                    FROM pg_stat_user_indexes
+                    ORDER BY relname, indexrelname
+                ''')
+                report["indexes"] = c.fetchall()
+                c.execute('''
+                    SELECT relname, seq_scan, seq_tup_read, COALESCE(idx_scan, 0), n_live_tup
+                    FROM pg_stat_user_tables
+                    ORDER BY seq_tup_read DESC
+                ''')
+                report["tables"] = c.fetchall()
+                c.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+                if c.fetchone():
+                    try:
+                        c.execute('SAVEPOINT report_statements')
+                        c.execute('''
+                            SELECT calls, mean_exec_time, total_exec_time, left(regexp_replace(query, '\\s+', ' ', 'g'), 120)
+                            FROM pg_stat_statements
+                            WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+                            ORDER BY mean_exec_time DESC
+                            LIMIT 10
+                        ''')
+                        report["statements"] = c.fetchall()
+                    except psycopg2.Error as e:
+                        # Extension installed but not preloaded, or a pre-13 server without *_exec_time
+                        c.execute('ROLLBACK TO SAVEPOINT report_statements')
+                        logger.warning(f"pg_stat_statements not readable: {e}")
+        return report
+    except Exception as e:
+        logger.error(f"Error collecting database report: {e}")
+        raise
+
 def fix_users_table():
     """Add username and created_at columns to users table if they don't exist."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 logger.info("Checking and adding username and created_at columns to users table")
                 c.execute('''
                     ALTER TABLE users
                     ADD COLUMN IF NOT EXISTS username TEXT,
-                    ADD COLUMN IF NOT EXISTS created_at TEXT
+                    ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ
                 ''')
                 conn.commit()
                 logger.info("Successfully added username and created_at columns to users table")
@@ -884,27 +2325,30 @@ def fix_users_table():
         logger.error(f"Error fixing users table: {e}", exc_info=True)
         raise
 
+@adb.sync_helper
 def ban_user(user_id):
     """Ban a user by setting is_banned to True."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('UPDATE users SET is_banned = TRUE WHERE user_id = %s', (user_id,))
                 if c.rowcount == 0:
                     return False
                 conn.commit()
+                user_cache.invalidate(user_id)
                 logger.info(f"User {user_id} banned successfully")
                 return True
     except Exception as e:
         logger.error(f"Error banning user {user_id}: {e}")
         raise
 
+@adb.sync_helper
 def add_user_seed_admin(user_id, seed_id):
     """Add a seed to a user by admin."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                purchase_date = datetime.now(pytz.timezone('Asia/Tehran')).isoformat()
+                purchase_date = datetime.now(pytz.timezone('Asia/Tehran'))
                 c.execute('''
                     INSERT INTO user_seeds (user_id, seed_id, purchase_date)
                     VALUES (%s, %s, %s)
@@ -915,10 +2359,11 @@ def add_user_seed_admin(user_id, seed_id):
         logger.error(f"Error adding seed {seed_id} to user {user_id}: {e}")
         raise
 
+@adb.sync_helper
 def remove_user_seed(user_id, user_seed_id):
     """Remove a specific seed from a user."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
                     DELETE FROM user_seeds
@@ -934,30 +2379,37 @@ def remove_user_seed(user_id, user_seed_id):
         raise    
 
 # Database helper functions
+@adb.sync_helper
 def get_user(user_id):
     """Retrieve user data from database or create a new user."""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached_user_profile(user_id, cached)
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('SELECT language, balance, is_banned FROM users WHERE user_id = %s', (user_id,))
                 user = c.fetchone()
                 if user:
+                    user_cache.set(user_id, *user)
                     if user[2]:  # اگر is_banned=True باشه
                         logger.warning(f"User {user_id} is banned")
                         return None
                     return user[:2]  # فقط language و balance رو برگردون
-                # Create new user if not found
-                upsert_user(user_id, language="en")
-                return ("en", 0.0)
+        # Create new user if not found (after the lookup connection is back in the pool)
+        upsert_user(user_id, language="en")
+        user_cache.set(user_id, "en", MONEY_ZERO)
+        return ("en", MONEY_ZERO)
     except Exception as e:
         logger.error(f"Error getting user {user_id}: {e}")
         return None
 
+@adb.sync_helper
 def upsert_user(user_id, language='en', username=None, referred_by=None):
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                created_at = datetime.now(pytz.timezone('Asia/Tehran')).isoformat()
+                created_at = datetime.now(pytz.timezone('Asia/Tehran'))
                 c.execute('''
                     INSERT INTO users (user_id, language, balance, username, created_at)
                     VALUES (%s, %s, %s, %s, %s)
@@ -965,15 +2417,17 @@ def upsert_user(user_id, language='en', username=None, referred_by=None):
                     SET language = %s, username = %s
                 ''', (user_id, language, 0.0, username, created_at, language, username))
                 conn.commit()
+                user_cache.update(user_id, language=language)
                 logger.info(f"Upserted user {user_id} with language {language}, username {username}")
     except Exception as e:
         logger.error(f"Error upserting user {user_id}: {e}")
         raise
 
 # تابع جدید برای گرفتن جزئیات رفرال
+@adb.sync_helper
 def get_referral_details(referrer_id, referred_id, lang):
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 # گرفتن اطلاعات کاربر (username و زمان ورود)
                 c.execute('''
@@ -1007,7 +2461,7 @@ def get_referral_details(referrer_id, referred_id, lang):
                     FROM referral_profits 
                     WHERE referrer_id = %s AND referred_id = %s
                 ''', (referrer_id, referred_id))
-                profit = c.fetchone()[0] or 0.0
+                profit = c.fetchone()[0] or MONEY_ZERO
 
                 # گرفتن تراکنش‌ها
                 c.execute('''
@@ -1035,38 +2489,186 @@ def get_referral_details(referrer_id, referred_id, lang):
         logger.error(f"Error getting referral details for referrer {referrer_id}, referred {referred_id}: {e}")
         return None    
 
-def update_balance(user_id, amount):
-    """Update user balance."""
+# Every change to users.balance appends its ledger row in the same statement; users.balance
+# is a projection of SUM(ledger.amount) and /verify_ledger checks that it still is.
+# The ledger insert drives the update: it locks the user row (so require_funds sees the current
+# balance) and a repeated idempotency key hits ON CONFLICT DO NOTHING, leaving the balance alone
+# and returning no row, even when two callers race with the same key.
+BALANCE_CHANGE_QUERY = '''
+    WITH entry AS (
+        INSERT INTO ledger (user_id, entry_type, amount, reference_id, idempotency_key)
+        SELECT u.user_id, %(entry_type)s, %(amount)s, %(reference_id)s::BIGINT, %(idempotency_key)s::TEXT
+        FROM users u
+        WHERE u.user_id = %(user_id)s
+          AND (NOT %(require_funds)s OR u.balance + %(amount)s >= 0)
+        FOR UPDATE OF u
+        ON CONFLICT (idempotency_key) DO NOTHING
+        RETURNING user_id
+    ), changed AS (
+        UPDATE users
+        SET balance = balance + %(amount)s
+        FROM entry
+        WHERE users.user_id = entry.user_id
+        RETURNING users.balance
+    )
+    SELECT balance FROM changed
+'''
+
+def balance_change_params(user_id, amount, entry_type, reference_id=None, idempotency_key=None, require_funds=False):
+    return {
+        "user_id": user_id,
+        "amount": to_money(amount),
+        "entry_type": entry_type,
+        "reference_id": reference_id,
+        "idempotency_key": idempotency_key,
+        "require_funds": require_funds,
+    }
+
+@adb.sync_helper
+def update_balance(user_id, amount, entry_type="adjustment", reference_id=None, idempotency_key=None):
+    """Add amount (negative to subtract) to the user's balance and ledger.
+    Returns the new balance, or None if the user is missing or idempotency_key was already applied."""
+    params = balance_change_params(user_id, amount, entry_type, reference_id, idempotency_key)
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                # گرفتن بالانس فعلی
-                c.execute('SELECT balance FROM users WHERE user_id = %s', (user_id,))
-                current_balance = c.fetchone()[0] or 0.0
-                logger.info(f"Current balance for user {user_id} before update: {current_balance}")
-                # آپدیت بالانس
-                c.execute('UPDATE users SET balance = balance + %s WHERE user_id = %s', (amount, user_id))
-                # گرفتن بالانس جدید
-                c.execute('SELECT balance FROM users WHERE user_id = %s', (user_id,))
-                new_balance = c.fetchone()[0] or 0.0
-                logger.info(f"Updated balance for user {user_id}: added {amount}, new balance: {new_balance}")
+                c.execute(BALANCE_CHANGE_QUERY, params)
+                row = c.fetchone()
                 conn.commit()
+        if row is None:
+            logger.warning(f"Balance change {entry_type} of {params['amount']} for user {user_id} not applied (key {idempotency_key})")
+            return None
+        user_cache.update(user_id, balance=row[0])
+        logger.info(f"Updated balance for user {user_id}: {entry_type} {params['amount']}, new balance: {row[0]}")
+        return row[0]
     except Exception as e:
         logger.error(f"Error updating balance for user {user_id}: {e}", exc_info=True)
         raise
 
+SPENDABLE_BALANCE_QUERY = '''
+    SELECT u.balance, u.balance - COALESCE((
+        SELECT SUM(t.amount) FROM transactions t
+        WHERE t.user_id = u.user_id AND t.type = 'withdrawal' AND t.status = 'pending'
+    ), 0)
+    FROM users u
+    WHERE u.user_id = %s
+'''
+
+@adb.sync_helper
+def get_spendable_balance(user_id):
+    """Fresh (uncached) balance and balance minus pending withdrawals. Returns (balance, spendable) or None."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(SPENDABLE_BALANCE_QUERY, (user_id,))
+                row = c.fetchone()
+        if row:
+            user_cache.update(user_id, balance=row[0])
+        return row
+    except Exception as e:
+        logger.error(f"Error reading spendable balance for user {user_id}: {e}")
+        raise
+
+@adb.sync_helper
+def purchase_seed(user_id, seed_id, price, idempotency_key):
+    """Buy a seed from the spendable balance: debit, ledger entry and user_seeds row in one transaction.
+    Returns ("purchased", new_balance), ("insufficient", balance) or ("duplicate", None) if the key was already applied."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                # قفل ردیف کاربر تا موجودی قابل برداشت تا پایان خرید ثابت بماند
+                c.execute(SPENDABLE_BALANCE_QUERY + ' FOR UPDATE OF u', (user_id,))
+                row = c.fetchone()
+                if row is None or row[1] < price:
+                    conn.rollback()
+                    logger.warning(f"Refused purchase of seed {seed_id} for {price} by user {user_id}: insufficient spendable balance")
+                    return "insufficient", row[0] if row else MONEY_ZERO
+                c.execute(BALANCE_CHANGE_QUERY, balance_change_params(
+                    user_id, -to_money(price), "purchase", seed_id, idempotency_key, require_funds=True
+                ))
+                debited = c.fetchone()
+                if debited is None:
+                    conn.rollback()
+                    logger.warning(f"Purchase {idempotency_key} by user {user_id} was already applied")
+                    return "duplicate", None
+                c.execute('''
+                    INSERT INTO user_seeds (user_id, seed_id, purchase_date)
+                    VALUES (%s, %s, %s)
+                ''', (user_id, seed_id, dt.datetime.now(dt.UTC)))
+                conn.commit()
+        user_cache.update(user_id, balance=debited[0])
+        logger.info(f"User {user_id} bought seed {seed_id} for {price} from balance, new balance: {debited[0]}")
+        return "purchased", debited[0]
+    except Exception as e:
+        logger.error(f"Error purchasing seed {seed_id} for user {user_id}: {e}", exc_info=True)
+        raise
+
+# Running totals in user_stats are kept in step by the writers below, inside their own transaction
+REBUILD_USER_STATS_QUERY = '''
+    INSERT INTO user_stats (user_id, seed_profit, referral_profit, confirmed_count, last_confirmed_at)
+    SELECT u.user_id, COALESCE(p.total, 0), COALESCE(r.total, 0), COALESCE(t.confirmed_count, 0), t.last_confirmed_at
+    FROM users u
+    LEFT JOIN (SELECT user_id, SUM(amount) AS total FROM profits GROUP BY user_id) p
+        ON p.user_id = u.user_id
+    LEFT JOIN (SELECT referrer_id, SUM(profit_amount) AS total FROM referral_profits GROUP BY referrer_id) r
+        ON r.referrer_id = u.user_id
+    LEFT JOIN (
+        SELECT user_id, COUNT(*) AS confirmed_count, MAX(created_at::TIMESTAMPTZ) AS last_confirmed_at
+        FROM transactions
+        WHERE status = 'confirmed'
+        GROUP BY user_id
+    ) t ON t.user_id = u.user_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET seed_profit = EXCLUDED.seed_profit,
+        referral_profit = EXCLUDED.referral_profit,
+        confirmed_count = EXCLUDED.confirmed_count,
+        last_confirmed_at = EXCLUDED.last_confirmed_at
+'''
+
+def bump_user_stats(c, user_id, seed_profit=MONEY_ZERO, referral_profit=MONEY_ZERO, confirmed_count=0, confirmed_at=None):
+    """Add deltas to a user's running totals using the caller's cursor (and transaction)."""
+    c.execute('''
+        INSERT INTO user_stats (user_id, seed_profit, referral_profit, confirmed_count, last_confirmed_at)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE
+        SET seed_profit = user_stats.seed_profit + EXCLUDED.seed_profit,
+            referral_profit = user_stats.referral_profit + EXCLUDED.referral_profit,
+            confirmed_count = user_stats.confirmed_count + EXCLUDED.confirmed_count,
+            last_confirmed_at = GREATEST(user_stats.last_confirmed_at, EXCLUDED.last_confirmed_at)
+    ''', (user_id, seed_profit, referral_profit, confirmed_count, confirmed_at))
+
+@adb.sync_helper
+def rebuild_user_stats():
+    """Recompute user_stats from scratch. Returns the number of users written."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('LOCK TABLE user_stats IN EXCLUSIVE MODE')
+                c.execute('DELETE FROM user_stats')
+                c.execute(REBUILD_USER_STATS_QUERY)
+                count = c.rowcount
+                conn.commit()
+                logger.info(f"Rebuilt user_stats for {count} users")
+                return count
+    except Exception as e:
+        logger.error(f"Error rebuilding user_stats: {e}")
+        raise
+
+@adb.sync_helper
 def insert_transaction(user_id, amount, network, status, type, message_id, address=None, seed_id=None):
     """Insert a transaction into the database."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                created_at = dt.datetime.now(dt.UTC).isoformat()
+                created_at = dt.datetime.now(dt.UTC)
                 c.execute('''
                     INSERT INTO transactions (user_id, amount, network, status, type, created_at, message_id, address, seed_id)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
                     RETURNING id
                 ''', (user_id, amount, network, status, type, created_at, message_id, address, seed_id))
                 transaction_id = c.fetchone()[0]
+                if status == "confirmed":
+                    bump_user_stats(c, user_id, confirmed_count=1, confirmed_at=created_at)
                 conn.commit()
                 logger.info(f"Inserted transaction for user {user_id}: amount {amount}, network {network}, status {status}, type {type}, seed_id {seed_id}, id {transaction_id}")
                 return transaction_id
@@ -1074,52 +2676,39 @@ def insert_transaction(user_id, amount, network, status, type, message_id, addre
         logger.error(f"Error inserting transaction for user {user_id}: {e}")
         raise
 
+@adb.sync_helper
 def insert_profit(user_id, seed_id, amount, period):
     """Insert a profit record into the database."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 # Check if profit already recorded for this seed today
-                today = datetime.now(pytz.timezone('Asia/Tehran')).date().isoformat()
+                day_start, day_end = tehran_day_bounds()
                 c.execute('''
                     SELECT COUNT(*) FROM profits
                     WHERE user_id = %s AND seed_id = %s AND period = %s
-                    AND DATE(created_at) = %s
-                ''', (user_id, seed_id, period, today))
+                    AND created_at >= %s AND created_at < %s
+                ''', (user_id, seed_id, period, day_start, day_end))
                 if c.fetchone()[0] > 0:
                     logger.warning(f"Profit already recorded for user {user_id}, seed_id {seed_id} today")
                     return
-                created_at = dt.datetime.now(dt.UTC).isoformat()
+                created_at = dt.datetime.now(dt.UTC)
                 c.execute('''
                     INSERT INTO profits (user_id, seed_id, amount, period, created_at)
                     VALUES (%s, %s, %s, %s, %s)
                 ''', (user_id, seed_id, amount, period, created_at))
+                bump_user_stats(c, user_id, seed_profit=amount)
                 conn.commit()
                 logger.info(f"Inserted profit for user {user_id}: seed_id {seed_id}, amount {amount}, period {period}")
     except Exception as e:
         logger.error(f"Error inserting profit for user {user_id}: {e}")
         raise
 
-def update_transaction_status(transaction_id, user_id, message_id, status):
-    """Update transaction status."""
-    try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as c:
-                c.execute('''
-                    UPDATE transactions
-                    SET status = %s
-                    WHERE user_id = %s AND message_id = %s AND status = 'pending'
-                ''', (status, user_id, message_id))
-                conn.commit()
-                logger.info(f"Updated transaction status for user {user_id}, message_id {message_id} to {status}")
-    except Exception as e:
-        logger.error(f"Error updating transaction status for user {user_id}: {e}")
-        raise
-
+@adb.sync_helper
 def get_transaction(transaction_id):
     """Retrieve a transaction including its ID."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
                     SELECT id, user_id, amount, network, status, type, address, seed_id
@@ -1131,10 +2720,11 @@ def get_transaction(transaction_id):
         logger.error(f"Error getting transaction for transaction_id {transaction_id}: {e}")
         return None
 
+@adb.sync_helper
 def get_transaction_history(user_id):
     """Retrieve transaction history for a user."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
                     SELECT t.amount, t.network, t.status, t.type, t.created_at, s.name, s.name_fa
@@ -1151,128 +2741,201 @@ def get_transaction_history(user_id):
         logger.error(f"Error getting transaction history for user {user_id}: {e}")
         return []
 
-def add_referral(referrer_id, referred_id, level):
-    """Add a referral entry."""
+# The referrals table is a closure table: one row per (ancestor referrer_id, descendant
+# referred_id, depth level), so a user's whole upline is a single indexed lookup
+# Attaching a user crosses the new ancestors (the referrer at level 1 plus the referrer's own
+# upline) with the user at level 0 and any downline they already have, so the closure stays
+# complete when a whole subtree joins. The cycle guard walks the referrer's full upline over
+# level 1 rows, since closure rows stop at REFERRAL_MAX_DEPTH
+ADD_REFERRAL_CHAIN_QUERY = '''
+    WITH RECURSIVE upline (user_id) AS (
+        SELECT %(referrer_id)s::BIGINT
+        UNION
+        SELECT r.referrer_id
+        FROM referrals r
+        JOIN upline ON r.referred_id = upline.user_id AND r.level = 1
+    ), ancestors AS (
+        SELECT %(referrer_id)s::BIGINT AS referrer_id, 1 AS level
+        UNION ALL
+        SELECT r.referrer_id, r.level + 1
+        FROM referrals r
+        WHERE r.referred_id = %(referrer_id)s AND r.level < %(max_depth)s
+    ), subtree AS (
+        SELECT %(referred_id)s::BIGINT AS referred_id, 0 AS level
+        UNION ALL
+        SELECT r.referred_id, r.level
+        FROM referrals r
+        WHERE r.referrer_id = %(referred_id)s AND r.level < %(max_depth)s
+    )
+    INSERT INTO referrals (referrer_id, referred_id, level)
+    SELECT a.referrer_id, d.referred_id, a.level + d.level
+    FROM ancestors a
+    CROSS JOIN subtree d
+    WHERE a.level + d.level <= %(max_depth)s
+      AND NOT EXISTS (SELECT 1 FROM referrals WHERE referred_id = %(referred_id)s)
+      AND NOT EXISTS (SELECT 1 FROM upline WHERE user_id = %(referred_id)s)
+'''
+
+@adb.sync_helper
+def add_referral_chain(referrer_id, referred_id):
+    """Attach a user (and any downline they already have) below referrer_id, adding one closure
+    row per ancestor and descendant pair up to REFERRAL_MAX_DEPTH.
+    Returns the number of rows recorded (0 if the user was already referred, or is the
+    referrer or one of the referrer's ancestors)."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                c.execute('''
-                    INSERT INTO referrals (referrer_id, referred_id, level)
-                    VALUES (%s, %s, %s)
-                ''', (referrer_id, referred_id, level))
-                conn.commit()
-                logger.info(f"Added referral: referrer {referrer_id}, referred {referred_id}, level {level}")
+                # قفل کل درخت رفرال تا دو اتصال همزمان (روی یک کاربر یا زیرشاخه‌های هم) ردیف جاافتاده نسازند
+                c.execute("SELECT pg_advisory_xact_lock(hashtext('referrals'))")
+                c.execute(ADD_REFERRAL_CHAIN_QUERY, {
+                    "referrer_id": referrer_id,
+                    "referred_id": referred_id,
+                    "max_depth": REFERRAL_MAX_DEPTH,
+                })
+                rows = c.rowcount
+        if rows:
+            logger.info(f"Added referral chain for user {referred_id} under {referrer_id}: {rows} closure rows")
+        else:
+            logger.info(f"User {referred_id} is already referred or above {referrer_id}, skipping referral processing")
+        return rows
     except Exception as e:
-        logger.error(f"Error adding referral for referrer {referrer_id}: {e}")
+        logger.error(f"Error handling referral for referrer {referrer_id}, referred {referred_id}: {e}")
         raise
 
-def handle_referral(referrer_id, referred_id):
-    """Handle referral processing and insert into referrals table."""
+@adb.sync_helper
+def extend_referral_closure():
+    """Add closure rows missing after REFERRAL_MAX_DEPTH was raised. Returns rows inserted."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                # چک کردن اینکه کاربر جدید قبلاً رفرال شده یا نه
-                c.execute('SELECT id FROM referrals WHERE referred_id = %s', (referred_id,))
-                if c.fetchone():
-                    logger.info(f"User {referred_id} is already referred, skipping referral processing")
-                    return
-                
-                # ثبت رفرال سطح 1
-                logger.info(f"Adding level 1 referral: referrer {referrer_id}, referred {referred_id}")
-                add_referral(referrer_id, referred_id, 1)
-
-                # گرفتن زنجیره رفرال برای ثبت سطح‌های 2 و 3
-                c.execute('SELECT referrer_id FROM referrals WHERE referred_id = %s', (referrer_id,))
-                level_2_referrer = c.fetchone()
-                if level_2_referrer:
-                    level_2_referrer_id = level_2_referrer[0]
-                    logger.info(f"Adding level 2 referral: referrer {level_2_referrer_id}, referred {referred_id}")
-                    add_referral(level_2_referrer_id, referred_id, 2)
-
-                    # چک کردن سطح 3
-                    c.execute('SELECT referrer_id FROM referrals WHERE referred_id = %s', (level_2_referrer_id,))
-                    level_3_referrer = c.fetchone()
-                    if level_3_referrer:
-                        level_3_referrer_id = level_3_referrer[0]
-                        logger.info(f"Adding level 3 referral: referrer {level_3_referrer_id}, referred {referred_id}")
-                        add_referral(level_3_referrer_id, referred_id, 3)
-
-                conn.commit()
-                logger.info(f"Referral processing completed for referred_id {referred_id}")
+                c.execute('''
+                    WITH RECURSIVE chain (referrer_id, referred_id, level) AS (
+                        SELECT referrer_id, referred_id, 1 FROM referrals WHERE level = 1
+                        UNION ALL
+                        SELECT parent.referrer_id, chain.referred_id, chain.level + 1
+                        FROM chain
+                        JOIN referrals parent ON parent.referred_id = chain.referrer_id AND parent.level = 1
+                        WHERE chain.level < %(max_depth)s
+                    )
+                    INSERT INTO referrals (referrer_id, referred_id, level)
+                    SELECT referrer_id, referred_id, level
+                    FROM chain
+                    WHERE level > 1 AND NOT EXISTS (
+                        SELECT 1 FROM referrals r
+                        WHERE r.referred_id = chain.referred_id AND r.level = chain.level
+                    )
+                ''', {"max_depth": REFERRAL_MAX_DEPTH})
+                count = c.rowcount
+        if count:
+            logger.info(f"Extended referral closure with {count} rows (max depth {REFERRAL_MAX_DEPTH})")
+        return count
     except Exception as e:
-        logger.error(f"Error handling referral for referrer {referrer_id}, referred {referred_id}: {e}")
-        raise    
+        logger.error(f"Error extending referral closure: {e}")
+        raise
+
+# Whole referral payout for one approved deposit in a single statement: every level of the
+# chain is credited, recorded in referral_profits and added to user_stats atomically.
+# Ledger entries are keyed 'referral:<transaction>:<level>' and levels that already have one
+# are skipped, so a retried payout for the same deposit pays nothing twice
+REFERRAL_PAYOUT_QUERY = '''
+    WITH payout AS (
+        SELECT r.referrer_id, r.level, round(%(amount)s * rates.rate, 2) AS profit
+        FROM referrals r
+        JOIN unnest(%(levels)s::INTEGER[], %(rates)s::NUMERIC[]) AS rates (level, rate) ON rates.level = r.level
+        WHERE r.referred_id = %(referred_id)s
+          AND NOT EXISTS (
+              SELECT 1 FROM ledger l
+              WHERE l.idempotency_key = 'referral:' || %(transaction_id)s::BIGINT || ':' || r.level
+          )
+    ), credited AS (
+        UPDATE users u
+        SET balance = u.balance + p.profit
+        FROM payout p
+        WHERE u.user_id = p.referrer_id
+        RETURNING u.user_id, u.balance, u.language
+    ), recorded AS (
+        INSERT INTO referral_profits (referrer_id, referred_id, transaction_id, level, profit_amount, created_at)
+        SELECT referrer_id, %(referred_id)s, %(transaction_id)s, level, profit, now() FROM payout
+        RETURNING id, referrer_id, level, profit_amount
+    ), entries AS (
+        INSERT INTO ledger (user_id, entry_type, amount, reference_id, idempotency_key)
+        SELECT r.referrer_id, 'referral', r.profit_amount, r.id,
+               'referral:' || %(transaction_id)s::BIGINT || ':' || r.level
+        FROM recorded r
+        JOIN credited c ON c.user_id = r.referrer_id
+    ), stats AS (
+        INSERT INTO user_stats (user_id, referral_profit)
+        SELECT referrer_id, profit FROM payout
+        ON CONFLICT (user_id) DO UPDATE
+        SET referral_profit = user_stats.referral_profit + EXCLUDED.referral_profit
+    )
+    SELECT p.referrer_id, p.level, p.profit, c.balance, c.language
+    FROM payout p
+    JOIN credited c ON c.user_id = p.referrer_id
+    ORDER BY p.level
+'''
+
+def referral_payout_params(referred_id, transaction_id, amount):
+    return {
+        "referred_id": referred_id,
+        "transaction_id": transaction_id,
+        "amount": amount,
+        "levels": list(REFERRAL_PROFIT_RATES),
+        "rates": list(REFERRAL_PROFIT_RATES.values()),
+    }
+
+def apply_referral_payouts(referred_id, transaction_id, payouts):
+    """Write the referrers' new balances through to the cache and log the payout."""
+    for referrer_id, level, profit, balance, _ in payouts:
+        user_cache.update(referrer_id, balance=balance)
+    if payouts:
+        logger.info(
+            f"Paid referral profits for transaction {transaction_id} of user {referred_id}: "
+            f"{[(referrer_id, level, profit) for referrer_id, level, profit, _, _ in payouts]}"
+        )
 
-def record_referral_profit(referrer_id, referred_id, transaction_id, level, profit_amount):
-    """Record referral profit and send notification to referrer."""
+# (referred_id, username) rows behind the referral menu buttons
+REFERRAL_LIST_QUERY = '''
+    SELECT r.referred_id, u.username
+    FROM referrals r
+    JOIN users u ON r.referred_id = u.user_id
+    WHERE r.referrer_id = %s
+    ORDER BY r.id
+'''
+
+@adb.sync_helper
+def get_referral_list(user_id):
+    """Referrals shown as buttons in the referral menu."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                created_at = dt.datetime.now(dt.UTC).isoformat()
-                c.execute('''
-                    INSERT INTO referral_profits (referrer_id, referred_id, transaction_id, level, profit_amount, created_at)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                ''', (referrer_id, referred_id, transaction_id, level, profit_amount, created_at))
-                conn.commit()
-                logger.info(f"Recorded referral profit: referrer {referrer_id}, referred {referred_id}, profit {profit_amount}, level {level}")
-        
-        # ارسال اعلان به رفرر
-        try:
-            bot = Bot(token=os.getenv("BOT_TOKEN"))
-            user = get_user(referrer_id)
-            lang = user[0] if user else "en"
-            # تابع کمکی برای ارسال پیام به صورت async
-            async def send_notification():
-                await bot.send_message(
-                    chat_id=referrer_id,
-                    text=messages[lang]["referral_profit_notification"](
-                        round(profit_amount, 2), referred_id, level
-                    ),
-                    parse_mode="Markdown"
-                )
-            # اجرای تابع async در یک event loop
-            loop = asyncio.get_event_loop()
-            loop.run_until_complete(send_notification())
-            logger.info(f"Sent referral profit notification to referrer {referrer_id}")
-        except telegram.error.TelegramError as e:
-            logger.error(f"Failed to send referral profit notification to referrer {referrer_id}: {e}")
-        except Exception as e:
-            logger.error(f"Error sending notification to referrer {referrer_id}: {e}")
+                c.execute(REFERRAL_LIST_QUERY, (user_id,))
+                return c.fetchall()
     except Exception as e:
-        logger.error(f"Error recording referral profit for referrer {referrer_id}: {e}")
+        logger.error(f"Error getting referral list for user {user_id}: {e}")
         raise
 
+@adb.sync_helper
 def get_referral_stats(user_id):
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 # تعداد رفرال‌ها در هر سطح
                 c.execute('''
                     SELECT level, COUNT(*) 
                     FROM referrals 
-                    WHERE referrer_id = %s 
+                    WHERE referrer_id = %s AND level <= %s
                     GROUP BY level
-                ''', (user_id,))
-                level_counts = {1: 0, 2: 0, 3: 0}
-                for level, count in c.fetchall():
-                    level_counts[level] = count
+                ''', (user_id, REFERRAL_MAX_DEPTH))
+                level_counts = dict(c.fetchall())
 
                 # کل سود رفرال
-                c.execute('''
-                    SELECT SUM(profit_amount) 
-                    FROM referral_profits 
-                    WHERE referrer_id = %s
-                ''', (user_id,))
-                total_profit = c.fetchone()[0] or 0.0
+                c.execute('SELECT referral_profit FROM user_stats WHERE user_id = %s', (user_id,))
+                row = c.fetchone()
+                total_profit = row[0] if row else MONEY_ZERO
 
                 # گرفتن رفرال‌ها برای نمایش دکمه‌ها
-                c.execute('''
-                    SELECT r.referred_id, u.username 
-                    FROM referrals r
-                    JOIN users u ON r.referred_id = u.user_id
-                    WHERE r.referrer_id = %s
-                    ORDER BY r.id
-                ''', (user_id,))
+                c.execute(REFERRAL_LIST_QUERY, (user_id,))
                 referrals = c.fetchall()
 
                 # گرفتن تراکنش‌های رفرال‌ها
@@ -1287,71 +2950,167 @@ def get_referral_stats(user_id):
                 ''', (user_id,))
                 transactions = c.fetchall()
 
-                return level_counts[1], level_counts[2], level_counts[3], total_profit, transactions, referrals
+                return level_counts, total_profit, transactions, referrals
     except Exception as e:
         logger.error(f"Error getting referral stats for user {user_id}: {e}")
-        return 0, 0, 0, 0.0, [], []
+        return {}, MONEY_ZERO, [], []
+
+REFERRAL_CHAIN_QUERY = '''
+    SELECT referrer_id, level
+    FROM referrals
+    WHERE referred_id = %s AND level <= %s
+    ORDER BY level
+'''
 
+@adb.sync_helper
 def get_referral_chain(user_id):
-    """Get referral chain for a user."""
+    """Get the user's referrers as [(referrer_id, level)], nearest first."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                chain = []
-                current_id = user_id
-                for level in range(1, 4):
-                    c.execute('SELECT referrer_id FROM referrals WHERE referred_id = %s AND level = %s', (current_id, 1))
-                    result = c.fetchone()
-                    if result:
-                        chain.append((result[0], level))
-                        current_id = result[0]
-                    else:
-                        break
+                c.execute(REFERRAL_CHAIN_QUERY, (user_id, REFERRAL_MAX_DEPTH))
+                chain = c.fetchall()
                 logger.info(f"Referral chain for user {user_id}: {chain}")
                 return chain
     except Exception as e:
         logger.error(f"Error getting referral chain for user {user_id}: {e}")
         return []
 
-def has_referrals(user_id):
-    """Check if a user has any referrers."""
-    try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as c:
-                c.execute('SELECT COUNT(*) FROM referrals WHERE referred_id = %s', (user_id,))
-                count = c.fetchone()[0]
-                logger.info(f"User {user_id} has {count} referrers")
-                return count > 0
-    except Exception as e:
-        logger.error(f"Error checking referrals for user {user_id}: {e}")
-        return False
+def tehran_day_bounds(day=None):
+    """Return [start, end) of a Tehran calendar day as aware datetimes, for indexable range filters."""
+    tehran = pytz.timezone('Asia/Tehran')
+    day = day or datetime.now(tehran).date()
+    start = tehran.localize(datetime.combine(day, datetime.min.time()))
+    end = tehran.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return start, end
+
+# Plant/harvest readiness on Tehran calendar days, evaluated in SQL next to the timestamps
+# (a seed can be planted once per day and harvested the day after planting, once per planting)
+SEED_CAN_PLANT_SQL = '''(
+    us.last_planted IS NULL
+    OR (us.last_planted AT TIME ZONE 'Asia/Tehran')::date < (now() AT TIME ZONE 'Asia/Tehran')::date
+)'''
+SEED_CAN_HARVEST_SQL = '''(
+    us.last_planted IS NOT NULL
+    AND (us.last_planted AT TIME ZONE 'Asia/Tehran')::date < (now() AT TIME ZONE 'Asia/Tehran')::date
+    AND (
+        us.last_harvested IS NULL
+        OR (us.last_harvested AT TIME ZONE 'Asia/Tehran')::date < (us.last_planted AT TIME ZONE 'Asia/Tehran')::date
+    )
+)'''
 
+# Seed catalog
+class SeedCatalog:
+    """In-memory copy of the seeds table, indexed by menu position and by seed_id.
+
+    Entries are the SEEDS dicts plus ``seed_id``, ``index`` and the precomputed
+    ``daily_profit`` / ``weekly_profit`` / ``monthly_profit`` / ``total_monthly``.
+    ``load()`` builds a new snapshot and swaps it in whole, so readers never see a
+    half-loaded catalog.
+    """
+
+    def __init__(self):
+        self._menu = []
+        self._by_id = {}
+
+    def load(self):
+        """(Re)load the catalog from the seeds table. Returns the number of seeds."""
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as c:
+                    c.execute('SELECT seed_id, name, name_fa, price, daily_profit_rate FROM seeds ORDER BY seed_id')
+                    rows = c.fetchall()
+        except Exception as e:
+            logger.error(f"Error loading seed catalog: {e}")
+            raise
+        positions = {seed["name"]: idx for idx, seed in enumerate(SEEDS)}
+        by_id = {}
+        on_sale = {}
+        for seed_id, name, name_fa, price, rate in rows:
+            position = positions.get(name)
+            daily_profit = to_money(price * rate)
+            seed = {
+                "seed_id": seed_id,
+                "index": None,
+                "name": name,
+                "name_fa": name_fa,
+                "price": price,
+                "daily_profit_rate": rate,
+                "emoji": SEEDS[position]["emoji"] if position is not None else "🌱",
+                "daily_profit": daily_profit,
+                "weekly_profit": daily_profit * 7,
+                "monthly_profit": daily_profit * 30,
+                "total_monthly": price + daily_profit * 30,
+            }
+            by_id[seed_id] = seed
+            if position is not None:
+                on_sale.setdefault(position, seed)
+        menu = [on_sale[position] for position in sorted(on_sale)]
+        for idx, seed in enumerate(menu):
+            seed["index"] = idx
+        self._menu, self._by_id = menu, by_id
+        keyboards.build_seed_menus()
+        logger.info(f"Loaded seed catalog: {len(by_id)} seeds, {len(menu)} on sale")
+        return len(by_id)
+
+    def __len__(self):
+        return len(self._menu)
+
+    def menu(self):
+        """Seeds on sale, in menu order."""
+        return self._menu
+
+    def by_index(self, idx):
+        menu = self._menu
+        return menu[idx] if 0 <= idx < len(menu) else None
+
+    def by_id(self, seed_id):
+        return self._by_id.get(seed_id)
+
+    def names(self, seed_id):
+        """(name, name_fa) of a seed, with a placeholder for ids missing from the catalog."""
+        seed = self._by_id.get(seed_id)
+        return (seed["name"], seed["name_fa"]) if seed else (f"Seed {seed_id}", f"بذر {seed_id}")
+
+    def user_seed_row(self, row):
+        """Expand (last_planted, last_harvested, user_seed_id, seed_id, can_plant, can_harvest) into
+        the get_user_seeds tuple (name, name_fa, price, daily_profit_rate, *row)."""
+        seed = self._by_id.get(row[3])
+        if seed is None:
+            return self.names(row[3]) + (MONEY_ZERO, Decimal(0)) + tuple(row)
+        return (seed["name"], seed["name_fa"], seed["price"], seed["daily_profit_rate"]) + tuple(row)
+
+seed_catalog = SeedCatalog()
+
+USER_SEEDS_QUERY = f'''
+    SELECT us.last_planted, us.last_harvested, us.id, us.seed_id,
+           {SEED_CAN_PLANT_SQL} AS can_plant, {SEED_CAN_HARVEST_SQL} AS can_harvest
+    FROM user_seeds us
+    WHERE us.user_id = %s
+    ORDER BY us.id
+'''
+
+@adb.sync_helper
 def get_user_seeds(user_id):
     """Retrieve all seeds owned by a user."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                c.execute('''
-                    SELECT s.name, s.name_fa, s.price, s.daily_profit_rate, 
-                           us.last_planted, us.last_harvested, us.id
-                    FROM user_seeds us
-                    JOIN seeds s ON us.seed_id = s.seed_id
-                    WHERE us.user_id = %s
-                ''', (user_id,))
-                return c.fetchall()
+                c.execute(USER_SEEDS_QUERY, (user_id,))
+                return [seed_catalog.user_seed_row(row) for row in c.fetchall()]
     except Exception as e:
         logger.error(f"Error getting seeds for user {user_id}: {e}")
         return []    
 
+@adb.sync_helper
 def get_user_seed(user_id, user_seed_id):
     """Retrieve a specific user seed by user_seed_id."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
-                    SELECT us.seed_id, us.last_planted, us.last_harvested, s.price, s.daily_profit_rate
+                    SELECT us.seed_id, us.last_planted, us.last_harvested
                     FROM user_seeds us
-                    JOIN seeds s ON us.seed_id = s.seed_id
                     WHERE us.id = %s AND us.user_id = %s
                 ''', (user_seed_id, user_id))
                 result = c.fetchone()
@@ -1360,14 +3119,116 @@ def get_user_seed(user_id, user_seed_id):
     except Exception as e:
         logger.error(f"Error getting user seed {user_seed_id} for user {user_id}: {e}")
         return None
-    
-def debug_user_seeds(user_id):
-    """Debug user seeds data for a specific user."""
+
+USER_CONTEXT_QUERY = f'''
+    SELECT u.language, u.balance, u.is_banned,
+           us.last_planted, us.last_harvested, us.id, us.seed_id,
+           {SEED_CAN_PLANT_SQL}, {SEED_CAN_HARVEST_SQL}
+    FROM users u
+    LEFT JOIN user_seeds us ON us.user_id = u.user_id
+    WHERE u.user_id = %s
+    ORDER BY us.id
+'''
+
+def build_request_context(user_id, rows):
+    """Fold USER_CONTEXT_QUERY rows (one per seed) into a RequestContext, or None if the user is missing."""
+    if not rows:
+        return None
+    language, balance, is_banned = rows[0][:3]
+    user_cache.set(user_id, language, balance, is_banned)
+    seeds = [seed_catalog.user_seed_row(row[3:]) for row in rows if row[5] is not None]
+    return RequestContext(user_id, language, balance, bool(is_banned), seeds)
+
+@adb.sync_helper
+def get_user_context(user_id):
+    """Load user row and seeds in one query, creating the user if needed.
+
+    On a profile cache hit no query is made; seeds are then loaded on first use.
+    """
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return RequestContext(user_id, *cached, seeds=None)
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                c.execute('''
-                    SELECT id, seed_id, last_planted, last_harvested
+                c.execute(USER_CONTEXT_QUERY, (user_id,))
+                request = build_request_context(user_id, c.fetchall())
+        if request is None:
+            upsert_user(user_id, language="en")
+            user_cache.set(user_id, "en", MONEY_ZERO)
+            request = RequestContext(user_id, "en", MONEY_ZERO, False, [])
+        return request
+    except Exception as e:
+        logger.error(f"Error loading request context for user {user_id}: {e}")
+        return None
+
+@adb.sync_helper
+def get_user_languages(user_ids):
+    """Return {user_id: language} for the given users in one query."""
+    if not user_ids:
+        return {}
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('SELECT user_id, language FROM users WHERE user_id = ANY(%s)', (list(user_ids),))
+                return {row[0]: row[1] or "en" for row in c.fetchall()}
+    except Exception as e:
+        logger.error(f"Error getting languages for users {user_ids}: {e}")
+        return {}
+
+WALLET_SUMMARY_QUERY = '''
+    SELECT u.balance, u.username, u.created_at, u.is_banned,
+           COALESCE(st.seed_profit, 0), COALESCE(st.referral_profit, 0),
+           COALESCE(st.confirmed_count, 0), st.last_confirmed_at,
+           COALESCE(owned.seed_ids, '{}')
+    FROM users u
+    LEFT JOIN user_stats st ON st.user_id = u.user_id
+    CROSS JOIN LATERAL (
+        SELECT array_agg(us.seed_id ORDER BY us.id) AS seed_ids
+        FROM user_seeds us
+        WHERE us.user_id = u.user_id
+    ) owned
+    WHERE u.user_id = %(user_id)s
+'''
+
+def build_wallet_summary(row):
+    """Turn a WALLET_SUMMARY_QUERY row into the dict used by the wallet screens."""
+    if row is None:
+        return None
+    balance, username, created_at, is_banned, seed_profit, referral_profit, tx_count, last_tx, seed_ids = row
+    return {
+        "balance": balance or MONEY_ZERO,
+        "username": username,
+        "created_at": created_at,
+        "is_banned": bool(is_banned),
+        "seed_profit": seed_profit,
+        "referral_profit": referral_profit,
+        "total_profit": seed_profit + referral_profit,
+        "transaction_count": tx_count,
+        "last_transaction": last_tx,
+        "seeds": [seed_catalog.names(seed_id) for seed_id in seed_ids],
+    }
+
+@adb.sync_helper
+def get_wallet_summary(user_id):
+    """Everything the wallet screen shows, in one query. Returns None if the user does not exist."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(WALLET_SUMMARY_QUERY, {"user_id": user_id})
+                return build_wallet_summary(c.fetchone())
+    except Exception as e:
+        logger.error(f"Error getting wallet summary for user {user_id}: {e}")
+        raise
+
+@adb.sync_helper
+def debug_user_seeds(user_id):
+    """Debug user seeds data for a specific user."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    SELECT id, seed_id, last_planted, last_harvested
                     FROM user_seeds
                     WHERE user_id = %s
                 ''', (user_id,))
@@ -1378,10 +3239,11 @@ def debug_user_seeds(user_id):
         logger.error(f"Error debugging user seeds for user {user_id}: {e}")
         return None
 
+@adb.sync_helper
 def fix_seed_id(user_id, user_seed_id, correct_seed_id):
     """Fix seed_id for a specific user seed."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
                     UPDATE user_seeds
@@ -1393,10 +3255,11 @@ def fix_seed_id(user_id, user_seed_id, correct_seed_id):
     except Exception as e:
         logger.error(f"Error fixing seed_id for user {user_id}, user_seed_id {user_seed_id}: {e}")    
 
+@adb.sync_helper
 def fix_database(user_id):
     """Fix seed_id in user_seeds and remove duplicate profits for a specific user."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 # Fix seed_id in user_seeds (ID: 2 -> seed_id: 2 for tomato, others -> seed_id: 3 for cucumber)
                 c.execute('''
@@ -1413,14 +3276,15 @@ def fix_database(user_id):
                 logger.info(f"Fixed seed_id for user {user_id}")
 
                 # Remove duplicate profits and adjust balance
-                today = datetime.now(pytz.timezone('Asia/Tehran')).date().isoformat()
+                day_start, day_end = tehran_day_bounds()
                 c.execute('''
                     SELECT id, amount FROM profits
-                    WHERE user_id = %s AND DATE(created_at) = %s
+                    WHERE user_id = %s AND created_at >= %s AND created_at < %s
+                    AND user_seed_id IS NULL
                     ORDER BY created_at
-                ''', (user_id, today))
+                ''', (user_id, day_start, day_end))
                 profits = c.fetchall()
-                total_deducted = 0.0
+                total_deducted = MONEY_ZERO
                 valid_profit_ids = []
                 seen_seed_ids = set()
 
@@ -1435,36 +3299,23 @@ def fix_database(user_id):
                         c.execute('DELETE FROM profits WHERE id = %s', (profit_id,))
 
                 if total_deducted > 0:
-                    c.execute('UPDATE users SET balance = balance - %s WHERE user_id = %s', (total_deducted, user_id))
+                    c.execute(BALANCE_CHANGE_QUERY, balance_change_params(user_id, -total_deducted, "correction"))
+                    bump_user_stats(c, user_id, seed_profit=-total_deducted)
                     conn.commit()
+                    user_cache.invalidate(user_id)
                     logger.info(f"Removed duplicate profits for user {user_id}, deducted {total_deducted} from balance")
 
     except Exception as e:
         logger.error(f"Error fixing database for user {user_id}: {e}")
         raise            
 
-def add_user_seed(user_id, seed_id):
-    """Add a seed to a user's collection."""
-    try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as c:
-                created_at = dt.datetime.now(dt.UTC).isoformat()
-                c.execute('''
-                    INSERT INTO user_seeds (user_id, seed_id, purchase_date)
-                    VALUES (%s, %s, %s)
-                ''', (user_id, seed_id, created_at))
-                conn.commit()
-                logger.info(f"Added seed {seed_id} to user {user_id}")
-    except Exception as e:
-        logger.error(f"Error adding seed for user {user_id}: {e}")
-        raise
-
+@adb.sync_helper
 def update_seed_plant(user_id, user_seed_id):
     """Update the last planted date for a seed."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                created_at = dt.datetime.now(dt.UTC).isoformat()
+                created_at = dt.datetime.now(dt.UTC)
                 c.execute('''
                     UPDATE user_seeds
                     SET last_planted = %s
@@ -1476,12 +3327,13 @@ def update_seed_plant(user_id, user_seed_id):
         logger.error(f"Error updating seed plant for user {user_id}: {e}")
         raise
 
+@adb.sync_helper
 def update_seed_harvest(user_id, user_seed_id):
     """Update the last harvested date for a seed."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                created_at = dt.datetime.now(dt.UTC).isoformat()
+                created_at = dt.datetime.now(dt.UTC)
                 c.execute('''
                     UPDATE user_seeds
                     SET last_harvested = %s
@@ -1493,33 +3345,628 @@ def update_seed_harvest(user_id, user_seed_id):
         logger.error(f"Error updating seed harvest for user {user_id}: {e}")
         raise
 
-def can_plant_seed(last_planted):
-    """Check if a seed can be planted today."""
-    if not last_planted:
-        return True
-    last_planted_dt = datetime.fromisoformat(last_planted)
-    today = datetime.now(pytz.timezone('Asia/Tehran')).date()
-    last_planted_date = last_planted_dt.astimezone(pytz.timezone('Asia/Tehran')).date()
-    return last_planted_date < today
-
-def can_harvest_seed(last_planted, last_harvested, seed_id=None):
-    """Check if a seed can be harvested."""
-    if not last_planted:
-        return False
-    last_planted_dt = datetime.fromisoformat(last_planted).astimezone(pytz.timezone('Asia/Tehran'))
-    now = datetime.now(pytz.timezone('Asia/Tehran'))
-    
-    if last_harvested:
-        last_harvested_dt = datetime.fromisoformat(last_harvested).astimezone(pytz.timezone('Asia/Tehran'))
-        if last_harvested_dt.date() >= last_planted_dt.date():
-            return False
-    
-    return now.date() > last_planted_dt.date()
-    return now.date() > last_planted_dt.date()
+# One statement: the guarded UPDATE locks the user_seeds row, so a concurrent double-tap
+# re-checks readiness after the first commit and matches nothing.
+HARVEST_QUERY = f'''
+    WITH harvested AS (
+        UPDATE user_seeds us
+        SET last_harvested = now()
+        FROM seeds s
+        WHERE us.id = %(user_seed_id)s AND us.user_id = %(user_id)s
+          AND s.seed_id = us.seed_id
+          AND {SEED_CAN_HARVEST_SQL}
+        RETURNING us.id, us.user_id, us.seed_id, round(s.price * s.daily_profit_rate, {MONEY_SCALE}) AS amount
+    ), credited AS (
+        UPDATE users u
+        SET balance = u.balance + h.amount
+        FROM harvested h
+        WHERE u.user_id = h.user_id
+        RETURNING u.balance
+    ), profit AS (
+        INSERT INTO profits (user_id, seed_id, user_seed_id, amount, period, created_at)
+        SELECT user_id, seed_id, id, amount, 'daily', now() FROM harvested
+        RETURNING id, user_id, amount
+    ), entries AS (
+        INSERT INTO ledger (user_id, entry_type, amount, reference_id, idempotency_key)
+        SELECT user_id, 'harvest', amount, id, 'profit:' || id FROM profit
+    ), stats AS (
+        INSERT INTO user_stats (user_id, seed_profit)
+        SELECT user_id, amount FROM harvested
+        ON CONFLICT (user_id) DO UPDATE
+        SET seed_profit = user_stats.seed_profit + EXCLUDED.seed_profit
+    )
+    SELECT h.seed_id, h.amount, c.balance
+    FROM harvested h
+    CROSS JOIN credited c
+'''
+
+@adb.sync_helper
+def harvest_seed(user_id, user_seed_id):
+    """Harvest a seed atomically. Returns (seed_id, amount, new_balance), or None if not ready/not owned."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(HARVEST_QUERY, {"user_id": user_id, "user_seed_id": user_seed_id})
+                result = c.fetchone()
+        if result:
+            user_cache.update(user_id, balance=result[2])
+            logger.info(f"User {user_id} harvested seed {user_seed_id}: credited {result[1]}, new balance {result[2]}")
+        return result
+    except Exception as e:
+        logger.error(f"Error harvesting seed {user_seed_id} for user {user_id}: {e}")
+        raise
+
+PLANT_ALL_QUERY = f'''
+    UPDATE user_seeds us
+    SET last_planted = now()
+    WHERE us.user_id = %(user_id)s AND {SEED_CAN_PLANT_SQL}
+    RETURNING us.id
+'''
+
+# Set-based harvest of every ready seed: one UPDATE, one multi-row INSERT, one balance credit
+HARVEST_ALL_QUERY = f'''
+    WITH harvested AS (
+        UPDATE user_seeds us
+        SET last_harvested = now()
+        FROM seeds s
+        WHERE us.user_id = %(user_id)s
+          AND s.seed_id = us.seed_id
+          AND {SEED_CAN_HARVEST_SQL}
+        RETURNING us.id, us.seed_id, round(s.price * s.daily_profit_rate, {MONEY_SCALE}) AS amount
+    ), total AS (
+        SELECT COUNT(*) AS harvested_count, COALESCE(SUM(amount), 0) AS amount FROM harvested
+    ), credited AS (
+        UPDATE users u
+        SET balance = u.balance + t.amount
+        FROM total t
+        WHERE u.user_id = %(user_id)s AND t.harvested_count > 0
+        RETURNING u.balance
+    ), profit AS (
+        INSERT INTO profits (user_id, seed_id, user_seed_id, amount, period, created_at)
+        SELECT %(user_id)s, seed_id, id, amount, 'daily', now() FROM harvested
+        RETURNING id, user_id, amount
+    ), entries AS (
+        INSERT INTO ledger (user_id, entry_type, amount, reference_id, idempotency_key)
+        SELECT user_id, 'harvest', amount, id, 'profit:' || id FROM profit
+    ), stats AS (
+        INSERT INTO user_stats (user_id, seed_profit)
+        SELECT %(user_id)s, amount FROM total WHERE harvested_count > 0
+        ON CONFLICT (user_id) DO UPDATE
+        SET seed_profit = user_stats.seed_profit + EXCLUDED.seed_profit
+    )
+    SELECT t.harvested_count, t.amount, (SELECT balance FROM credited)
+    FROM total t
+'''
+
+@adb.sync_helper
+def plant_all_seeds(user_id):
+    """Plant every seed of the user that can be planted today. Returns how many were planted."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(PLANT_ALL_QUERY, {"user_id": user_id})
+                count = c.rowcount
+                logger.info(f"User {user_id} planted {count} seeds")
+                return count
+    except Exception as e:
+        logger.error(f"Error planting all seeds for user {user_id}: {e}")
+        raise
+
+@adb.sync_helper
+def harvest_all_seeds(user_id):
+    """Harvest every ready seed of the user. Returns (count, amount, new_balance)."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(HARVEST_ALL_QUERY, {"user_id": user_id})
+                result = c.fetchone()
+        if result[0]:
+            user_cache.update(user_id, balance=result[2])
+            logger.info(f"User {user_id} harvested {result[0]} seeds: credited {result[1]}, new balance {result[2]}")
+        return result
+    except Exception as e:
+        logger.error(f"Error harvesting all seeds for user {user_id}: {e}")
+        raise
+
+# Nightly auto-harvest: users who opted in are harvested in user_id-range chunks,
+# each chunk one statement that also advances the run's checkpoint in accrual_runs
+ACCRUAL_CHUNK_SIZE = int(os.getenv("ACCRUAL_CHUNK_SIZE", "500"))
+
+ACCRUAL_CHUNK_BOUND_QUERY = '''
+    SELECT MAX(user_id) FROM (
+        SELECT user_id FROM users
+        WHERE auto_harvest AND user_id > %(low)s
+        ORDER BY user_id
+        LIMIT %(chunk_size)s
+    ) chunk
+'''
+
+ACCRUAL_CHUNK_QUERY = f'''
+    WITH harvested AS (
+        UPDATE user_seeds us
+        SET last_harvested = now()
+        FROM seeds s, users u
+        WHERE us.user_id > %(low)s AND us.user_id <= %(high)s
+          AND u.user_id = us.user_id AND u.auto_harvest AND NOT COALESCE(u.is_banned, FALSE)
+          AND s.seed_id = us.seed_id
+          AND {SEED_CAN_HARVEST_SQL}
+        RETURNING us.id, us.user_id, us.seed_id, round(s.price * s.daily_profit_rate, {MONEY_SCALE}) AS amount
+    ), per_user AS (
+        SELECT user_id, COUNT(*) AS seeds, SUM(amount) AS amount FROM harvested GROUP BY user_id
+    ), credited AS (
+        UPDATE users u
+        SET balance = u.balance + p.amount
+        FROM per_user p
+        WHERE u.user_id = p.user_id
+        RETURNING u.user_id, u.balance
+    ), profit AS (
+        INSERT INTO profits (user_id, seed_id, user_seed_id, amount, period, created_at)
+        SELECT user_id, seed_id, id, amount, 'daily', now() FROM harvested
+        RETURNING id, user_id, amount
+    ), entries AS (
+        INSERT INTO ledger (user_id, entry_type, amount, reference_id, idempotency_key)
+        SELECT user_id, 'auto_harvest', amount, id, 'profit:' || id FROM profit
+    ), stats AS (
+        INSERT INTO user_stats (user_id, seed_profit)
+        SELECT user_id, amount FROM per_user
+        ON CONFLICT (user_id) DO UPDATE
+        SET seed_profit = user_stats.seed_profit + EXCLUDED.seed_profit
+    ), progress AS (
+        UPDATE accrual_runs
+        SET last_user_id = %(high)s,
+            users_processed = users_processed + (SELECT COUNT(*) FROM per_user),
+            seeds_harvested = seeds_harvested + (SELECT COUNT(*) FROM harvested),
+            amount_credited = amount_credited + (SELECT COALESCE(SUM(amount), 0) FROM per_user)
+        WHERE run_date = %(run_date)s
+    )
+    SELECT c.user_id, c.balance, p.seeds, p.amount
+    FROM credited c
+    JOIN per_user p ON p.user_id = c.user_id
+'''
+
+ACCRUAL_RUN_COLUMNS = ("last_user_id", "users_processed", "seeds_harvested", "amount_credited", "started_at", "finished_at")
+
+@adb.sync_helper
+def start_accrual_run(run_date):
+    """Create or resume the accrual run of a Tehran day. Returns its progress row as a dict."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    'INSERT INTO accrual_runs (run_date) VALUES (%s) ON CONFLICT (run_date) DO NOTHING',
+                    (run_date,)
+                )
+                c.execute(f'SELECT {", ".join(ACCRUAL_RUN_COLUMNS)} FROM accrual_runs WHERE run_date = %s', (run_date,))
+                return dict(zip(ACCRUAL_RUN_COLUMNS, c.fetchone()))
+    except Exception as e:
+        logger.error(f"Error starting accrual run for {run_date}: {e}")
+        raise
+
+@adb.sync_helper
+def run_accrual_chunk(run_date, low, chunk_size=ACCRUAL_CHUNK_SIZE):
+    """Auto-harvest the next chunk of opted-in users after user_id `low`.
+    Returns (high, users, seeds, amount), or None when no users are left."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(ACCRUAL_CHUNK_BOUND_QUERY, {"low": low, "chunk_size": chunk_size})
+                high = c.fetchone()[0]
+                if high is None:
+                    return None
+                c.execute(ACCRUAL_CHUNK_QUERY, {"low": low, "high": high, "run_date": run_date})
+                credited = c.fetchall()
+        for credited_user_id, balance, _, _ in credited:
+            user_cache.update(credited_user_id, balance=balance)
+        seeds = sum(row[2] for row in credited)
+        amount = sum((row[3] for row in credited), MONEY_ZERO)
+        return high, len(credited), seeds, amount
+    except Exception as e:
+        logger.error(f"Error running accrual chunk after user {low} for {run_date}: {e}")
+        raise
+
+@adb.sync_helper
+def finish_accrual_run(run_date):
+    """Mark the accrual run of a Tehran day as finished. Returns its final progress row as a dict."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    f'UPDATE accrual_runs SET finished_at = now() WHERE run_date = %s '
+                    f'RETURNING {", ".join(ACCRUAL_RUN_COLUMNS)}',
+                    (run_date,)
+                )
+                return dict(zip(ACCRUAL_RUN_COLUMNS, c.fetchone()))
+    except Exception as e:
+        logger.error(f"Error finishing accrual run for {run_date}: {e}")
+        raise
+
+@adb.sync_helper
+def toggle_auto_harvest(user_id):
+    """Flip the user's auto-harvest opt-in. Returns the new setting."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    'UPDATE users SET auto_harvest = NOT auto_harvest WHERE user_id = %s RETURNING auto_harvest',
+                    (user_id,)
+                )
+                row = c.fetchone()
+        enabled = bool(row and row[0])
+        logger.info(f"User {user_id} set auto-harvest to {enabled}")
+        return enabled
+    except Exception as e:
+        logger.error(f"Error toggling auto-harvest for user {user_id}: {e}")
+        raise
+
+# Broadcasts
+BROADCAST_FETCH_SIZE = int(os.getenv("BROADCAST_FETCH_SIZE", "1000"))
+BROADCAST_WINDOW = int(os.getenv("BROADCAST_WINDOW", "100"))  # messages handed to the dispatcher at once
+BROADCAST_FLUSH_SIZE = int(os.getenv("BROADCAST_FLUSH_SIZE", "500"))
+BROADCAST_OUTCOMES = ("delivered", "blocked", "deleted", "failed")
+BROADCAST_COLUMNS = ("id", "total", "delivered", "blocked", "deleted", "failed", "created_at", "finished_at")
+
+@adb.sync_helper
+def get_broadcast_recipients(broadcast_id, after_user_id, limit=BROADCAST_FETCH_SIZE):
+    """Next batch of recipients above after_user_id (keyset pagination on a short checkout)."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    SELECT u.user_id
+                    FROM users u
+                    WHERE u.user_id > %(after)s
+                      AND NOT COALESCE(u.is_banned, FALSE)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM broadcast_deliveries d
+                          WHERE d.broadcast_id = %(broadcast_id)s AND d.user_id = u.user_id
+                      )
+                    ORDER BY u.user_id
+                    LIMIT %(limit)s
+                ''', {"after": after_user_id, "broadcast_id": broadcast_id, "limit": limit})
+                return [row[0] for row in c.fetchall()]
+    except Exception as e:
+        logger.error(f"Error fetching recipients of broadcast {broadcast_id} after user {after_user_id}: {e}")
+        raise
+
+@adb.sync_helper
+def create_broadcast(text, created_by):
+    """Create a broadcast to every non-banned user. Returns (broadcast_id, total)."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    INSERT INTO broadcasts (text, created_by, total)
+                    SELECT %s, %s, COUNT(*) FROM users WHERE NOT COALESCE(is_banned, FALSE)
+                    RETURNING id, total
+                ''', (text, created_by))
+                broadcast_id, total = c.fetchone()
+                logger.info(f"Created broadcast {broadcast_id} for {total} users")
+                return broadcast_id, total
+    except Exception as e:
+        logger.error(f"Error creating broadcast: {e}")
+        raise
+
+@adb.sync_helper
+def get_unfinished_broadcasts():
+    """Return (id, text, created_by, last_user_id) of broadcasts interrupted before finishing."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    SELECT id, text, created_by, last_user_id
+                    FROM broadcasts
+                    WHERE finished_at IS NULL
+                    ORDER BY id
+                ''')
+                return c.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting unfinished broadcasts: {e}")
+        raise
+
+@adb.sync_helper
+def record_broadcast_outcomes(broadcast_id, outcomes, last_user_id):
+    """Store per-user outcomes [(user_id, status, error)] and advance the resume point."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                inserted = psycopg2.extras.execute_values(c, '''
+                    INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, error)
+                    VALUES %s
+                    ON CONFLICT (broadcast_id, user_id) DO NOTHING
+                    RETURNING status
+                ''', [(broadcast_id, *outcome) for outcome in outcomes], fetch=True) if outcomes else []
+                counts = {status: 0 for status in BROADCAST_OUTCOMES}
+                for (status,) in inserted:
+                    counts[status] += 1
+                c.execute('''
+                    UPDATE broadcasts
+                    SET last_user_id = GREATEST(last_user_id, %(last_user_id)s),
+                        delivered = delivered + %(delivered)s,
+                        blocked = blocked + %(blocked)s,
+                        deleted = deleted + %(deleted)s,
+                        failed = failed + %(failed)s
+                    WHERE id = %(broadcast_id)s
+                ''', {"broadcast_id": broadcast_id, "last_user_id": last_user_id, **counts})
+    except Exception as e:
+        logger.error(f"Error recording outcomes for broadcast {broadcast_id}: {e}")
+        raise
+
+@adb.sync_helper
+def finish_broadcast(broadcast_id):
+    """Mark a broadcast finished. Returns its final counters as a dict."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    f'UPDATE broadcasts SET finished_at = now() WHERE id = %s RETURNING {", ".join(BROADCAST_COLUMNS)}',
+                    (broadcast_id,)
+                )
+                return dict(zip(BROADCAST_COLUMNS, c.fetchone()))
+    except Exception as e:
+        logger.error(f"Error finishing broadcast {broadcast_id}: {e}")
+        raise
+
+@adb.sync_helper
+def get_recent_broadcasts(limit=5):
+    """Return the counters of the latest broadcasts as dicts, newest first."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    f'SELECT {", ".join(BROADCAST_COLUMNS)} FROM broadcasts ORDER BY id DESC LIMIT %s',
+                    (limit,)
+                )
+                return [dict(zip(BROADCAST_COLUMNS, row)) for row in c.fetchall()]
+    except Exception as e:
+        logger.error(f"Error getting recent broadcasts: {e}")
+        raise
+
+# Native async database helpers (hot read paths)
+@adb.native("get_user")
+async def get_user_async(user_id):
+    """Awaitable get_user running on the async pool."""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached_user_profile(user_id, cached)
+    try:
+        async with async_db.cursor() as c:
+            await c.execute('SELECT language, balance, is_banned FROM users WHERE user_id = %s', (user_id,))
+            user = c.fetchone()
+        if user:
+            user_cache.set(user_id, *user)
+            if user[2]:
+                logger.warning(f"User {user_id} is banned")
+                return None
+            return user[:2]
+        await upsert_user_async(user_id, language="en")
+        user_cache.set(user_id, "en", MONEY_ZERO)
+        return ("en", MONEY_ZERO)
+    except Exception as e:
+        logger.error(f"Error getting user {user_id}: {e}")
+        return None
+
+@adb.native("upsert_user")
+async def upsert_user_async(user_id, language='en', username=None, referred_by=None):
+    """Awaitable upsert_user running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            created_at = datetime.now(pytz.timezone('Asia/Tehran'))
+            await c.execute('''
+                INSERT INTO users (user_id, language, balance, username, created_at)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (user_id) DO UPDATE
+                SET language = %s, username = %s
+            ''', (user_id, language, 0.0, username, created_at, language, username))
+        user_cache.update(user_id, language=language)
+        logger.info(f"Upserted user {user_id} with language {language}, username {username}")
+    except Exception as e:
+        logger.error(f"Error upserting user {user_id}: {e}")
+        raise
+
+@adb.native("get_user_seeds")
+async def get_user_seeds_async(user_id):
+    """Awaitable get_user_seeds running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute(USER_SEEDS_QUERY, (user_id,))
+            return [seed_catalog.user_seed_row(row) for row in c.fetchall()]
+    except Exception as e:
+        logger.error(f"Error getting seeds for user {user_id}: {e}")
+        return []
+
+@adb.native("get_user_seed")
+async def get_user_seed_async(user_id, user_seed_id):
+    """Awaitable get_user_seed running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute('''
+                SELECT us.seed_id, us.last_planted, us.last_harvested
+                FROM user_seeds us
+                WHERE us.id = %s AND us.user_id = %s
+            ''', (user_seed_id, user_id))
+            result = c.fetchone()
+            logger.info(f"Retrieved seed for user {user_id}, user_seed_id {user_seed_id}: {result}")
+            return result
+    except Exception as e:
+        logger.error(f"Error getting user seed {user_seed_id} for user {user_id}: {e}")
+        return None
+
+@adb.native("get_user_context")
+async def get_user_context_async(user_id):
+    """Awaitable get_user_context running on the async pool."""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return RequestContext(user_id, *cached, seeds=None)
+    try:
+        async with async_db.cursor() as c:
+            await c.execute(USER_CONTEXT_QUERY, (user_id,))
+            request = build_request_context(user_id, c.fetchall())
+        if request is None:
+            await upsert_user_async(user_id, language="en")
+            user_cache.set(user_id, "en", MONEY_ZERO)
+            request = RequestContext(user_id, "en", MONEY_ZERO, False, [])
+        return request
+    except Exception as e:
+        logger.error(f"Error loading request context for user {user_id}: {e}")
+        return None
+
+@adb.native("get_user_languages")
+async def get_user_languages_async(user_ids):
+    """Awaitable get_user_languages running on the async pool."""
+    if not user_ids:
+        return {}
+    try:
+        async with async_db.cursor() as c:
+            await c.execute('SELECT user_id, language FROM users WHERE user_id = ANY(%s)', (list(user_ids),))
+            return {row[0]: row[1] or "en" for row in c.fetchall()}
+    except Exception as e:
+        logger.error(f"Error getting languages for users {user_ids}: {e}")
+        return {}
+
+@adb.native("get_wallet_summary")
+async def get_wallet_summary_async(user_id):
+    """Awaitable get_wallet_summary running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute(WALLET_SUMMARY_QUERY, {"user_id": user_id})
+            return build_wallet_summary(c.fetchone())
+    except Exception as e:
+        logger.error(f"Error getting wallet summary for user {user_id}: {e}")
+        raise
+
+@adb.native("harvest_seed")
+async def harvest_seed_async(user_id, user_seed_id):
+    """Awaitable harvest_seed running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute(HARVEST_QUERY, {"user_id": user_id, "user_seed_id": user_seed_id})
+            result = c.fetchone()
+        if result:
+            user_cache.update(user_id, balance=result[2])
+            logger.info(f"User {user_id} harvested seed {user_seed_id}: credited {result[1]}, new balance {result[2]}")
+        return result
+    except Exception as e:
+        logger.error(f"Error harvesting seed {user_seed_id} for user {user_id}: {e}")
+        raise
+
+@adb.native("plant_all_seeds")
+async def plant_all_seeds_async(user_id):
+    """Awaitable plant_all_seeds running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute(PLANT_ALL_QUERY, {"user_id": user_id})
+            count = c.rowcount
+        logger.info(f"User {user_id} planted {count} seeds")
+        return count
+    except Exception as e:
+        logger.error(f"Error planting all seeds for user {user_id}: {e}")
+        raise
+
+@adb.native("harvest_all_seeds")
+async def harvest_all_seeds_async(user_id):
+    """Awaitable harvest_all_seeds running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute(HARVEST_ALL_QUERY, {"user_id": user_id})
+            result = c.fetchone()
+        if result[0]:
+            user_cache.update(user_id, balance=result[2])
+            logger.info(f"User {user_id} harvested {result[0]} seeds: credited {result[1]}, new balance {result[2]}")
+        return result
+    except Exception as e:
+        logger.error(f"Error harvesting all seeds for user {user_id}: {e}")
+        raise
+
+@adb.native("get_transaction")
+async def get_transaction_async(transaction_id):
+    """Awaitable get_transaction running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute('''
+                SELECT id, user_id, amount, network, status, type, address, seed_id
+                FROM transactions
+                WHERE id = %s AND status = 'pending'
+            ''', (transaction_id,))
+            return c.fetchone()
+    except Exception as e:
+        logger.error(f"Error getting transaction for transaction_id {transaction_id}: {e}")
+        return None
+
+@adb.native("get_transaction_history")
+async def get_transaction_history_async(user_id):
+    """Awaitable get_transaction_history running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute('''
+                SELECT t.amount, t.network, t.status, t.type, t.created_at, s.name, s.name_fa
+                FROM transactions t
+                LEFT JOIN seeds s ON t.seed_id = s.seed_id
+                WHERE t.user_id = %s
+                ORDER BY t.created_at DESC
+                LIMIT 10
+            ''', (user_id,))
+            transactions = c.fetchall()
+            logger.info(f"Retrieved {len(transactions)} transactions for user {user_id}")
+            return transactions
+    except Exception as e:
+        logger.error(f"Error getting transaction history for user {user_id}: {e}")
+        return []
+
+@adb.native("get_referral_stats")
+async def get_referral_stats_async(user_id):
+    """Awaitable get_referral_stats running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute('''
+                SELECT level, COUNT(*)
+                FROM referrals
+                WHERE referrer_id = %s AND level <= %s
+                GROUP BY level
+            ''', (user_id, REFERRAL_MAX_DEPTH))
+            level_counts = dict(c.fetchall())
+
+            await c.execute('SELECT referral_profit FROM user_stats WHERE user_id = %s', (user_id,))
+            row = c.fetchone()
+            total_profit = row[0] if row else MONEY_ZERO
+
+            await c.execute(REFERRAL_LIST_QUERY, (user_id,))
+            referrals = c.fetchall()
+
+            await c.execute('''
+                SELECT t.amount, t.network, t.status, t.type, t.created_at, r.level, s.name, s.name_fa
+                FROM transactions t
+                JOIN referrals r ON t.user_id = r.referred_id
+                LEFT JOIN seeds s ON t.seed_id = s.seed_id
+                WHERE r.referrer_id = %s AND t.type = 'deposit' AND t.status = 'confirmed'
+                ORDER BY t.created_at DESC
+                LIMIT 10
+            ''', (user_id,))
+            transactions = c.fetchall()
+
+            return level_counts, total_profit, transactions, referrals
+    except Exception as e:
+        logger.error(f"Error getting referral stats for user {user_id}: {e}")
+        return {}, MONEY_ZERO, [], []
+
+@adb.native("get_referral_chain")
+async def get_referral_chain_async(user_id):
+    """Awaitable get_referral_chain running on the async pool."""
+    try:
+        async with async_db.cursor() as c:
+            await c.execute(REFERRAL_CHAIN_QUERY, (user_id, REFERRAL_MAX_DEPTH))
+            chain = c.fetchall()
+            logger.info(f"Referral chain for user {user_id}: {chain}")
+            return chain
+    except Exception as e:
+        logger.error(f"Error getting referral chain for user {user_id}: {e}")
+        return []
 
 # Menu generation
-def get_main_menu(lang, user_id=None):
-    """🌾 Generate main menu keyboard with enhanced visuals."""
+BACK_LABELS = {"fa": "🔙 بازگشت", "en": "🔙 Back"}
+PAGER_LABELS = {"fa": ("⬅️ قبلی", "بعدی ➡️"), "en": ("⬅️ Previous", "Next ➡️")}
+
+def _build_main_menu(lang, is_admin):
+    """🌾 Main menu keyboard; the admin variant adds the manage users row."""
     keyboard = [
         [
             InlineKeyboardButton("🏞️ خرید زمین" if lang == "fa" else "🏞️ Buy Land", callback_data="buy_seed"),
@@ -1534,17 +3981,16 @@ def get_main_menu(lang, user_id=None):
         ]
     ]
     # اضافه کردن دکمه مدیریت کاربران فقط برای ادمین
-    if user_id == DEFAULT_ADMIN_ID:
+    if is_admin:
         keyboard.append(
             [
                 InlineKeyboardButton("👤 مدیریت کاربران" if lang == "fa" else "👤 Manage Users", callback_data="manage_users")
             ]
         )
-    return InlineKeyboardMarkup(keyboard)
+    return keyboard
 
-def get_wallet_menu(lang, balance, has_seeds):
-    """Generate wallet menu keyboard."""
-    buttons = [
+def _build_wallet_menu(lang):
+    return [
         [
             InlineKeyboardButton("🌱 کاشت بذر" if lang == "fa" else "🌱 Plant Seed", callback_data="plant_seed"),
             InlineKeyboardButton("🚜 برداشت سود" if lang == "fa" else "🚜 Harvest Profit", callback_data="harvest_seed")
@@ -1554,30 +4000,293 @@ def get_wallet_menu(lang, balance, has_seeds):
             InlineKeyboardButton("📜 تاریخچه" if lang == "fa" else "📜 History", callback_data="history")
         ],
         [
-            InlineKeyboardButton("💸 برداشت" if lang == "fa" else "💸 Withdraw", callback_data="withdraw")
+            InlineKeyboardButton("💸 برداشت" if lang == "fa" else "💸 Withdraw", callback_data="withdraw"),
+            InlineKeyboardButton(messages[lang]["auto_harvest"], callback_data="auto_harvest")
         ]
     ]
-    buttons.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")])
-    return InlineKeyboardMarkup(buttons)
-
-def get_referral_menu(lang, referrals):
-    buttons = [
-        [InlineKeyboardButton(f"👤 @{ref[1] or 'Unknown'}", callback_data=f"referral_{ref[0]}")]
-        for ref in referrals
-    ]
-    buttons.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")])
-    return InlineKeyboardMarkup(buttons)
 
-def get_language_menu(lang):
-    """Generate language selection keyboard."""
-    return InlineKeyboardMarkup([
+def _build_language_menu(lang):
+    return [
         [
             InlineKeyboardButton("فارسی 🇮🇷", callback_data="lang_fa"),
             InlineKeyboardButton("English 🇬🇧", callback_data="lang_en")
-        ],
-        [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
+        ]
+    ]
+
+def _build_manage_users_menu(lang):
+    return [
+        [InlineKeyboardButton("👥 مشاهده کاربران" if lang == "fa" else "👥 View Users", callback_data="view_users")],
+        [InlineKeyboardButton(messages[lang]["ban_user"], callback_data="ban_user")],
+        [InlineKeyboardButton(messages[lang]["manage_seeds"], callback_data="manage_seeds")],
+        [InlineKeyboardButton(messages[lang]["manage_balance"], callback_data="manage_balance")]
+    ]
+
+def _build_seed_action_menu(lang):
+    return [
+        [InlineKeyboardButton(messages[lang]["add_seed"], callback_data="add_seed")],
+        [InlineKeyboardButton(messages[lang]["remove_seed"], callback_data="remove_seed")]
+    ]
+
+def _build_balance_action_menu(lang):
+    return [
+        [InlineKeyboardButton(messages[lang]["add_balance"], callback_data="add_balance")],
+        [InlineKeyboardButton(messages[lang]["subtract_balance"], callback_data="subtract_balance")]
+    ]
+
+def _build_network_menu(prefix):
+    return lambda lang: [
+        [InlineKeyboardButton("TRC20", callback_data=f"{prefix}TRC20")],
+        [InlineKeyboardButton("BEP20", callback_data=f"{prefix}BEP20")]
+    ]
+
+def _build_purchase_menu(lang, can_pay_with_balance):
+    keyboard = [
+        [InlineKeyboardButton("💸 پرداخت با واریز" if lang == "fa" else "💸 Pay with Deposit", callback_data="confirm_seed_purchase")]
+    ]
+    if can_pay_with_balance:
+        keyboard.insert(0, [InlineKeyboardButton("💰 پرداخت با موجودی" if lang == "fa" else "💰 Pay with Balance", callback_data="balance_purchase")])
+    return keyboard
+
+def _build_confirm_menu(callback_data):
+    return lambda lang: [
+        [InlineKeyboardButton("✅ تأیید" if lang == "fa" else "✅ Confirm", callback_data=callback_data)]
+    ]
+
+def _build_seed_menu(lang):
+    """🌱 Seed selection keyboard with emojis, in catalog order."""
+    return [
+        [InlineKeyboardButton(f"{seed['emoji']} {seed['name_fa' if lang == 'fa' else 'name']}", callback_data=f"seed_{idx}")]
+        for idx, seed in enumerate(seed_catalog.menu())
+    ]
+
+def _build_admin_seed_menu(lang):
+    return [
+        [InlineKeyboardButton(seed["name_fa" if lang == "fa" else "name"] + f" {seed['emoji']}", callback_data=f"add_seed_{idx}")]
+        for idx, seed in enumerate(seed_catalog.menu())
+    ]
+
+class KeyboardRegistry:
+    """Inline keyboards built once and shared by every update.
+
+    Telegram objects are frozen after construction, so one markup per
+    (menu, lang, flags) can be handed to any number of replies. Static menus
+    are built at import; the seed menus are rebuilt from seed_catalog on
+    every catalog load. Dynamic lists go through build(), which only creates
+    the per-row buttons and reuses the cached head and back rows.
+    """
+
+    # name -> (builder(lang, *flags), back target or None, flag combinations)
+    MENUS = {
+        "main": (_build_main_menu, None, ((False,), (True,))),
+        "wallet": (_build_wallet_menu, "back_to_menu", ((),)),
+        "language": (_build_language_menu, "back_to_menu", ((),)),
+        "manage_users": (_build_manage_users_menu, "back_to_menu", ((),)),
+        "seed_action": (_build_seed_action_menu, "manage_users", ((),)),
+        "balance_action": (_build_balance_action_menu, "manage_users", ((),)),
+        "deposit_network": (_build_network_menu("network_"), "back_to_menu", ((),)),
+        "withdraw_network": (_build_network_menu("withdraw_network_"), "wallet", ((),)),
+        "purchase": (_build_purchase_menu, "back_to_menu", ((False,), (True,))),
+        "confirm_balance_purchase": (_build_confirm_menu("confirm_balance_purchase"), "back_to_menu", ((),)),
+        "confirm_ban": (_build_confirm_menu("confirm_ban"), "manage_users", ((),)),
+    }
+    SEED_MENUS = {
+        "seeds": (_build_seed_menu, "back_to_menu", ((),)),
+        "admin_seeds": (_build_admin_seed_menu, "manage_users", ((),)),
+    }
+    BACK_TARGETS = ("back_to_menu", "wallet", "manage_users", "view_users")
+
+    def __init__(self):
+        self._rows = {}
+        self._markups = {}
+
+    def _build_menus(self, menus):
+        markups = {}
+        for name, (builder, back, flag_sets) in menus.items():
+            for lang in messages:
+                for flags in flag_sets:
+                    rows = [tuple(row) for row in builder(lang, *flags)]
+                    if back:
+                        rows.append(self._rows[("back", lang, back)])
+                    markups[(name, lang, flags)] = InlineKeyboardMarkup(tuple(rows))
+        return markups
+
+    def build_static(self):
+        """Build the back rows, shared head rows and every static menu."""
+        rows = {}
+        for lang in messages:
+            for target in self.BACK_TARGETS:
+                rows[("back", lang, target)] = (InlineKeyboardButton(BACK_LABELS[lang], callback_data=target),)
+            for action in ("plant_all", "harvest_all"):
+                rows[(action, lang)] = (InlineKeyboardButton(messages[lang][action], callback_data=action),)
+        self._rows = rows
+        markups = dict(self._markups)
+        markups.update(self._build_menus(self.MENUS))
+        markups.update(self._build_menus(self.SEED_MENUS))
+        for lang in messages:
+            for target in self.BACK_TARGETS:
+                markups[("back", lang, (target,))] = InlineKeyboardMarkup((rows[("back", lang, target)],))
+        self._markups = markups
+        logger.info(f"Built {len(markups)} static keyboards")
+
+    def build_seed_menus(self):
+        """Rebuild the catalog-driven menus; swapped in as a whole like the catalog."""
+        markups = dict(self._markups)
+        markups.update(self._build_menus(self.SEED_MENUS))
+        self._markups = markups
+
+    def get(self, name, lang, *flags):
+        return self._markups[(name, lang, flags)]
+
+    def back(self, lang, target="back_to_menu"):
+        """Markup holding only the back button to target."""
+        return self._markups[("back", lang, (target,))]
+
+    def head(self, name, lang):
+        """Cached single-button row such as plant_all/harvest_all."""
+        return self._rows[(name, lang)]
+
+    def build(self, lang, rows, back="back_to_menu", head=None):
+        """Dynamic keyboard: head row (if any), one row per item, cached back row."""
+        keyboard = [head] if head else []
+        keyboard.extend(rows)
+        if back:
+            keyboard.append(self._rows[("back", lang, back)])
+        return InlineKeyboardMarkup(keyboard)
+
+    def pager(self, lang, page, total_pages, prefix="page_"):
+        """Previous/next navigation row for paged lists, or None on a single page."""
+        previous_label, next_label = PAGER_LABELS[lang]
+        buttons = []
+        if page > 1:
+            buttons.append(InlineKeyboardButton(previous_label, callback_data=f"{prefix}{page-1}"))
+        if page < total_pages:
+            buttons.append(InlineKeyboardButton(next_label, callback_data=f"{prefix}{page+1}"))
+        return buttons or None
+
+keyboards = KeyboardRegistry()
+keyboards.build_static()
+
+def get_main_menu(lang, user_id=None):
+    """🌾 Main menu keyboard with enhanced visuals."""
+    return keyboards.get("main", lang, user_id == DEFAULT_ADMIN_ID)
+
+def get_wallet_menu(lang, balance, has_seeds):
+    """Wallet menu keyboard."""
+    return keyboards.get("wallet", lang)
+
+async def reply_wallet_summary(message, user_id, lang):
+    """Send the wallet screen for user_id in reply to message."""
+    try:
+        summary = await adb.get_wallet_summary(user_id)
+    except psycopg2.Error as e:
+        logger.error(f"Database error retrieving wallet stats for user {user_id}: {e}")
+        await message.reply_text(
+            messages[lang]["db_error"],
+            parse_mode="Markdown",
+            reply_markup=get_main_menu(lang)
+        )
+        return ConversationHandler.END
+    balance = summary["balance"] if summary else MONEY_ZERO
+    seeds = [name_fa if lang == "fa" else name for name, name_fa in summary["seeds"]] if summary else []
+    seeds_text = ", ".join(seeds) if seeds else None
+    await message.reply_text(
+        messages[lang]["wallet_balance"](
+            balance,
+            seeds_text,
+            summary["total_profit"] if summary else MONEY_ZERO,
+            summary["transaction_count"] if summary else 0,
+            summary["last_transaction"] if summary else None,
+        ),
+        parse_mode="Markdown",
+        reply_markup=get_wallet_menu(lang, balance, bool(seeds))
+    )
+    return ConversationHandler.END
+
+def get_referral_menu(lang, referrals):
+    return keyboards.build(lang, [
+        [InlineKeyboardButton(f"👤 @{ref[1] or 'Unknown'}", callback_data=f"referral_{ref[0]}")]
+        for ref in referrals
     ])
 
+def get_language_menu(lang):
+    """Language selection keyboard."""
+    return keyboards.get("language", lang)
+
+
+# Per-update request context
+class RequestContext:
+    """User row and seeds loaded once per update, shared by every handler for that update.
+
+    Seed tuples have the get_user_seeds shape: (name, name_fa, price, daily_profit_rate,
+    last_planted, last_harvested, user_seed_id, seed_id, can_plant, can_harvest).
+    ``seeds`` is None when the profile came from the user cache; get_context_seeds fills it in.
+    """
+
+    __slots__ = ("user_id", "language", "balance", "is_banned", "seeds", "__weakref__")
+
+    def __init__(self, user_id, language, balance, is_banned, seeds):
+        self.user_id = user_id
+        self.language = language or "en"
+        self.balance = balance
+        self.is_banned = is_banned
+        self.seeds = seeds
+
+    def profile(self):
+        """Return (language, balance) like get_user, or None for banned users."""
+        if self.is_banned:
+            return None
+        return (self.language, self.balance)
+
+# Request contexts of updates currently being processed, so error handlers (which get a fresh
+# CallbackContext) can reuse them. Entries vanish once the handler context is released.
+_active_requests = weakref.WeakValueDictionary()
+
+class BotContext(CallbackContext):
+    """CallbackContext carrying the RequestContext loaded by load_request_context."""
+
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.request = None
+
+    @classmethod
+    def from_error(cls, update, error, application, job=None, coroutine=None):
+        context = super().from_error(update, error, application, job=job, coroutine=coroutine)
+        if isinstance(update, Update):
+            context.request = _active_requests.get(update.update_id)
+        return context
+
+async def load_request_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pre-handler (group -1): load the sender's user row and seeds once for this update."""
+    user = update.effective_user
+    if not user:
+        return
+    request = await adb.get_user_context(user.id)
+    if request is not None:
+        context.request = request
+        _active_requests[update.update_id] = request
+
+def get_request(context, user_id):
+    """Return the update's RequestContext if it was loaded for user_id."""
+    request = getattr(context, "request", None)
+    if request is not None and request.user_id == user_id:
+        return request
+    return None
+
+async def get_context_user(context, user_id):
+    """get_user that reuses the per-update request context when it belongs to user_id."""
+    request = get_request(context, user_id)
+    if request is not None:
+        return request.profile()
+    return await adb.get_user(user_id)
+
+async def get_context_seeds(context, user_id):
+    """get_user_seeds that reuses the per-update request context when it belongs to user_id."""
+    request = get_request(context, user_id)
+    if request is None:
+        return await adb.get_user_seeds(user_id)
+    if request.seeds is None:
+        request.seeds = await adb.get_user_seeds(user_id)
+    return request.seeds
 
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1585,7 +4294,7 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}")
     if update and update.effective_user:
         user_id = update.effective_user.id
-        user = get_user(user_id)
+        user = await get_context_user(context, user_id)
         lang = user[0] if user else "en"
         try:
             await update.effective_message.reply_text(
@@ -1597,6 +4306,18 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Error sending error message to user {user_id}: {e}")
 
 # Test handlers
+@adb.sync_helper
+def count_seeds():
+    """Number of rows in the seeds table (used by /dbtest)."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('SELECT COUNT(*) FROM seeds')
+                return c.fetchone()[0]
+    except Exception as e:
+        logger.error(f"Error counting seeds: {e}")
+        raise
+
 async def db_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Test database connection and seeds table."""
     user_id = update.effective_user.id
@@ -1608,20 +4329,17 @@ async def db_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as c:
-                c.execute('SELECT COUNT(*) FROM seeds')
-                seed_count = c.fetchone()[0]
-                if seed_count > 0:
-                    await update.message.reply_text(
-                        messages["en"]["db_test_success"].format(seed_count),
-                        parse_mode="Markdown"
-                    )
-                else:
-                    await update.message.reply_text(
-                        messages["en"]["db_test_failed"].format("Seeds table is empty"),
-                        parse_mode="Markdown"
-                    )
+        seed_count = await adb.count_seeds()
+        if seed_count > 0:
+            await update.message.reply_text(
+                messages["en"]["db_test_success"].format(seed_count),
+                parse_mode="Markdown"
+            )
+        else:
+            await update.message.reply_text(
+                messages["en"]["db_test_failed"].format("Seeds table is empty"),
+                parse_mode="Markdown"
+            )
     except Exception as e:
         logger.error(f"Database test failed: {e}")
         await update.message.reply_text(
@@ -1667,7 +4385,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         context.user_data.clear()
         referred_by = None
-        if args and args[0].startswith("ref_"):
+        if args and args[0].startswith(REFERRAL_START_PREFIX):
             try:
                 referred_by = int(args[0].split("_")[1])
                 if referred_by == user_id:
@@ -1679,40 +4397,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.warning(f"Invalid referral code for user {user_id}: {args[0]}")
         
         # ثبت یا به‌روزرسانی کاربر
-        user = get_user(user_id)
+        user = await get_context_user(context, user_id)
         lang = user[0] if user else "en"
-        upsert_user(user_id, language=lang, username=username)
+        await adb.upsert_user(user_id, language=lang, username=username)
         logger.info(f"User {user_id} upserted with language {lang}, username {username}")
 
         # پردازش رفرال
         if referred_by:
-            with psycopg2.connect(DATABASE_URL) as conn:
-                with conn.cursor() as c:
-                    # چک کردن اینکه کاربر قبلاً رفرال شده یا نه
-                    c.execute('SELECT id FROM referrals WHERE referred_id = %s', (user_id,))
-                    if c.fetchone():
-                        logger.info(f"User {user_id} is already referred, skipping referral processing")
-                    else:
-                        # ثبت رفرال سطح 1
-                        logger.info(f"Adding level 1 referral: referrer {referred_by}, referred {user_id}")
-                        add_referral(referred_by, user_id, 1)
-
-                        # ثبت رفرال‌های سطح 2 و 3
-                        c.execute('SELECT referrer_id FROM referrals WHERE referred_id = %s', (referred_by,))
-                        level_2_referrer = c.fetchone()
-                        if level_2_referrer:
-                            level_2_referrer_id = level_2_referrer[0]
-                            logger.info(f"Adding level 2 referral: referrer {level_2_referrer_id}, referred {user_id}")
-                            add_referral(level_2_referrer_id, user_id, 2)
-
-                            c.execute('SELECT referrer_id FROM referrals WHERE referred_id = %s', (level_2_referrer_id,))
-                            level_3_referrer = c.fetchone()
-                            if level_3_referrer:
-                                level_3_referrer_id = level_3_referrer[0]
-                                logger.info(f"Adding level 3 referral: referrer {level_3_referrer_id}, referred {user_id}")
-                                add_referral(level_3_referrer_id, user_id, 3)
-                        conn.commit()
-                        logger.info(f"Referral processing completed for user {user_id}")
+            await adb.add_referral_chain(referred_by, user_id)
 
         # ارسال پیام خوش‌آمدگویی
         await update.message.reply_text(
@@ -1731,20 +4423,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 def get_seed_selection_menu(lang):
-    """🌱 Generate seed selection keyboard with emojis."""
-    buttons = [
-        [InlineKeyboardButton(f"{seed['emoji']} {seed['name_fa' if lang == 'fa' else 'name']}", callback_data=f"seed_{idx}")]
-        for idx, seed in enumerate(SEEDS)
-    ]
-    buttons.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")])
-    return InlineKeyboardMarkup(buttons)
+    """🌱 Seed selection keyboard with emojis."""
+    return keyboards.get("seeds", lang)
 
 async def handle_language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
       """Handle language selection callbacks."""
       query = update.callback_query
       await query.answer()
       user_id = query.from_user.id
-      user = get_user(user_id)
+      user = await get_context_user(context, user_id)
       lang = user[0] if user else "en"
       logger.info(f"User {user_id} triggered language callback: {query.data}")
 
@@ -1752,7 +4439,7 @@ async def handle_language_callback(update: Update, context: ContextTypes.DEFAULT
           if query.data.startswith("lang_"):
               new_lang = query.data.split("_")[1]
               if new_lang in ["fa", "en"]:
-                  upsert_user(user_id, language=new_lang)
+                  await adb.upsert_user(user_id, language=new_lang)
                   logger.info(f"Updated language for user {user_id} to {new_lang}")
                   await query.message.reply_text(
                       messages[new_lang]["language_updated"],
@@ -1788,7 +4475,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     if not user:
         logger.error(f"Failed to retrieve or create user {user_id}")
         await query.message.reply_text(
@@ -1810,40 +4497,9 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return SELECT_SEED
         elif query.data == "wallet":
-            try:
-                with psycopg2.connect(DATABASE_URL) as conn:
-                    with conn.cursor() as c:
-                        c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (user_id,))
-                        total_profit = c.fetchone()[0] or 0.0
-                        c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s AND status = %s', (user_id, 'confirmed'))
-                        transaction_count = c.fetchone()[0]
-                        c.execute('SELECT created_at FROM transactions WHERE user_id = %s AND status = %s ORDER BY created_at DESC LIMIT 1', (user_id, 'confirmed'))
-                        last_transaction = c.fetchone()[0] if c.rowcount > 0 else None
-                        c.execute('''
-                            SELECT s.name, s.name_fa
-                            FROM user_seeds us
-                            JOIN seeds s ON us.seed_id = s.seed_id
-                            WHERE us.user_id = %s
-                        ''', (user_id,))
-                        seeds = [row[1] if lang == "fa" else row[0] for row in c.fetchall()]
-                        seeds_text = ", ".join(seeds) if seeds else None
-            except psycopg2.Error as e:
-                logger.error(f"Database error retrieving wallet stats for user {user_id}: {e}")
-                await query.message.reply_text(
-                    messages[lang]["db_error"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                return ConversationHandler.END
-
-            await query.message.reply_text(
-                messages[lang]["wallet_balance"](balance, seeds_text, total_profit, transaction_count, last_transaction),
-                parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(seeds))
-            )
-            return ConversationHandler.END
+            return await reply_wallet_summary(query.message, user_id, lang)
         elif query.data == "plant_seed":
-            user_seeds = get_user_seeds(user_id)
+            user_seeds = await get_context_seeds(context, user_id)
             if not user_seeds:
                 await query.message.reply_text(
                     messages[lang]["no_seeds"],
@@ -1853,7 +4509,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                 return ConversationHandler.END
             buttons = [
                 [InlineKeyboardButton(seed[1] if lang == "fa" else seed[0], callback_data=f"plant_{seed[6]}")]
-                for seed in user_seeds if can_plant_seed(seed[4])
+                for seed in user_seeds if seed[8]
             ]
             if not buttons:
                 await query.message.reply_text(
@@ -1862,15 +4518,17 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                     reply_markup=get_wallet_menu(lang, balance, True)
                 )
                 return ConversationHandler.END
-            buttons.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="wallet")])
             await query.message.reply_text(
                 messages[lang]["plant_seed"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=keyboards.build(
+                    lang, buttons, back="wallet",
+                    head=keyboards.head("plant_all", lang) if len(buttons) > 1 else None
+                )
             )
             return PLANT_SEED
         elif query.data == "harvest_seed":
-            user_seeds = get_user_seeds(user_id)
+            user_seeds = await get_context_seeds(context, user_id)
             if not user_seeds:
                 await query.message.reply_text(
                     messages[lang]["no_seeds"],
@@ -1880,7 +4538,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                 return ConversationHandler.END
             buttons = [
                 [InlineKeyboardButton(seed[1] if lang == "fa" else seed[0], callback_data=f"harvest_{seed[6]}")]
-                for seed in user_seeds if can_harvest_seed(seed[4], seed[5], seed_id=seed[6])
+                for seed in user_seeds if seed[9]
             ]
             if not buttons:
                 await query.message.reply_text(
@@ -1889,11 +4547,13 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                     reply_markup=get_wallet_menu(lang, balance, True)
                 )
                 return ConversationHandler.END
-            buttons.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="wallet")])
             await query.message.reply_text(
                 messages[lang]["harvest_seed"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=keyboards.build(
+                    lang, buttons, back="wallet",
+                    head=keyboards.head("harvest_all", lang) if len(buttons) > 1 else None
+                )
             )
             return HARVEST_SEED
         elif query.data == "withdraw":
@@ -1901,19 +4561,17 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.message.reply_text(
                 messages[lang]["ask_withdraw_amount"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="wallet")]
-                ])
+                reply_markup=keyboards.back(lang, "wallet")
             )
             return WITHDRAW_AMOUNT
         elif query.data == "history":
             try:
-                transactions = get_transaction_history(user_id)
+                transactions = await adb.get_transaction_history(user_id)
                 if not transactions:
                     await query.message.reply_text(
                         messages[lang]["no_history"],
                         parse_mode="Markdown",
-                        reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+                        reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
                     )
                     return ConversationHandler.END
 
@@ -1959,7 +4617,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                 await query.message.reply_text(
                     messages[lang]["history"](transaction_text),
                     parse_mode="Markdown",
-                    reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+                    reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
                 )
                 return ConversationHandler.END
             except Exception as e:
@@ -1972,9 +4630,8 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                 return ConversationHandler.END
         elif query.data == "referral":
             try:
-                level1, level2, level3, total_profit, transactions, referrals = get_referral_stats(user_id)
-                bot = telegram.Bot(token=os.getenv("BOT_TOKEN"))
-                referral_link = f"https://t.me/{(await bot.get_me()).username}?start=ref_{user_id}"
+                level_counts, total_profit, transactions, referrals = await adb.get_referral_stats(user_id)
+                referral_link = build_referral_link(context.bot, user_id)
                 
                 transaction_text = ""
                 status_map = {
@@ -2016,7 +4673,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                     )
                 else:
                     await query.message.reply_text(
-                        messages[lang]["referral_info"](referral_link, level1, level2, level3, total_profit, transaction_text),
+                        messages[lang]["referral_info"](referral_link, level_counts, total_profit, transaction_text),
                         parse_mode="Markdown",
                         reply_markup=get_referral_menu(lang, referrals)
                     )
@@ -2032,7 +4689,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         elif query.data.startswith("referral_") and query.data != "referral":
             try:
                 referred_id = int(query.data.split("_")[1])
-                details = get_referral_details(user_id, referred_id, lang)
+                details = await adb.get_referral_details(user_id, referred_id, lang)
                 if not details:
                     await query.message.reply_text(
                         messages[lang]["error"],
@@ -2049,7 +4706,7 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                         details["transactions"]
                     ),
                     parse_mode="Markdown",
-                    reply_markup=get_referral_menu(lang, get_referral_stats(user_id)[5])
+                    reply_markup=get_referral_menu(lang, await adb.get_referral_list(user_id))
                 )
                 return ConversationHandler.END
             except Exception as e:
@@ -2060,13 +4717,27 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                     reply_markup=get_main_menu(lang)
                 )
                 return ConversationHandler.END
+        elif query.data == "auto_harvest":
+            try:
+                enabled = await adb.toggle_auto_harvest(user_id)
+            except psycopg2.Error:
+                await query.message.reply_text(
+                    messages[lang]["db_error"],
+                    parse_mode="Markdown",
+                    reply_markup=get_main_menu(lang)
+                )
+                return ConversationHandler.END
+            await query.message.reply_text(
+                messages[lang]["auto_harvest_on" if enabled else "auto_harvest_off"],
+                parse_mode="Markdown",
+                reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
+            )
+            return ConversationHandler.END
         elif query.data == "support":
             await query.message.reply_text(
                 messages[lang]["support"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-                ])
+                reply_markup=keyboards.back(lang)
             )
             return ConversationHandler.END
         elif query.data == "language":
@@ -2102,39 +4773,48 @@ async def handle_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data.clear()
         return ConversationHandler.END
     
-async def test_referral_profit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id != DEFAULT_ADMIN_ID:
-        await update.message.reply_text(
-            messages["en"]["unauthorized"],
-            parse_mode="Markdown"
-        )
-        return
-    
+@adb.sync_helper
+def get_recent_referral_profits(referrer_id, limit=10):
+    """Latest referral profit rows paid to a referrer."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
                     SELECT referrer_id, referred_id, profit_amount, level, created_at
                     FROM referral_profits
                     WHERE referrer_id = %s
                     ORDER BY created_at DESC
-                    LIMIT 10
-                ''', (user_id,))
-                profits = c.fetchall()
-                if not profits:
-                    await update.message.reply_text(
-                        "📉 *No Referral Profits*\nNo profits recorded for your referrals.",
-                        parse_mode="Markdown"
-                    )
-                    return
-                response = "📈 *Referral Profits*\n"
-                for profit in profits:
-                    response += (
-                        f"- Referred ID: {profit[1]}, Profit: {profit[2]} USDT, "
-                        f"Level: {profit[3]}, Date: {profit[4]}\n"
-                    )
-                await update.message.reply_text(response, parse_mode="Markdown")
+                    LIMIT %s
+                ''', (referrer_id, limit))
+                return c.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting referral profits for referrer {referrer_id}: {e}")
+        raise
+
+async def test_referral_profit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id != DEFAULT_ADMIN_ID:
+        await update.message.reply_text(
+            messages["en"]["unauthorized"],
+            parse_mode="Markdown"
+        )
+        return
+    
+    try:
+        profits = await adb.get_recent_referral_profits(user_id)
+        if not profits:
+            await update.message.reply_text(
+                "📉 *No Referral Profits*\nNo profits recorded for your referrals.",
+                parse_mode="Markdown"
+            )
+            return
+        response = "📈 *Referral Profits*\n"
+        for profit in profits:
+            response += (
+                f"- Referred ID: {profit[1]}, Profit: {profit[2]} USDT, "
+                f"Level: {profit[3]}, Date: {profit[4]}\n"
+            )
+        await update.message.reply_text(response, parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error in test_referral_profit for user {user_id}: {e}")
         await update.message.reply_text(
@@ -2147,7 +4827,7 @@ async def handle_seed_selection(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     balance = user[1] if user else 0
     logger.info(f"User {user_id} triggered seed selection callback: {query.data}")
@@ -2155,7 +4835,8 @@ async def handle_seed_selection(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         if query.data.startswith("seed_"):
             seed_idx = int(query.data.split("_")[1])
-            if seed_idx < 0 or seed_idx >= len(SEEDS):
+            seed = seed_catalog.by_index(seed_idx)
+            if seed is None:
                 logger.warning(f"Invalid seed index {seed_idx} for user {user_id}")
                 await query.message.reply_text(
                     messages[lang]["error"],
@@ -2163,31 +4844,21 @@ async def handle_seed_selection(update: Update, context: ContextTypes.DEFAULT_TY
                     reply_markup=get_main_menu(lang)
                 )
                 return ConversationHandler.END
-            seed = SEEDS[seed_idx]
-            daily_profit = round(seed["price"] * seed["daily_profit_rate"], 3)
-            weekly_profit = round(daily_profit * 7, 3)
-            monthly_profit = round(daily_profit * 30, 3)
-            total_monthly = round(seed["price"] + monthly_profit, 3)
             context.user_data["seed_idx"] = seed_idx
+            context.user_data["seed_id"] = seed["seed_id"]
             context.user_data["seed_price"] = seed["price"]
-            buttons = [
-                [InlineKeyboardButton("💸 پرداخت با واریز" if lang == "fa" else "💸 Pay with Deposit", callback_data="confirm_seed_purchase")]
-            ]
-            if balance >= seed["price"]:
-                buttons.insert(0, [InlineKeyboardButton("💰 پرداخت با موجودی" if lang == "fa" else "💰 Pay with Balance", callback_data="balance_purchase")])
-            buttons.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")])
             await query.message.reply_text(
                 messages[lang]["seed_info"](
                     seed["name_fa" if lang == "fa" else "name"],
                     seed["price"],
-                    daily_profit,
-                    weekly_profit,
-                    monthly_profit,
-                    total_monthly,
+                    seed["daily_profit"],
+                    seed["weekly_profit"],
+                    seed["monthly_profit"],
+                    seed["total_monthly"],
                     seed["emoji"]
                 ),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=keyboards.get("purchase", lang, balance >= seed["price"])
             )
             return SELECT_SEED
         elif query.data == "confirm_seed_purchase":
@@ -2204,9 +4875,7 @@ async def handle_seed_selection(update: Update, context: ContextTypes.DEFAULT_TY
             await query.message.reply_text(
                 messages[lang]["ask_amount"].format(seed_price),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-                ])
+                reply_markup=keyboards.back(lang)
             )
             return DEPOSIT_AMOUNT
         elif query.data == "balance_purchase":
@@ -2220,26 +4889,19 @@ async def handle_seed_selection(update: Update, context: ContextTypes.DEFAULT_TY
                     reply_markup=get_main_menu(lang)
                 )
                 return ConversationHandler.END
-            seed = SEEDS[seed_idx]
-            daily_profit = round(seed["price"] * seed["daily_profit_rate"], 3)
-            weekly_profit = round(daily_profit * 7, 3)
-            monthly_profit = round(daily_profit * 30, 3)
-            total_monthly = round(seed["price"] + monthly_profit, 3)
+            seed = seed_catalog.by_index(seed_idx)
             await query.message.reply_text(
                 messages[lang]["seed_info"](
                     seed["name_fa" if lang == "fa" else "name"],
                     seed["price"],
-                    daily_profit,
-                    weekly_profit,
-                    monthly_profit,
-                    total_monthly,
+                    seed["daily_profit"],
+                    seed["weekly_profit"],
+                    seed["monthly_profit"],
+                    seed["total_monthly"],
                     seed["emoji"]
                 ) + "\n\n" + ("تأیید خرید با موجودی؟" if lang == "fa" else "Confirm purchase with balance?"),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ تأیید" if lang == "fa" else "✅ Confirm", callback_data="confirm_balance_purchase")],
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-                ])
+                reply_markup=keyboards.get("confirm_balance_purchase", lang)
             )
             return CONFIRM_BALANCE_PURCHASE
         else:
@@ -2270,7 +4932,7 @@ async def handle_balance_purchase(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     balance = user[1] if user else 0
     logger.info(f"User {user_id} triggered balance purchase callback: {query.data}")
@@ -2283,73 +4945,50 @@ async def handle_balance_purchase(update: Update, context: ContextTypes.DEFAULT_
                 await query.message.reply_text(
                     messages[lang]["invalid_data"],
                     parse_mode="Markdown",
-                    reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+                    reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
                 )
                 return ConversationHandler.END
-            seed = SEEDS[seed_idx]
-            if balance < seed_price:
+            seed_id = context.user_data.get("seed_id")
+            seed = seed_catalog.by_id(seed_id) if seed_id is not None else seed_catalog.by_index(seed_idx)
+            if seed is None or seed["price"] != seed_price:
+                # کاتالوگ بعد از انتخاب بذر عوض شده (/reload_seeds)؛ کاربر باید دوباره انتخاب کند
+                logger.warning(f"Seed {seed_id or seed_idx} changed since user {user_id} selected it at {seed_price}")
+                await query.message.reply_text(
+                    messages[lang]["invalid_data"],
+                    parse_mode="Markdown",
+                    reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
+                )
+                context.user_data.clear()
+                return ConversationHandler.END
+            async with balance_locks.hold(user_id):
+                outcome, new_balance = await adb.purchase_seed(
+                    user_id, seed["seed_id"], seed["price"], f"purchase:{query.id}"
+                )
+            if outcome == "insufficient":
                 await query.message.reply_text(
                     messages[lang]["insufficient_balance"],
                     parse_mode="Markdown",
-                    reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+                    reply_markup=get_wallet_menu(lang, new_balance, bool(await get_context_seeds(context, user_id)))
                 )
                 return ConversationHandler.END
-            with psycopg2.connect(DATABASE_URL) as conn:
-                with conn.cursor() as c:
-                    c.execute('SELECT seed_id FROM seeds WHERE name = %s', (seed["name"],))
-                    seed_id = c.fetchone()[0]
-            update_balance(user_id, -seed_price)
-            add_user_seed(user_id, seed_id)
+            if outcome == "duplicate":
+                # Same callback delivered twice; the first delivery already bought the seed
+                return ConversationHandler.END
             await query.message.reply_text(
                 messages[lang]["confirmed"],
                 parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance - seed_price, True)
+                reply_markup=get_wallet_menu(lang, new_balance, True)
             )
             context.user_data.clear()
             return ConversationHandler.END
         elif query.data == "wallet":
             context.user_data.clear()
-            try:
-                with psycopg2.connect(DATABASE_URL) as conn:
-                    with conn.cursor() as c:
-                        # جمع سود از جدول profits
-                        c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (user_id,))
-                        seed_profit = c.fetchone()[0] or 0.0
-                        # جمع سود از جدول referral_profits
-                        c.execute('SELECT SUM(profit_amount) FROM referral_profits WHERE referrer_id = %s', (user_id,))
-                        referral_profit = c.fetchone()[0] or 0.0
-                        total_profit = seed_profit + referral_profit
-                        c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s AND status = %s', (user_id, 'confirmed'))
-                        transaction_count = c.fetchone()[0]
-                        c.execute('SELECT created_at FROM transactions WHERE user_id = %s AND status = %s ORDER BY created_at DESC LIMIT 1', (user_id, 'confirmed'))
-                        last_transaction = c.fetchone()[0] if c.rowcount > 0 else None
-                        c.execute('''
-                            SELECT s.name, s.name_fa
-                            FROM user_seeds us
-                            JOIN seeds s ON us.seed_id = s.seed_id
-                            WHERE us.user_id = %s
-                        ''', (user_id,))
-                        seeds = [row[1] if lang == "fa" else row[0] for row in c.fetchall()]
-                        seeds_text = ", ".join(seeds) if seeds else None
-            except psycopg2.Error as e:
-                logger.error(f"Database error retrieving wallet stats for user {user_id}: {e}")
-                await query.message.reply_text(
-                    messages[lang]["db_error"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                return ConversationHandler.END
-            await query.message.reply_text(
-                messages[lang]["wallet_balance"](balance, seeds_text, total_profit, transaction_count, last_transaction),
-                parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(seeds))
-            )
-            return ConversationHandler.END
+            return await reply_wallet_summary(query.message, user_id, lang)
         else:
             await query.message.reply_text(
                 messages[lang]["error"],
                 parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+                reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
             )
             return ConversationHandler.END
     except Exception as e:
@@ -2357,7 +4996,7 @@ async def handle_balance_purchase(update: Update, context: ContextTypes.DEFAULT_
         await query.message.reply_text(
             messages[lang]["error"],
             parse_mode="Markdown",
-            reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+            reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
         )
         context.user_data.clear()
         return ConversationHandler.END    
@@ -2367,23 +5006,31 @@ async def handle_plant_seed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"User {user_id} triggered plant seed callback: {query.data}")
 
     try:
-        if query.data.startswith("plant_"):
+        if query.data == "plant_all":
+            count = await adb.plant_all_seeds(user_id)
+            await query.message.reply_text(
+                messages[lang]["plant_all_success"](count) if count else messages[lang]["plant_already_done"],
+                parse_mode="Markdown",
+                reply_markup=get_wallet_menu(lang, user[1], True)
+            )
+            return ConversationHandler.END
+        elif query.data.startswith("plant_"):
             user_seed_id = int(query.data.split("_")[1])
-            user_seeds = get_user_seeds(user_id)
+            user_seeds = await get_context_seeds(context, user_id)
             seed = next((s for s in user_seeds if s[6] == user_seed_id), None)
-            if not seed or not can_plant_seed(seed[4]):
+            if not seed or not seed[8]:
                 await query.message.reply_text(
                     messages[lang]["plant_already_done"],
                     parse_mode="Markdown",
                     reply_markup=get_wallet_menu(lang, user[1], True)
                 )
                 return ConversationHandler.END
-            update_seed_plant(user_id, user_seed_id)
+            await adb.update_seed_plant(user_id, user_seed_id)
             await query.message.reply_text(
                 messages[lang]["plant_success"],
                 parse_mode="Markdown",
@@ -2391,44 +5038,7 @@ async def handle_plant_seed(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return ConversationHandler.END
         elif query.data == "wallet":
-            balance = user[1] if user else 0
-            try:
-                with psycopg2.connect(DATABASE_URL) as conn:
-                    with conn.cursor() as c:
-                        # جمع سود از جدول profits
-                        c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (user_id,))
-                        seed_profit = c.fetchone()[0] or 0.0
-                        # جمع سود از جدول referral_profits
-                        c.execute('SELECT SUM(profit_amount) FROM referral_profits WHERE referrer_id = %s', (user_id,))
-                        referral_profit = c.fetchone()[0] or 0.0
-                        total_profit = seed_profit + referral_profit
-                        c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s AND status = %s', (user_id, 'confirmed'))
-                        transaction_count = c.fetchone()[0]
-                        c.execute('SELECT created_at FROM transactions WHERE user_id = %s AND status = %s ORDER BY created_at DESC LIMIT 1', (user_id, 'confirmed'))
-                        last_transaction = c.fetchone()[0] if c.rowcount > 0 else None
-                        c.execute('''
-                            SELECT s.name, s.name_fa
-                            FROM user_seeds us
-                            JOIN seeds s ON us.seed_id = s.seed_id
-                            WHERE us.user_id = %s
-                        ''', (user_id,))
-                        seeds = [row[1] if lang == "fa" else row[0] for row in c.fetchall()]
-                        seeds_text = ", ".join(seeds) if seeds else None
-            except psycopg2.Error as e:
-                logger.error(f"Database error retrieving wallet stats for user {user_id}: {e}")
-                await query.message.reply_text(
-                    messages[lang]["db_error"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                return ConversationHandler.END
-
-            await query.message.reply_text(
-                messages[lang]["wallet_balance"](balance, seeds_text, total_profit, transaction_count, last_transaction),
-                parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(seeds))
-            )
-            return ConversationHandler.END
+            return await reply_wallet_summary(query.message, user_id, lang)
         else:
             logger.warning(f"Unhandled plant seed callback data for user {user_id}: {query.data}")
             await query.message.reply_text(
@@ -2452,15 +5062,32 @@ async def handle_harvest_seed(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     balance = user[1] if user else 0
     logger.info(f"User {user_id} triggered harvest seed callback: {query.data}")
 
     try:
-        if query.data.startswith("harvest_"):
+        if query.data == "harvest_all":
+            async with balance_locks.hold(user_id):
+                count, amount, new_balance = await adb.harvest_all_seeds(user_id)
+            if not count:
+                await query.message.reply_text(
+                    messages[lang]["harvest_not_ready"],
+                    parse_mode="Markdown",
+                    reply_markup=get_wallet_menu(lang, balance, True)
+                )
+                return ConversationHandler.END
+            await query.message.reply_text(
+                messages[lang]["harvest_all_success"](count, amount),
+                parse_mode="Markdown",
+                reply_markup=get_wallet_menu(lang, new_balance, True)
+            )
+            return ConversationHandler.END
+        elif query.data.startswith("harvest_"):
             user_seed_id = int(query.data.split("_")[1])
-            user_seed = get_user_seed(user_id, user_seed_id)
+            user_seeds = await get_context_seeds(context, user_id)
+            user_seed = next((s for s in user_seeds if s[6] == user_seed_id), None)
             if not user_seed:
                 logger.warning(f"User {user_id} does not own seed with user_seed_id {user_seed_id}")
                 await query.message.reply_text(
@@ -2470,76 +5097,38 @@ async def handle_harvest_seed(update: Update, context: ContextTypes.DEFAULT_TYPE
                 )
                 return ConversationHandler.END
 
-            seed_id, last_planted, last_harvested, price, daily_profit_rate = user_seed
-            logger.info(f"Checking harvest for user {user_id}, seed_id {seed_id}, user_seed_id {user_seed_id}")
+            logger.info(f"Checking harvest for user {user_id}, seed_id {user_seed[7]}, user_seed_id {user_seed_id}")
 
-            if not can_harvest_seed(last_planted, last_harvested, seed_id):
-                logger.info(f"Seed {seed_id} not ready for harvest by user {user_id}")
+            # The preloaded flag saves a round-trip for the common case; harvest_seed re-checks under lock
+            harvested = None
+            if user_seed[9]:
+                async with balance_locks.hold(user_id):
+                    harvested = await adb.harvest_seed(user_id, user_seed_id)
+            if not harvested:
+                logger.info(f"Seed {user_seed[7]} not ready for harvest by user {user_id}")
                 await query.message.reply_text(
                     messages[lang]["harvest_not_ready"],
                     parse_mode="Markdown",
                     reply_markup=get_wallet_menu(lang, balance, True)
                 )
                 return ConversationHandler.END
+            _, profit_amount, balance = harvested
 
-            profit_amount = round(price * daily_profit_rate, 3)
-            logger.info(f"Calculated profit for user {user_id}, seed_id {seed_id}: {profit_amount}")
-
-            update_seed_harvest(user_id, user_seed_id)
-            update_balance(user_id, profit_amount)
-            insert_profit(user_id, seed_id, profit_amount, "daily")
-
-            user_seeds = get_user_seeds(user_id)
+            # بقیه بذرها تغییری نکردن؛ نیازی به خواندن دوباره از دیتابیس نیست
             buttons = [
                 [InlineKeyboardButton(seed[1] if lang == "fa" else seed[0], callback_data=f"harvest_{seed[6]}")]
-                for seed in user_seeds if can_harvest_seed(seed[4], seed[5], seed_id=seed[6])
+                for seed in user_seeds
+                if seed[6] != user_seed_id and seed[9]
             ]
-            buttons.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="wallet")])
             await query.message.reply_text(
                 messages[lang]["harvest_success"](profit_amount),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=keyboards.build(lang, buttons, back="wallet")
             )
             logger.info(f"Sent harvest success message to user {user_id}")
             return HARVEST_SEED
         elif query.data == "wallet":
-            try:
-                with psycopg2.connect(DATABASE_URL) as conn:
-                    with conn.cursor() as c:
-                        # جمع سود از جدول profits
-                        c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (user_id,))
-                        seed_profit = c.fetchone()[0] or 0.0
-                        # جمع سود از جدول referral_profits
-                        c.execute('SELECT SUM(profit_amount) FROM referral_profits WHERE referrer_id = %s', (user_id,))
-                        referral_profit = c.fetchone()[0] or 0.0
-                        total_profit = seed_profit + referral_profit
-                        c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s AND status = %s', (user_id, 'confirmed'))
-                        transaction_count = c.fetchone()[0]
-                        c.execute('SELECT created_at FROM transactions WHERE user_id = %s AND status = %s ORDER BY created_at DESC LIMIT 1', (user_id, 'confirmed'))
-                        last_transaction = c.fetchone()[0] if c.rowcount > 0 else None
-                        c.execute('''
-                            SELECT s.name, s.name_fa
-                            FROM user_seeds us
-                            JOIN seeds s ON us.seed_id = s.seed_id
-                            WHERE us.user_id = %s
-                        ''', (user_id,))
-                        seeds = [row[1] if lang == "fa" else row[0] for row in c.fetchall()]
-                        seeds_text = ", ".join(seeds) if seeds else None
-            except psycopg2.Error as e:
-                logger.error(f"Database error retrieving wallet stats for user {user_id}: {e}")
-                await query.message.reply_text(
-                    messages[lang]["db_error"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                return ConversationHandler.END
-
-            await query.message.reply_text(
-                messages[lang]["wallet_balance"](balance, seeds_text, total_profit, transaction_count, last_transaction),
-                parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(seeds))
-            )
-            return ConversationHandler.END
+            return await reply_wallet_summary(query.message, user_id, lang)
         else:
             logger.warning(f"Unhandled harvest seed callback data for user {user_id}: {query.data}")
             await query.message.reply_text(
@@ -2557,14 +5146,11 @@ async def handle_harvest_seed(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return ConversationHandler.END
     
-async def check_seeds(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Check seeds for user 5664533861 (temporary for debugging)."""
-    user_id = update.effective_user.id
-    if user_id != 5664533861:
-        await update.message.reply_text("🚫 Unauthorized")
-        return
+@adb.sync_helper
+def get_user_seed_rows(user_id):
+    """Raw user_seeds rows with planting/harvest times, for debugging."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
                     SELECT us.id, us.seed_id, us.last_planted, us.last_harvested, s.name_fa
@@ -2572,16 +5158,28 @@ async def check_seeds(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     JOIN seeds s ON us.seed_id = s.seed_id
                     WHERE us.user_id = %s
                 ''', (user_id,))
-                seeds = c.fetchall()
-                if not seeds:
-                    await update.message.reply_text("🌱 No seeds found.")
-                    return
-                response = "🌱 Your seeds:\n"
-                for seed in seeds:
-                    response += (f"ID: {seed[0]}, Seed: {seed[4]}, "
-                                f"Last Planted: {seed[2] or 'Never'}, "
-                                f"Last Harvested: {seed[3] or 'Never'}\n")
-                await update.message.reply_text(response)
+                return c.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting seed rows for user {user_id}: {e}")
+        raise
+
+async def check_seeds(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Check seeds for user 5664533861 (temporary for debugging)."""
+    user_id = update.effective_user.id
+    if user_id != 5664533861:
+        await update.message.reply_text("🚫 Unauthorized")
+        return
+    try:
+        seeds = await adb.get_user_seed_rows(user_id)
+        if not seeds:
+            await update.message.reply_text("🌱 No seeds found.")
+            return
+        response = "🌱 Your seeds:\n"
+        for seed in seeds:
+            response += (f"ID: {seed[0]}, Seed: {seed[4]}, "
+                        f"Last Planted: {seed[2] or 'Never'}, "
+                        f"Last Harvested: {seed[3] or 'Never'}\n")
+        await update.message.reply_text(response)
     except Exception as e:
         logger.error(f"Error checking seeds for user {user_id}: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")  
@@ -2589,7 +5187,7 @@ async def check_seeds(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle deposit amount input."""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     seed_price = context.user_data.get("seed_price")
     input_text = update.message.text.strip()
@@ -2605,27 +5203,21 @@ async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TY
         return ConversationHandler.END
 
     try:
-        amount = float(input_text)
+        amount = parse_money(input_text)
         logger.info(f"Parsed amount for user {user_id}: {amount}")
         if amount != seed_price:
             logger.warning(f"Invalid amount entered by user {user_id}: {amount}, expected {seed_price}")
             await update.message.reply_text(
                 messages[lang]["invalid_amount"].format(seed_price),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-                ])
+                reply_markup=keyboards.back(lang)
             )
             return DEPOSIT_AMOUNT
         context.user_data["amount"] = amount
         await update.message.reply_text(
             messages[lang]["choose_network"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("TRC20", callback_data="network_TRC20")],
-                [InlineKeyboardButton("BEP20", callback_data="network_BEP20")],
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-            ])
+            reply_markup=keyboards.get("deposit_network", lang)
         )
         logger.info(f"Sent network selection message to user {user_id}")
         return DEPOSIT_NETWORK
@@ -2634,9 +5226,7 @@ async def handle_deposit_amount(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(
             messages[lang]["invalid_amount"].format(seed_price),
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-            ])
+            reply_markup=keyboards.back(lang)
         )
         return DEPOSIT_AMOUNT
     except Exception as e:
@@ -2654,7 +5244,7 @@ async def handle_deposit_network(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"User {user_id} triggered deposit network callback: {query.data}")
 
@@ -2672,16 +5262,12 @@ async def handle_deposit_network(update: Update, context: ContextTypes.DEFAULT_T
             await query.message.reply_text(
                 messages[lang]["wallet"](network, wallet_addresses[network]),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-                ])
+                reply_markup=keyboards.back(lang)
             )
             await query.message.reply_text(
                 messages[lang]["ask_txid"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-                ])
+                reply_markup=keyboards.back(lang)
             )
             return DEPOSIT_TXID
         elif query.data == "back_to_menu":
@@ -2712,7 +5298,7 @@ async def handle_deposit_network(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_deposit_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle deposit TXID or screenshot submission."""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     amount = context.user_data.get("amount")
     network = context.user_data.get("network")
@@ -2729,27 +5315,22 @@ async def handle_deposit_txid(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
 
     try:
-        seed = SEEDS[seed_idx]
+        seed = seed_catalog.by_index(seed_idx)
         message_id = update.message.message_id
-        
+        if seed is None:
+            logger.error(f"No seed at index {seed_idx} in the catalog for user {user_id}")
+            await update.message.reply_text(
+                messages[lang]["db_error"],
+                parse_mode="Markdown",
+                reply_markup=get_main_menu(lang)
+            )
+            context.user_data.clear()
+            return ConversationHandler.END
+
         # Insert transaction
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as c:
-                c.execute('SELECT seed_id FROM seeds WHERE name = %s', (seed["name"],))
-                result = c.fetchone()
-                if not result:
-                    logger.error(f"No seed found with name {seed['name']} for user {user_id}")
-                    await update.message.reply_text(
-                        messages[lang]["db_error"],
-                        parse_mode="Markdown",
-                        reply_markup=get_main_menu(lang)
-                    )
-                    context.user_data.clear()
-                    return ConversationHandler.END
-                seed_id = result[0]
-                transaction_id = insert_transaction(
-                    user_id, amount, network, "pending", "deposit", message_id, seed_id=seed_id
-                )
+        transaction_id = await adb.insert_transaction(
+            user_id, amount, network, "pending", "deposit", message_id, seed_id=seed["seed_id"]
+        )
 
         # Forward to admin
         try:
@@ -2819,19 +5400,19 @@ async def handle_deposit_txid(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def handle_withdraw_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle withdrawal amount input."""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     balance = user[1] if user else 0
     logger.info(f"User {user_id} entered withdrawal amount")
 
     try:
-        amount = float(update.message.text)
+        amount = parse_money(update.message.text)
         if amount < 15:
             await update.message.reply_text(
                 "⚠️ *خطا*: مقدار واردشده کمتر از حداقل مقدار برداشت (15 تتر) است!\nلطفاً مقدار معتبر وارد کنید." if lang == "fa" else
                 "⚠️ *Error*: The entered amount is less than the minimum withdrawal (15 USDT)!\nPlease enter a valid amount.",
                 parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+                reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
             )
             return WITHDRAW_AMOUNT
         if amount > balance:
@@ -2839,25 +5420,21 @@ async def handle_withdraw_amount(update: Update, context: ContextTypes.DEFAULT_T
                 f"⚠️ *خطا*: موجودی کافی نیست! موجودی شما `{balance}` تتر است.\nلطفاً مقدار کمتر یا برابر با موجودی وارد کنید." if lang == "fa" else
                 f"⚠️ *Error*: Insufficient balance! Your balance is `{balance}` USDT.\nPlease enter an amount less than or equal to your balance.",
                 parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+                reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
             )
             return WITHDRAW_AMOUNT
         context.user_data["withdraw_amount"] = amount
         await update.message.reply_text(
             messages[lang]["choose_network_withdraw"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("TRC20", callback_data="withdraw_network_TRC20")],
-                [InlineKeyboardButton("BEP20", callback_data="withdraw_network_BEP20")],
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="wallet")]
-            ])
+            reply_markup=keyboards.get("withdraw_network", lang)
         )
         return WITHDRAW_NETWORK
     except ValueError:
         await update.message.reply_text(
             messages[lang]["insufficient_balance"],
             parse_mode="Markdown",
-            reply_markup=get_wallet_menu(lang, balance, bool(get_user_seeds(user_id)))
+            reply_markup=get_wallet_menu(lang, balance, bool(await get_context_seeds(context, user_id)))
         )
         return WITHDRAW_AMOUNT
     except Exception as e:
@@ -2875,7 +5452,7 @@ async def handle_withdraw_network(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"User {user_id} triggered withdraw network callback: {query.data}")
 
@@ -2893,47 +5470,11 @@ async def handle_withdraw_network(update: Update, context: ContextTypes.DEFAULT_
             await query.message.reply_text(
                 messages[lang]["ask_withdraw_address"](network, wallet_addresses[network]),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="wallet")]
-                ])
+                reply_markup=keyboards.back(lang, "wallet")
             )
             return WITHDRAW_ADDRESS
         elif query.data == "wallet":
-            balance = user[1] if user else 0
-            try:
-                with psycopg2.connect(DATABASE_URL) as conn:
-                    with conn.cursor() as c:
-                        c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (user_id,))
-                        seed_profit = c.fetchone()[0] or 0.0
-                        c.execute('SELECT SUM(profit_amount) FROM referral_profits WHERE referrer_id = %s', (user_id,))
-                        referral_profit = c.fetchone()[0] or 0.0
-                        total_profit = seed_profit + referral_profit
-                        c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s AND status = %s', (user_id, 'confirmed'))
-                        transaction_count = c.fetchone()[0]
-                        c.execute('SELECT created_at FROM transactions WHERE user_id = %s AND status = %s ORDER BY created_at DESC LIMIT 1', (user_id, 'confirmed'))
-                        last_transaction = c.fetchone()[0] if c.rowcount > 0 else None
-                        c.execute('''
-                            SELECT s.name, s.name_fa
-                            FROM user_seeds us
-                            JOIN seeds s ON us.seed_id = s.seed_id
-                            WHERE us.user_id = %s
-                        ''', (user_id,))
-                        seeds = [row[1] if lang == "fa" else row[0] for row in c.fetchall()]
-                        seeds_text = ", ".join(seeds) if seeds else None
-            except psycopg2.Error as e:
-                logger.error(f"Database error retrieving wallet stats for user {user_id}: {e}")
-                await query.message.reply_text(
-                    messages[lang]["db_error"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                return ConversationHandler.END
-            await query.message.reply_text(
-                messages[lang]["wallet_balance"](balance, seeds_text, total_profit, transaction_count, last_transaction),
-                parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(seeds))
-            )
-            return ConversationHandler.END
+            return await reply_wallet_summary(query.message, user_id, lang)
         else:
             await query.message.reply_text(
                 messages[lang]["error"],
@@ -2954,7 +5495,7 @@ async def handle_withdraw_network(update: Update, context: ContextTypes.DEFAULT_
 async def handle_withdraw_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle withdrawal address input."""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     amount = context.user_data.get("withdraw_amount")
     network = context.user_data.get("withdraw_network")
@@ -2972,9 +5513,23 @@ async def handle_withdraw_address(update: Update, context: ContextTypes.DEFAULT_
 
     try:
         message_id = update.message.message_id
-        transaction_id = insert_transaction(
-            user_id, amount, network, "pending", "withdrawal", message_id, address=address
-        )
+        async with balance_locks.hold(user_id):
+            # Pending withdrawals reserve their amount, so two requests cannot both spend the same balance
+            fresh = await adb.get_spendable_balance(user_id)
+            transaction_id = None
+            if fresh and fresh[1] >= amount:
+                transaction_id = await adb.insert_transaction(
+                    user_id, amount, network, "pending", "withdrawal", message_id, address=address
+                )
+        if transaction_id is None:
+            logger.warning(f"Withdrawal of {amount} by user {user_id} exceeds spendable balance")
+            await update.message.reply_text(
+                messages[lang]["insufficient_balance"],
+                parse_mode="Markdown",
+                reply_markup=get_main_menu(lang)
+            )
+            context.user_data.clear()
+            return ConversationHandler.END
 
         # Forward to admin
         try:
@@ -3034,6 +5589,15 @@ async def handle_withdraw_address(update: Update, context: ContextTypes.DEFAULT_
         context.user_data.clear()
         return ConversationHandler.END
 
+def notify_referral_payouts(payouts, referred_id):
+    """Queue a profit notification for every referrer paid by confirm_deposit."""
+    for referrer_id, level, profit, _, referrer_lang in payouts:
+        notifier.enqueue(
+            referrer_id,
+            messages[referrer_lang or "en"]["referral_profit_notification"](profit, referred_id, level),
+            failure_notice=f"⚠️ *Warning*: Failed to notify referrer {referrer_id} about profit {profit}"
+        )
+
 async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle admin actions (approve/reject) from inline buttons."""
     query = update.callback_query
@@ -3054,7 +5618,7 @@ async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.info(f"Admin {user_id} attempting to {action} transaction_id {transaction_id}")
 
         # Retrieve transaction
-        transaction = get_transaction(transaction_id)
+        transaction = await adb.get_transaction(transaction_id)
         if not transaction:
             logger.warning(f"No pending transaction found for transaction_id {transaction_id}")
             await query.message.reply_text(
@@ -3067,79 +5631,51 @@ async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         transaction_id, target_user_id, amount, network, status, type, address, seed_id = transaction
         logger.info(f"Found transaction: id {transaction_id}, type {type}, amount {amount}, seed_id {seed_id}")
 
-        user = get_user(target_user_id)
+        user = await adb.get_user(target_user_id)
         lang = user[0] if user else "en"
 
         if action == "approve":
-            if not update_transaction_status(transaction_id, "confirmed"):
-                await query.message.reply_text(
-                    "❌ *Error*: Transaction already processed or not found.",
-                    parse_mode="Markdown"
-                )
-                return
-            
-            if type == "deposit" and seed_id:
-                logger.info(f"Adding seed {seed_id} to user {target_user_id}")
-                add_user_seed(target_user_id, seed_id)
-                if has_referrals(target_user_id):
-                    chain = get_referral_chain(target_user_id)
-                    logger.info(f"Referral chain for user {target_user_id}: {chain}")
-                    profit_rates = {1: 0.05, 2: 0.03, 3: 0.01}
-                    for referrer_id, level in chain:
-                        if level in profit_rates:
-                            profit_amount = round(amount * profit_rates[level], 2)
-                            logger.info(f"Recording referral profit for referrer {referrer_id}, level {level}, amount {profit_amount}")
-                            update_balance(referrer_id, profit_amount)
-                            record_referral_profit(referrer_id, target_user_id, transaction_id, level, profit_amount)
-                            # Send notification to referrer
-                            try:
-                                referrer_lang = get_user(referrer_id)[0] or "en"
-                                await context.bot.send_message(
-                                    chat_id=referrer_id,
-                                    text=messages[referrer_lang]["referral_profit_notification"](profit_amount, target_user_id, level),
-                                    parse_mode="Markdown"
-                                )
-                                logger.info(f"Sent referral profit notification to referrer {referrer_id}")
-                            except telegram.error.TelegramError as e:
-                                logger.error(f"Failed to send referral profit notification to referrer {referrer_id}: {e}")
-                                await context.bot.send_message(
-                                    chat_id=DEFAULT_ADMIN_ID,
-                                    text=f"⚠️ *Warning*: Failed to notify referrer {referrer_id} about profit {profit_amount}: {e}",
-                                    parse_mode="Markdown"
-                                )
-                try:
-                    await context.bot.send_message(
-                        chat_id=target_user_id,
-                        text=messages[lang]["confirmed"],
-                        parse_mode="Markdown",
-                        reply_markup=get_main_menu(lang)
-                    )
-                    logger.info(f"Sent confirmation message to user {target_user_id}")
-                except telegram.error.TelegramError as e:
-                    logger.error(f"Failed to send confirmation message to user {target_user_id}: {e}")
-                    await context.bot.send_message(
-                        chat_id=DEFAULT_ADMIN_ID,
-                        text=f"⚠️ *Warning*: Transaction approved for user {target_user_id}, but failed to notify user: {e}",
-                        parse_mode="Markdown"
-                    )
-            elif type == "withdrawal":
-                logger.info(f"Deducting {amount} from user {target_user_id} balance")
-                update_balance(target_user_id, -amount)
-                try:
-                    await context.bot.send_message(
-                        chat_id=target_user_id,
-                        text=messages[lang]["withdraw_confirmed"],
-                        parse_mode="Markdown",
-                        reply_markup=get_main_menu(lang)
+            async with balance_locks.hold(target_user_id):
+                if type == "withdrawal":
+                    logger.info(f"Deducting {amount} from user {target_user_id} balance")
+                    outcome, _ = await adb.confirm_withdrawal(transaction_id)
+                    if outcome != "confirmed":
+                        await query.message.reply_text(
+                            "❌ *Error*: Approval failed, user balance no longer covers this withdrawal; it stays pending."
+                            if outcome == "insufficient" else
+                            "❌ *Error*: Transaction already processed or not found.",
+                            parse_mode="Markdown"
+                        )
+                        return
+                    notifier.enqueue(
+                        target_user_id,
+                        messages[lang]["withdraw_confirmed"],
+                        reply_markup=get_main_menu(lang),
+                        failure_notice=f"⚠️ *Warning*: Withdrawal approved for user {target_user_id}, but failed to notify user"
                     )
-                    logger.info(f"Sent withdrawal confirmation message to user {target_user_id}")
-                except telegram.error.TelegramError as e:
-                    logger.error(f"Failed to send withdrawal confirmation to user {target_user_id}: {e}")
-                    await context.bot.send_message(
-                        chat_id=DEFAULT_ADMIN_ID,
-                        text=f"⚠️ *Warning*: Withdrawal approved for user {target_user_id}, but failed to notify user: {e}",
+                elif type == "deposit":
+                    logger.info(f"Confirming deposit {transaction_id} with seed {seed_id} for user {target_user_id}")
+                    outcome, payouts = await adb.confirm_deposit(transaction_id)
+                    if outcome != "confirmed":
+                        await query.message.reply_text(
+                            "❌ *Error*: Transaction already processed or not found.",
+                            parse_mode="Markdown"
+                        )
+                        return
+                    notify_referral_payouts(payouts, target_user_id)
+                    if seed_id:
+                        notifier.enqueue(
+                            target_user_id,
+                            messages[lang]["confirmed"],
+                            reply_markup=get_main_menu(lang),
+                            failure_notice=f"⚠️ *Warning*: Transaction approved for user {target_user_id}, but failed to notify user"
+                        )
+                elif not await adb.update_transaction_status(transaction_id, "confirmed"):
+                    await query.message.reply_text(
+                        "❌ *Error*: Transaction already processed or not found.",
                         parse_mode="Markdown"
                     )
+                    return
 
             await query.message.reply_text(
                 f"✅ *Transaction Approved* (ID: {transaction_id})",
@@ -3147,7 +5683,7 @@ async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             logger.info(f"Transaction {transaction_id} approved successfully")
         elif action == "reject":
-            if not update_transaction_status(transaction_id, "rejected"):
+            if not await adb.update_transaction_status(transaction_id, "rejected"):
                 await query.message.reply_text(
                     "❌ *Error*: Transaction already processed or not found.",
                     parse_mode="Markdown"
@@ -3155,37 +5691,19 @@ async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return
             
             if type == "deposit":
-                try:
-                    await context.bot.send_message(
-                        chat_id=target_user_id,
-                        text=messages[lang]["rejected"],
-                        parse_mode="Markdown",
-                        reply_markup=get_main_menu(lang)
-                    )
-                    logger.info(f"Sent rejection message to user {target_user_id} for deposit")
-                except telegram.error.TelegramError as e:
-                    logger.error(f"Failed to send rejection message to user {target_user_id}: {e}")
-                    await context.bot.send_message(
-                        chat_id=DEFAULT_ADMIN_ID,
-                        text=f"⚠️ *Warning*: Deposit rejected for user {target_user_id}, but failed to notify user: {e}",
-                        parse_mode="Markdown"
-                    )
+                notifier.enqueue(
+                    target_user_id,
+                    messages[lang]["rejected"],
+                    reply_markup=get_main_menu(lang),
+                    failure_notice=f"⚠️ *Warning*: Deposit rejected for user {target_user_id}, but failed to notify user"
+                )
             elif type == "withdrawal":
-                try:
-                    await context.bot.send_message(
-                        chat_id=target_user_id,
-                        text=messages[lang]["withdraw_rejected"],
-                        parse_mode="Markdown",
-                        reply_markup=get_main_menu(lang)
-                    )
-                    logger.info(f"Sent withdrawal rejection message to user {target_user_id}")
-                except telegram.error.TelegramError as e:
-                    logger.error(f"Failed to send withdrawal rejection to user {target_user_id}: {e}")
-                    await context.bot.send_message(
-                        chat_id=DEFAULT_ADMIN_ID,
-                        text=f"⚠️ *Warning*: Withdrawal rejected for user {target_user_id}, but failed to notify user: {e}",
-                        parse_mode="Markdown"
-                    )
+                notifier.enqueue(
+                    target_user_id,
+                    messages[lang]["withdraw_rejected"],
+                    reply_markup=get_main_menu(lang),
+                    failure_notice=f"⚠️ *Warning*: Withdrawal rejected for user {target_user_id}, but failed to notify user"
+                )
 
             await query.message.reply_text(
                 f"❌ *Transaction Rejected* (ID: {transaction_id})",
@@ -3210,7 +5728,7 @@ async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"User {user_id} triggered back callback: {query.data}")
 
@@ -3224,43 +5742,7 @@ async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return ConversationHandler.END
         elif query.data == "wallet":
-            balance = user[1] if user else 0
-            try:
-                with psycopg2.connect(DATABASE_URL) as conn:
-                    with conn.cursor() as c:
-                        # جمع سود از جدول profits
-                        c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (user_id,))
-                        seed_profit = c.fetchone()[0] or 0.0
-                        # جمع سود از جدول referral_profits
-                        c.execute('SELECT SUM(profit_amount) FROM referral_profits WHERE referrer_id = %s', (user_id,))
-                        referral_profit = c.fetchone()[0] or 0.0
-                        total_profit = seed_profit + referral_profit
-                        c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s AND status = %s', (user_id, 'confirmed'))
-                        transaction_count = c.fetchone()[0]
-                        c.execute('SELECT created_at FROM transactions WHERE user_id = %s AND status = %s ORDER BY created_at DESC LIMIT 1', (user_id, 'confirmed'))
-                        last_transaction = c.fetchone()[0] if c.rowcount > 0 else None
-                        c.execute('''
-                            SELECT s.name, s.name_fa
-                            FROM user_seeds us
-                            JOIN seeds s ON us.seed_id = s.seed_id
-                            WHERE us.user_id = %s
-                        ''', (user_id,))
-                        seeds = [row[1] if lang == "fa" else row[0] for row in c.fetchall()]
-                        seeds_text = ", ".join(seeds) if seeds else None
-            except psycopg2.Error as e:
-                logger.error(f"Database error retrieving wallet stats for user {user_id}: {e}")
-                await query.message.reply_text(
-                    messages[lang]["db_error"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                return ConversationHandler.END
-            await query.message.reply_text(
-                messages[lang]["wallet_balance"](balance, seeds_text, total_profit, transaction_count, last_transaction),
-                parse_mode="Markdown",
-                reply_markup=get_wallet_menu(lang, balance, bool(seeds))
-            )
-            return ConversationHandler.END
+            return await reply_wallet_summary(query.message, user_id, lang)
         else:
             logger.warning(f"Unhandled back callback data for user {user_id}: {query.data}")
             await query.message.reply_text(
@@ -3304,7 +5786,7 @@ async def approve_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE
         transaction_id = int(command[1])
         logger.info(f"Admin {user_id} attempting to approve transaction_id {transaction_id}")
 
-        transaction = get_transaction(transaction_id)
+        transaction = await adb.get_transaction(transaction_id)
         if not transaction:
             logger.warning(f"No pending transaction found for transaction_id {transaction_id}")
             await update.message.reply_text(
@@ -3316,77 +5798,49 @@ async def approve_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE
         transaction_id, target_user_id, amount, network, status, type, address, seed_id = transaction
         logger.info(f"Found transaction: id {transaction_id}, type {type}, amount {amount}, seed_id {seed_id}")
 
-        if not update_transaction_status(transaction_id, "confirmed"):
-            await update.message.reply_text(
-                "❌ *Error*: Transaction already processed or not found.",
-                parse_mode="Markdown"
-            )
-            return
-        
-        user = get_user(target_user_id)
+        user = await adb.get_user(target_user_id)
         lang = user[0] if user else "en"
-        if type == "deposit" and seed_id:
-            logger.info(f"Adding seed {seed_id} to user {target_user_id}")
-            add_user_seed(target_user_id, seed_id)
-            if has_referrals(target_user_id):
-                chain = get_referral_chain(target_user_id)
-                logger.info(f"Referral chain for user {target_user_id}: {chain}")
-                profit_rates = {1: 0.05, 2: 0.03, 3: 0.01}
-                for referrer_id, level in chain:
-                    if level in profit_rates:
-                        profit_amount = round(amount * profit_rates[level], 2)
-                        logger.info(f"Recording referral profit for referrer {referrer_id}, level {level}, amount {profit_amount}")
-                        update_balance(referrer_id, profit_amount)
-                        record_referral_profit(referrer_id, target_user_id, transaction_id, level, profit_amount)
-                        # Send notification to referrer
-                        try:
-                            referrer_lang = get_user(referrer_id)[0] or "en"
-                            await context.bot.send_message(
-                                chat_id=referrer_id,
-                                text=messages[referrer_lang]["referral_profit_notification"](profit_amount, target_user_id, level),
-                                parse_mode="Markdown"
-                            )
-                            logger.info(f"Sent referral profit notification to referrer {referrer_id}")
-                        except telegram.error.TelegramError as e:
-                            logger.error(f"Failed to send referral profit notification to referrer {referrer_id}: {e}")
-                            await context.bot.send_message(
-                                chat_id=DEFAULT_ADMIN_ID,
-                                text=f"⚠️ *Warning*: Failed to notify referrer {referrer_id} about profit {profit_amount}: {e}",
-                                parse_mode="Markdown"
-                            )
-            try:
-                await context.bot.send_message(
-                    chat_id=target_user_id,
-                    text=messages[lang]["confirmed"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                logger.info(f"Sent confirmation message to user {target_user_id}")
-            except telegram.error.TelegramError as e:
-                logger.error(f"Failed to send confirmation message to user {target_user_id}: {e}")
-                await context.bot.send_message(
-                    chat_id=DEFAULT_ADMIN_ID,
-                    text=f"⚠️ *Warning*: Transaction approved for user {target_user_id}, but failed to notify user: {e}",
-                    parse_mode="Markdown"
-                )
-        elif type == "withdrawal":
-            logger.info(f"Deducting {amount} from user {target_user_id} balance")
-            update_balance(target_user_id, -amount)
-            try:
-                await context.bot.send_message(
-                    chat_id=target_user_id,
-                    text=messages[lang]["withdraw_confirmed"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
+        async with balance_locks.hold(target_user_id):
+            if type == "withdrawal":
+                logger.info(f"Deducting {amount} from user {target_user_id} balance")
+                outcome, _ = await adb.confirm_withdrawal(transaction_id)
+                if outcome != "confirmed":
+                    await update.message.reply_text(
+                        "❌ *Error*: Approval failed, user balance no longer covers this withdrawal; it stays pending."
+                        if outcome == "insufficient" else
+                        "❌ *Error*: Transaction already processed or not found.",
+                        parse_mode="Markdown"
+                    )
+                    return
+                notifier.enqueue(
+                    target_user_id,
+                    messages[lang]["withdraw_confirmed"],
+                    reply_markup=get_main_menu(lang),
+                    failure_notice=f"⚠️ *Warning*: Withdrawal approved for user {target_user_id}, but failed to notify user"
                 )
-                logger.info(f"Sent withdrawal confirmation message to user {target_user_id}")
-            except telegram.error.TelegramError as e:
-                logger.error(f"Failed to send withdrawal confirmation to user {target_user_id}: {e}")
-                await context.bot.send_message(
-                    chat_id=DEFAULT_ADMIN_ID,
-                    text=f"⚠️ *Warning*: Withdrawal approved for user {target_user_id}, but failed to notify user: {e}",
+            elif type == "deposit":
+                logger.info(f"Confirming deposit {transaction_id} with seed {seed_id} for user {target_user_id}")
+                outcome, payouts = await adb.confirm_deposit(transaction_id)
+                if outcome != "confirmed":
+                    await update.message.reply_text(
+                        "❌ *Error*: Transaction already processed or not found.",
+                        parse_mode="Markdown"
+                    )
+                    return
+                notify_referral_payouts(payouts, target_user_id)
+                if seed_id:
+                    notifier.enqueue(
+                        target_user_id,
+                        messages[lang]["confirmed"],
+                        reply_markup=get_main_menu(lang),
+                        failure_notice=f"⚠️ *Warning*: Transaction approved for user {target_user_id}, but failed to notify user"
+                    )
+            elif not await adb.update_transaction_status(transaction_id, "confirmed"):
+                await update.message.reply_text(
+                    "❌ *Error*: Transaction already processed or not found.",
                     parse_mode="Markdown"
                 )
+                return
 
         await update.message.reply_text(
             f"✅ *Transaction Approved* (ID: {transaction_id})",
@@ -3426,7 +5880,7 @@ async def reject_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info(f"Admin {user_id} attempting to reject transaction_id {transaction_id}")
 
         # Retrieve transaction
-        transaction = get_transaction(transaction_id)
+        transaction = await adb.get_transaction(transaction_id)
         if not transaction:
             logger.warning(f"No pending transaction found for transaction_id {transaction_id}")
             await update.message.reply_text(
@@ -3440,7 +5894,7 @@ async def reject_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info(f"Found transaction: id {transaction_id}, type {type}, amount {amount}, seed_id {seed_id}")
 
         # Update transaction status
-        if not update_transaction_status(transaction_id, "rejected"):
+        if not await adb.update_transaction_status(transaction_id, "rejected"):
             await update.message.reply_text(
                 "❌ *Error*: Transaction already processed or not found.",
                 parse_mode="Markdown"
@@ -3448,40 +5902,22 @@ async def reject_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
         
         # Notify user
-        user = get_user(target_user_id)
+        user = await adb.get_user(target_user_id)
         lang = user[0] if user else "en"
         if type == "deposit":
-            try:
-                await context.bot.send_message(
-                    chat_id=target_user_id,
-                    text=messages[lang]["rejected"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                logger.info(f"Sent rejection message to user {target_user_id} for deposit")
-            except telegram.error.TelegramError as e:
-                logger.error(f"Failed to send rejection message to user {target_user_id}: {e}")
-                await context.bot.send_message(
-                    chat_id=DEFAULT_ADMIN_ID,
-                    text=f"⚠️ *Warning*: Deposit rejected for user {target_user_id}, but failed to notify user: {e}",
-                    parse_mode="Markdown"
-                )
+            notifier.enqueue(
+                target_user_id,
+                messages[lang]["rejected"],
+                reply_markup=get_main_menu(lang),
+                failure_notice=f"⚠️ *Warning*: Deposit rejected for user {target_user_id}, but failed to notify user"
+            )
         elif type == "withdrawal":
-            try:
-                await context.bot.send_message(
-                    chat_id=target_user_id,
-                    text=messages[lang]["withdraw_rejected"],
-                    parse_mode="Markdown",
-                    reply_markup=get_main_menu(lang)
-                )
-                logger.info(f"Sent withdrawal rejection message to user {target_user_id}")
-            except telegram.error.TelegramError as e:
-                logger.error(f"Failed to send withdrawal rejection to user {target_user_id}: {e}")
-                await context.bot.send_message(
-                    chat_id=DEFAULT_ADMIN_ID,
-                    text=f"⚠️ *Warning*: Withdrawal rejected for user {target_user_id}, but failed to notify user: {e}",
-                    parse_mode="Markdown"
-                )
+            notifier.enqueue(
+                target_user_id,
+                messages[lang]["withdraw_rejected"],
+                reply_markup=get_main_menu(lang),
+                failure_notice=f"⚠️ *Warning*: Withdrawal rejected for user {target_user_id}, but failed to notify user"
+            )
 
         await update.message.reply_text(
             f"❌ *Transaction Rejected* (ID: {transaction_id})",
@@ -3521,29 +5957,107 @@ async def test_approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@adb.sync_helper
 def update_transaction_status(transaction_id, status):
     """Update transaction status using transaction ID."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 c.execute('''
                     UPDATE transactions
                     SET status = %s
                     WHERE id = %s AND status = 'pending'
+                    RETURNING user_id, created_at
                 ''', (status, transaction_id))
-                if c.rowcount == 0:
+                row = c.fetchone()
+                if row is None:
                     logger.warning(f"No pending transaction found for transaction_id {transaction_id} to update to {status}")
                     return False
+                if status == "confirmed":
+                    bump_user_stats(c, row[0], confirmed_count=1, confirmed_at=row[1])
+                conn.commit()
+                logger.info(f"Updated transaction status for transaction_id {transaction_id} to {status}")
+                return True
+    except Exception as e:
+        logger.error(f"Error updating transaction status for transaction_id {transaction_id}: {e}")
+        raise
+
+@adb.sync_helper
+def confirm_withdrawal(transaction_id):
+    """Confirm a pending withdrawal and debit the balance in one transaction.
+    Returns ("confirmed", new_balance); ("insufficient", None) leaves it pending, ("processed", None) if it is not pending."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    UPDATE transactions
+                    SET status = 'confirmed'
+                    WHERE id = %s AND status = 'pending' AND type = 'withdrawal'
+                    RETURNING user_id, amount, created_at
+                ''', (transaction_id,))
+                row = c.fetchone()
+                if row is None:
+                    conn.rollback()
+                    logger.warning(f"No pending withdrawal found for transaction_id {transaction_id}")
+                    return "processed", None
+                user_id, amount, created_at = row
+                c.execute(BALANCE_CHANGE_QUERY, balance_change_params(
+                    user_id, -amount, "withdrawal", transaction_id, f"withdrawal:{transaction_id}", require_funds=True
+                ))
+                debited = c.fetchone()
+                if debited is None:
+                    # موجودی کافی نیست؛ وضعیت تراکنش pending می‌ماند
+                    conn.rollback()
+                    logger.warning(f"Withdrawal {transaction_id} left pending: balance of user {user_id} no longer covers {amount}")
+                    return "insufficient", None
+                bump_user_stats(c, user_id, confirmed_count=1, confirmed_at=created_at)
+                conn.commit()
+        user_cache.update(user_id, balance=debited[0])
+        logger.info(f"Confirmed withdrawal {transaction_id}: debited {amount} from user {user_id}, new balance: {debited[0]}")
+        return "confirmed", debited[0]
+    except Exception as e:
+        logger.error(f"Error confirming withdrawal {transaction_id}: {e}", exc_info=True)
+        raise
+
+@adb.sync_helper
+def confirm_deposit(transaction_id):
+    """Confirm a pending deposit, add its seed and pay the referral chain in one transaction.
+    Returns ("confirmed", [(referrer_id, level, profit, new_balance, language)]), or ("processed", None) if it is not pending."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    UPDATE transactions
+                    SET status = 'confirmed'
+                    WHERE id = %s AND status = 'pending' AND type = 'deposit'
+                    RETURNING user_id, amount, seed_id, created_at
+                ''', (transaction_id,))
+                row = c.fetchone()
+                if row is None:
+                    conn.rollback()
+                    logger.warning(f"No pending deposit found for transaction_id {transaction_id}")
+                    return "processed", None
+                user_id, amount, seed_id, created_at = row
+                payouts = []
+                if seed_id:
+                    c.execute('''
+                        INSERT INTO user_seeds (user_id, seed_id, purchase_date)
+                        VALUES (%s, %s, %s)
+                    ''', (user_id, seed_id, dt.datetime.now(dt.UTC)))
+                    c.execute(REFERRAL_PAYOUT_QUERY, referral_payout_params(user_id, transaction_id, amount))
+                    payouts = c.fetchall()
+                bump_user_stats(c, user_id, confirmed_count=1, confirmed_at=created_at)
                 conn.commit()
-                logger.info(f"Updated transaction status for transaction_id {transaction_id} to {status}")
-                return True
+        apply_referral_payouts(user_id, transaction_id, payouts)
+        logger.info(f"Confirmed deposit {transaction_id} of user {user_id}: seed {seed_id}, {len(payouts)} referral payouts")
+        return "confirmed", payouts
     except Exception as e:
-        logger.error(f"Error updating transaction status for transaction_id {transaction_id}: {e}")
+        logger.error(f"Error confirming deposit {transaction_id}: {e}", exc_info=True)
         raise
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"User {user_id} cancelled operation")
     
@@ -3565,7 +6079,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_unexpected_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle unexpected messages during conversation."""
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"User {user_id} sent unexpected message")
 
@@ -3576,42 +6090,296 @@ async def handle_unexpected_message(update: Update, context: ContextTypes.DEFAUL
     )
     return ConversationHandler.END
 
-async def debug_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def runtime_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show runtime performance stats to the admin."""
+    user_id = update.effective_user.id
+    if user_id != DEFAULT_ADMIN_ID:
+        await update.message.reply_text("🚫 Unauthorized")
+        return
+    try:
+        sections = [
+            format_pool_stats(),
+            format_async_pool_stats(),
+            format_executor_stats(),
+            format_update_stats(),
+            format_lock_stats(),
+            format_persistence_stats(),
+            format_user_cache_stats(),
+            format_notifier_stats(),
+            format_accrual_stats(),
+        ]
+        await update.message.reply_text("\n\n".join(sections))
+    except Exception as e:
+        logger.error(f"Error collecting runtime stats: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+async def rebuild_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Recompute the user_stats running totals from the source tables."""
+    user_id = update.effective_user.id
+    if user_id != DEFAULT_ADMIN_ID:
+        await update.message.reply_text("🚫 Unauthorized")
+        return
+    try:
+        started = time.monotonic()
+        count = await adb.rebuild_user_stats()
+        await update.message.reply_text(
+            f"✅ Rebuilt user_stats for {count} users in {time.monotonic() - started:.1f}s"
+        )
+    except Exception as e:
+        logger.error(f"Error rebuilding user stats: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+async def db_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show index usage and the slowest statements to the admin."""
     user_id = update.effective_user.id
     if user_id != DEFAULT_ADMIN_ID:
         await update.message.reply_text("🚫 Unauthorized")
         return
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        report = await adb.get_db_report()
+        lines = ["📇 Index usage (scans, size)"]
+        lines += [f"{table}.{index}: {scans} scans, {size}" for table, index, scans, size in report["indexes"]]
+        lines.append("")
+        lines.append("📋 Tables (seq scans / rows read, index scans, live rows)")
+        lines += [
+            f"{table}: {seq_scan} / {seq_read}, {idx_scan}, {live}"
+            for table, seq_scan, seq_read, idx_scan, live in report["tables"]
+        ]
+        lines.append("")
+        if report["statements"] is None:
+            lines.append("🐢 pg_stat_statements not available")
+        else:
+            lines.append("🐢 Slowest statements (mean ms, calls)")
+            lines += [
+                f"{mean:.1f} ms x{calls}: {query}"
+                for calls, mean, total, query in report["statements"]
+            ]
+        text = "\n".join(lines)
+        # Telegram caps messages at 4096 characters
+        await update.message.reply_text(text[:4000])
+    except Exception as e:
+        logger.error(f"Error building database report: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+# Ledger verification
+LEDGER_VERIFY_BATCH = int(os.getenv("LEDGER_VERIFY_BATCH", "5000"))  # users per verification query
+LEDGER_VERIFY_PARALLEL = int(os.getenv("LEDGER_VERIFY_PARALLEL", str(max(1, min(4, DB_POOL_MAX_SIZE - 1)))))
+LEDGER_MISMATCH_REPORT = 20
+
+# Users with a balance but no ledger rows get one 'opening' entry. The table lock holds back
+# balance writers (their statements insert into ledger) so no change slips between balance and ledger.
+LEDGER_OPENING_QUERY = '''
+    INSERT INTO ledger (user_id, entry_type, amount, idempotency_key)
+    SELECT u.user_id, 'opening', u.balance, 'opening:' || u.user_id
+    FROM users u
+    WHERE COALESCE(u.balance, 0) <> 0
+      AND NOT EXISTS (SELECT 1 FROM ledger l WHERE l.user_id = u.user_id)
+    ON CONFLICT (idempotency_key) DO NOTHING
+'''
+
+LEDGER_VERIFY_BOUNDS_QUERY = '''
+    SELECT user_id FROM (
+        SELECT user_id, row_number() OVER (ORDER BY user_id) AS rn FROM users
+    ) numbered
+    WHERE rn %% %(batch)s = 0
+    ORDER BY user_id
+'''
+
+LEDGER_VERIFY_QUERY = '''
+    SELECT u.user_id, COALESCE(u.balance, 0), COALESCE(l.total, 0), COALESCE(l.entries, 0)
+    FROM users u
+    LEFT JOIN (
+        SELECT user_id, SUM(amount) AS total, COUNT(*) AS entries
+        FROM ledger
+        WHERE user_id > %(low)s AND user_id <= %(high)s
+        GROUP BY user_id
+    ) l ON l.user_id = u.user_id
+    WHERE u.user_id > %(low)s AND u.user_id <= %(high)s
+'''
+
+def backfill_ledger_openings():
+    """Record opening balances for users that predate the ledger."""
+    try:
+        with db_connection() as conn:
             with conn.cursor() as c:
-                c.execute('SELECT referrer_id, referred_id, level FROM referrals WHERE referrer_id = %s', (user_id,))
-                referrals = c.fetchall()
-                if referrals:
-                    response = "\n".join([f"Referrer: {r[0]}, Referred: {r[1]}, Level: {r[2]}" for r in referrals])
-                else:
-                    response = "No referrals found."
-                await update.message.reply_text(f"Referrals:\n{response}")
+                c.execute('LOCK TABLE ledger IN EXCLUSIVE MODE')
+                c.execute(LEDGER_OPENING_QUERY)
+                count = c.rowcount
+                conn.commit()
+        if count:
+            logger.info(f"Recorded opening ledger balances for {count} users")
+        return count
+    except Exception as e:
+        logger.error(f"Error backfilling opening ledger balances: {e}")
+        raise
+
+def ledger_verify_ranges(batch_size=LEDGER_VERIFY_BATCH):
+    """Split the user id space into (low, high] ranges of about batch_size users each."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('SELECT MIN(user_id), MAX(user_id) FROM users')
+                low, high = c.fetchone()
+                if low is None:
+                    return []
+                c.execute(LEDGER_VERIFY_BOUNDS_QUERY, {"batch": batch_size})
+                bounds = [low - 1] + [row[0] for row in c.fetchall() if row[0] < high] + [high]
+        return list(zip(bounds, bounds[1:]))
+    except Exception as e:
+        logger.error(f"Error computing ledger verification ranges: {e}")
+        raise
+
+def verify_ledger_range(low, high):
+    """Compare balances to ledger sums for users in (low, high]. Returns (users, entries, mismatches)."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(LEDGER_VERIFY_QUERY, {"low": low, "high": high})
+                rows = c.fetchall()
+        mismatches = [(user_id, balance, total) for user_id, balance, total, _ in rows if balance != total]
+        return len(rows), sum(row[3] for row in rows), mismatches
+    except Exception as e:
+        logger.error(f"Error verifying ledger for users ({low}, {high}]: {e}")
+        raise
+
+def repair_balance_projection(user_ids):
+    """Reset users.balance to the ledger sum for user_ids. Returns [(user_id, balance)]."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                # Row locks first, so the sums below see every balance change that committed before them
+                c.execute('SELECT user_id FROM users WHERE user_id = ANY(%s) ORDER BY user_id FOR UPDATE', (user_ids,))
+                c.execute('''
+                    UPDATE users u
+                    SET balance = COALESCE((SELECT SUM(amount) FROM ledger l WHERE l.user_id = u.user_id), 0)
+                    WHERE u.user_id = ANY(%s)
+                    RETURNING u.user_id, u.balance
+                ''', (user_ids,))
+                repaired = c.fetchall()
+                conn.commit()
+        for user_id, balance in repaired:
+            user_cache.update(user_id, balance=balance)
+        logger.warning(f"Repaired balance projection from the ledger for users {[user_id for user_id, _ in repaired]}")
+        return repaired
+    except Exception as e:
+        logger.error(f"Error repairing balance projection: {e}")
+        raise
+
+async def verify_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Check users.balance against the ledger in parallel batches; '/verify_ledger repair' fixes mismatches."""
+    user_id = update.effective_user.id
+    if user_id != DEFAULT_ADMIN_ID:
+        await update.message.reply_text("🚫 Unauthorized")
+        return
+    repair = bool(context.args) and context.args[0] == "repair"
+    try:
+        started = time.monotonic()
+        ranges = await db_executor.run(ledger_verify_ranges)
+        semaphore = asyncio.Semaphore(LEDGER_VERIFY_PARALLEL)
+
+        async def check(low, high):
+            async with semaphore:
+                return await db_executor.run(verify_ledger_range, low, high)
+
+        results = await asyncio.gather(*(check(low, high) for low, high in ranges))
+        users = sum(result[0] for result in results)
+        entries = sum(result[1] for result in results)
+        mismatches = [mismatch for result in results for mismatch in result[2]]
+        elapsed = time.monotonic() - started
+        lines = [
+            f"📒 Ledger check: {users} users, {entries} entries in {len(ranges)} batches, {elapsed:.2f}s",
+            f"Mismatches: {len(mismatches)}",
+        ]
+        lines += [
+            f"{mismatch_user}: balance {balance}, ledger {total}"
+            for mismatch_user, balance, total in mismatches[:LEDGER_MISMATCH_REPORT]
+        ]
+        if len(mismatches) > LEDGER_MISMATCH_REPORT:
+            lines.append(f"... and {len(mismatches) - LEDGER_MISMATCH_REPORT} more")
+        if mismatches and repair:
+            repaired = []
+            for mismatch_user, _, _ in mismatches:
+                async with balance_locks.hold(mismatch_user):
+                    repaired += await db_executor.run(repair_balance_projection, [mismatch_user])
+            lines.append(f"🔧 Reset {len(repaired)} balances to their ledger sum")
+        elif mismatches:
+            lines.append("Run /verify_ledger repair to reset these balances to their ledger sum")
+        await update.message.reply_text("\n".join(lines))
     except Exception as e:
+        logger.error(f"Error verifying ledger: {e}")
         await update.message.reply_text(f"Error: {str(e)}")
 
-async def debug_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Debug balance and referral profits for a user."""
+async def reload_seeds(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reload the in-memory seed catalog after the seeds table was edited."""
     user_id = update.effective_user.id
     if user_id != DEFAULT_ADMIN_ID:
         await update.message.reply_text("🚫 Unauthorized")
         return
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        count = await db_executor.run(seed_catalog.load)
+        await update.message.reply_text(
+            f"✅ Reloaded seed catalog: {count} seeds, {len(seed_catalog)} on sale"
+        )
+    except Exception as e:
+        logger.error(f"Error reloading seed catalog: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send `/broadcast <text>` to every user; without text, show the latest broadcasts."""
+    user_id = update.effective_user.id
+    if user_id != DEFAULT_ADMIN_ID:
+        await update.message.reply_text("🚫 Unauthorized")
+        return
+    parts = update.message.text.split(maxsplit=1)
+    try:
+        if len(parts) < 2:
+            broadcasts = await adb.get_recent_broadcasts()
+            if not broadcasts:
+                await update.message.reply_text("📢 No broadcasts yet. Usage: /broadcast <text>")
+                return
+            lines = ["📢 Latest broadcasts (delivered / blocked / deleted / failed of total)"]
+            for b in broadcasts:
+                state = "running" if b["id"] in _broadcast_tasks else ("done" if b["finished_at"] else "interrupted")
+                lines.append(
+                    f"#{b['id']} {state}: {b['delivered']} / {b['blocked']} / {b['deleted']} / {b['failed']} "
+                    f"of {b['total']} ({b['created_at']:%Y-%m-%d %H:%M})"
+                )
+            await update.message.reply_text("\n".join(lines))
+            return
+        broadcast_id, total = await adb.create_broadcast(parts[1], user_id)
+        start_broadcast(broadcast_id, parts[1], user_id)
+        await update.message.reply_text(f"📢 Broadcast #{broadcast_id} started for {total} users")
+    except Exception as e:
+        logger.error(f"Error in broadcast command: {e}")
+        await update.message.reply_text(f"Error: {str(e)}")
+
+@adb.sync_helper
+def get_referral_rows(referrer_id):
+    """All closure rows below a referrer, for debugging."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('SELECT referrer_id, referred_id, level FROM referrals WHERE referrer_id = %s', (referrer_id,))
+                return c.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting referral rows for referrer {referrer_id}: {e}")
+        raise
+
+@adb.sync_helper
+def get_balance_breakdown(user_id):
+    """Balance, seed and referral profit totals plus referral profit rows, for debugging."""
+    try:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 # گرفتن بالانس
                 c.execute('SELECT balance FROM users WHERE user_id = %s', (user_id,))
-                balance = c.fetchone()[0] or 0.0
+                balance = c.fetchone()[0] or MONEY_ZERO
                 # گرفتن سود بذرها
                 c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (user_id,))
-                seed_profit = c.fetchone()[0] or 0.0
+                seed_profit = c.fetchone()[0] or MONEY_ZERO
                 # گرفتن سود رفرال‌ها
                 c.execute('SELECT SUM(profit_amount) FROM referral_profits WHERE referrer_id = %s', (user_id,))
-                referral_profit = c.fetchone()[0] or 0.0
+                referral_profit = c.fetchone()[0] or MONEY_ZERO
                 # گرفتن جزئیات سود رفرال‌ها
                 c.execute('''
                     SELECT referred_id, profit_amount, level, created_at
@@ -3619,20 +6387,47 @@ async def debug_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     WHERE referrer_id = %s
                     ORDER BY created_at DESC
                 ''', (user_id,))
-                referral_details = c.fetchall()
-                referral_text = "\n".join(
-                    f"Referred ID: {row[0]}, Profit: {row[1]} USDT, Level: {row[2]}, Date: {row[3]}"
-                    for row in referral_details
-                ) if referral_details else "No referral profits found."
-                response = (
-                    f"Debug Balance for User {user_id}:\n"
-                    f"Balance: {balance} USDT\n"
-                    f"Seed Profits: {seed_profit} USDT\n"
-                    f"Referral Profits: {referral_profit} USDT\n"
-                    f"Total Profits: {seed_profit + referral_profit} USDT\n"
-                    f"Referral Profit Details:\n{referral_text}"
-                )
-                await update.message.reply_text(response)
+                return balance, seed_profit, referral_profit, c.fetchall()
+    except Exception as e:
+        logger.error(f"Error getting balance breakdown for user {user_id}: {e}")
+        raise
+
+async def debug_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id != DEFAULT_ADMIN_ID:
+        await update.message.reply_text("🚫 Unauthorized")
+        return
+    try:
+        referrals = await adb.get_referral_rows(user_id)
+        if referrals:
+            response = "\n".join([f"Referrer: {r[0]}, Referred: {r[1]}, Level: {r[2]}" for r in referrals])
+        else:
+            response = "No referrals found."
+        await update.message.reply_text(f"Referrals:\n{response}")
+    except Exception as e:
+        await update.message.reply_text(f"Error: {str(e)}")
+
+async def debug_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Debug balance and referral profits for a user."""
+    user_id = update.effective_user.id
+    if user_id != DEFAULT_ADMIN_ID:
+        await update.message.reply_text("🚫 Unauthorized")
+        return
+    try:
+        balance, seed_profit, referral_profit, referral_details = await adb.get_balance_breakdown(user_id)
+        referral_text = "\n".join(
+            f"Referred ID: {row[0]}, Profit: {row[1]} USDT, Level: {row[2]}, Date: {row[3]}"
+            for row in referral_details
+        ) if referral_details else "No referral profits found."
+        response = (
+            f"Debug Balance for User {user_id}:\n"
+            f"Balance: {balance} USDT\n"
+            f"Seed Profits: {seed_profit} USDT\n"
+            f"Referral Profits: {referral_profit} USDT\n"
+            f"Total Profits: {seed_profit + referral_profit} USDT\n"
+            f"Referral Profit Details:\n{referral_text}"
+        )
+        await update.message.reply_text(response)
     except Exception as e:
         logger.error(f"Error debugging balance for user {user_id}: {e}")
         await update.message.reply_text(f"Error: {str(e)}") 
@@ -3648,19 +6443,13 @@ async def manage_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id != DEFAULT_ADMIN_ID:
         await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"Admin {user_id} opened manage users menu")
     await query.message.reply_text(
         messages[lang]["manage_users_menu"],
         parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("👥 مشاهده کاربران" if lang == "fa" else "👥 View Users", callback_data="view_users")],
-            [InlineKeyboardButton(messages[lang]["ban_user"], callback_data="ban_user")],
-            [InlineKeyboardButton(messages[lang]["manage_seeds"], callback_data="manage_seeds")],
-            [InlineKeyboardButton(messages[lang]["manage_balance"], callback_data="manage_balance")],
-            [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="back_to_menu")]
-        ])
+        reply_markup=keyboards.get("manage_users", lang)
     )
     return MANAGE_USERS
 
@@ -3672,7 +6461,7 @@ async def handle_manage_users_callback(update: Update, context: ContextTypes.DEF
     if user_id != DEFAULT_ADMIN_ID:
         await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"Admin {user_id} selected manage users action: {query.data}")
 
@@ -3681,9 +6470,7 @@ async def handle_manage_users_callback(update: Update, context: ContextTypes.DEF
         await query.message.reply_text(
             messages[lang]["ask_user_id"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-            ])
+            reply_markup=keyboards.back(lang, "manage_users")
         )
         return ENTER_USER_ID
     elif query.data == "manage_seeds":
@@ -3691,11 +6478,7 @@ async def handle_manage_users_callback(update: Update, context: ContextTypes.DEF
         await query.message.reply_text(
             messages[lang]["ask_seed_action"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(messages[lang]["add_seed"], callback_data="add_seed")],
-                [InlineKeyboardButton(messages[lang]["remove_seed"], callback_data="remove_seed")],
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-            ])
+            reply_markup=keyboards.get("seed_action", lang)
         )
         return SEED_ACTION
     elif query.data == "manage_balance":
@@ -3703,11 +6486,7 @@ async def handle_manage_users_callback(update: Update, context: ContextTypes.DEF
         await query.message.reply_text(
             messages[lang]["ask_balance_action"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(messages[lang]["add_balance"], callback_data="add_balance")],
-                [InlineKeyboardButton(messages[lang]["subtract_balance"], callback_data="subtract_balance")],
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-            ])
+            reply_markup=keyboards.get("balance_action", lang)
         )
         return BALANCE_ACTION
     elif query.data == "manage_users":
@@ -3730,7 +6509,7 @@ async def handle_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id != DEFAULT_ADMIN_ID:
         await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     target_user_id = context.user_data.get("target_user_id")
     logger.info(f"Admin {user_id} confirming ban for user {target_user_id}")
@@ -3744,7 +6523,7 @@ async def handle_ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return ConversationHandler.END
         try:
-            if ban_user(target_user_id):
+            if await adb.ban_user(target_user_id):
                 await query.message.reply_text(
                     messages[lang]["user_banned"](target_user_id),
                     parse_mode="Markdown",
@@ -3785,7 +6564,7 @@ async def handle_seed_action(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if user_id != DEFAULT_ADMIN_ID:
         await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"Admin {user_id} selected seed action: {query.data}")
 
@@ -3795,9 +6574,7 @@ async def handle_seed_action(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.message.reply_text(
             messages[lang]["ask_user_id"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-            ])
+            reply_markup=keyboards.back(lang, "manage_users")
         )
         return ENTER_USER_ID
     elif query.data == "manage_users":
@@ -3820,7 +6597,7 @@ async def handle_seed_selection_admin(update: Update, context: ContextTypes.DEFA
     if user_id != DEFAULT_ADMIN_ID:
         await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     target_user_id = context.user_data.get("target_user_id")
     logger.info(f"Admin {user_id} selected seed action for user {target_user_id}: {query.data}")
@@ -3828,12 +6605,8 @@ async def handle_seed_selection_admin(update: Update, context: ContextTypes.DEFA
     try:
         if query.data.startswith("add_seed_"):
             seed_idx = int(query.data.split("_")[2])
-            seed = SEEDS[seed_idx]
-            with psycopg2.connect(DATABASE_URL) as conn:
-                with conn.cursor() as c:
-                    c.execute('SELECT seed_id FROM seeds WHERE name = %s', (seed["name"],))
-                    seed_id = c.fetchone()[0]
-            add_user_seed_admin(target_user_id, seed_id)
+            seed = seed_catalog.by_index(seed_idx)
+            await adb.add_user_seed_admin(target_user_id, seed["seed_id"])
             await query.message.reply_text(
                 messages[lang]["seed_added"](seed["name_fa" if lang == "fa" else "name"], target_user_id),
                 parse_mode="Markdown",
@@ -3843,7 +6616,7 @@ async def handle_seed_selection_admin(update: Update, context: ContextTypes.DEFA
             return ConversationHandler.END
         elif query.data.startswith("remove_seed_"):
             user_seed_id = int(query.data.split("_")[2])
-            seed_info = get_user_seed(target_user_id, user_seed_id)
+            seed_info = await adb.get_user_seed(target_user_id, user_seed_id)
             if not seed_info:
                 await query.message.reply_text(
                     messages[lang]["invalid_data"],
@@ -3851,11 +6624,8 @@ async def handle_seed_selection_admin(update: Update, context: ContextTypes.DEFA
                     reply_markup=get_main_menu(lang, user_id)
                 )
                 return ConversationHandler.END
-            with psycopg2.connect(DATABASE_URL) as conn:
-                with conn.cursor() as c:
-                    c.execute('SELECT name, name_fa FROM seeds WHERE seed_id = %s', (seed_info[0],))
-                    seed_name, seed_name_fa = c.fetchone()
-            if remove_user_seed(target_user_id, user_seed_id):
+            seed_name, seed_name_fa = seed_catalog.names(seed_info[0])
+            if await adb.remove_user_seed(target_user_id, user_seed_id):
                 await query.message.reply_text(
                     messages[lang]["seed_removed"](seed_name_fa if lang == "fa" else seed_name, target_user_id),
                     parse_mode="Markdown",
@@ -3896,7 +6666,7 @@ async def handle_balance_action(update: Update, context: ContextTypes.DEFAULT_TY
     if user_id != DEFAULT_ADMIN_ID:
         await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     logger.info(f"Admin {user_id} selected balance action: {query.data}")
 
@@ -3906,9 +6676,7 @@ async def handle_balance_action(update: Update, context: ContextTypes.DEFAULT_TY
         await query.message.reply_text(
             messages[lang]["ask_user_id"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-            ])
+            reply_markup=keyboards.back(lang, "manage_users")
         )
         return ENTER_USER_ID
     elif query.data == "manage_users":
@@ -3929,7 +6697,7 @@ async def handle_balance_amount(update: Update, context: ContextTypes.DEFAULT_TY
     if user_id != DEFAULT_ADMIN_ID:
         await update.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     target_user_id = context.user_data.get("target_user_id")
     balance_action = context.user_data.get("balance_action")
@@ -3937,18 +6705,20 @@ async def handle_balance_amount(update: Update, context: ContextTypes.DEFAULT_TY
     logger.info(f"Admin {user_id} entered balance amount for user {target_user_id}: {input_text}")
 
     try:
-        amount = float(input_text)
+        amount = parse_money(input_text)
         if amount <= 0:
             await update.message.reply_text(
                 messages[lang]["invalid_balance_amount"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-                ])
+                reply_markup=keyboards.back(lang, "manage_users")
             )
             return ENTER_BALANCE_AMOUNT
         amount = amount if balance_action == "add_balance" else -amount
-        update_balance(target_user_id, amount)
+        async with balance_locks.hold(target_user_id):
+            await adb.update_balance(
+                target_user_id, amount, "admin_adjustment",
+                idempotency_key=f"admin:{update.message.chat_id}:{update.message.message_id}"
+            )
         action_text = "افزایش یافت" if balance_action == "add_balance" else "کاهش یافت" if lang == "fa" else \
                       "increased" if balance_action == "add_balance" else "decreased"
         await update.message.reply_text(
@@ -3962,9 +6732,7 @@ async def handle_balance_amount(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(
             messages[lang]["invalid_balance_amount"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-            ])
+            reply_markup=keyboards.back(lang, "manage_users")
         )
         return ENTER_BALANCE_AMOUNT
     except Exception as e:
@@ -3976,31 +6744,38 @@ async def handle_balance_amount(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return ConversationHandler.END
 
+@adb.sync_helper
+def is_active_user(user_id):
+    """Whether the user exists and is not banned."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('SELECT 1 FROM users WHERE user_id = %s AND is_banned = FALSE', (user_id,))
+                return c.fetchone() is not None
+    except Exception as e:
+        logger.error(f"Error checking user {user_id}: {e}")
+        raise
+
 async def handle_user_id_common(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user ID input for ban, seed management, or balance management."""
     user_id = update.effective_user.id
     if user_id != DEFAULT_ADMIN_ID:
         await update.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     input_text = update.message.text.strip()
     logger.info(f"Admin {user_id} entered user ID: {input_text}")
 
     try:
         target_user_id = int(input_text)
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as c:
-                c.execute('SELECT user_id FROM users WHERE user_id = %s AND is_banned = FALSE', (target_user_id,))
-                if not c.fetchone():
-                    await update.message.reply_text(
-                        messages[lang]["invalid_user_id"],
-                        parse_mode="Markdown",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-                        ])
-                    )
-                    return ENTER_USER_ID
+        if not await adb.is_active_user(target_user_id):
+            await update.message.reply_text(
+                messages[lang]["invalid_user_id"],
+                parse_mode="Markdown",
+                reply_markup=keyboards.back(lang, "manage_users")
+            )
+            return ENTER_USER_ID
         context.user_data["target_user_id"] = target_user_id
 
         # بررسی کنتکست برای تصمیم‌گیری
@@ -4008,55 +6783,42 @@ async def handle_user_id_common(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text(
                 messages[lang]["confirm_ban_user"](target_user_id),
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ تأیید" if lang == "fa" else "✅ Confirm", callback_data="confirm_ban")],
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-                ])
+                reply_markup=keyboards.get("confirm_ban", lang)
             )
             return BAN_USER
         elif context.user_data.get("manage_action") == "manage_seeds":
             seed_action = context.user_data.get("seed_action")
             if seed_action == "add_seed":
-                keyboard = [
-                    [InlineKeyboardButton(seed["name_fa" if lang == "fa" else "name"] + f" {seed['emoji']}", callback_data=f"add_seed_{idx}")]
-                    for idx, seed in enumerate(SEEDS)
-                ]
-                keyboard.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")])
                 await update.message.reply_text(
                     messages[lang]["select_seed_to_add"],
                     parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=keyboards.get("admin_seeds", lang)
                 )
                 return SELECT_SEED_ADD
             else:  # remove_seed
-                user_seeds = get_user_seeds(target_user_id)
+                user_seeds = await adb.get_user_seeds(target_user_id)
                 if not user_seeds:
                     await update.message.reply_text(
                         messages[lang]["no_seeds_to_remove"],
                         parse_mode="Markdown",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-                        ])
+                        reply_markup=keyboards.back(lang, "manage_users")
                     )
                     return MANAGE_USERS
                 keyboard = [
                     [InlineKeyboardButton(f"{seed[1 if lang == 'fa' else 0]} (ID: {seed[6]})", callback_data=f"remove_seed_{seed[6]}")]
                     for seed in user_seeds
                 ]
-                keyboard.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")])
                 await update.message.reply_text(
                     messages[lang]["select_seed_to_remove"],
                     parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=keyboards.build(lang, keyboard, back="manage_users")
                 )
                 return SELECT_SEED_REMOVE
         elif context.user_data.get("manage_action") == "manage_balance":
             await update.message.reply_text(
                 messages[lang]["ask_balance_amount"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-                ])
+                reply_markup=keyboards.back(lang, "manage_users")
             )
             return ENTER_BALANCE_AMOUNT
         else:
@@ -4070,9 +6832,7 @@ async def handle_user_id_common(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(
             messages[lang]["invalid_user_id"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-            ])
+            reply_markup=keyboards.back(lang, "manage_users")
         )
         return ENTER_USER_ID
     except Exception as e:
@@ -4084,10 +6844,11 @@ async def handle_user_id_common(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return ConversationHandler.END 
 
+@adb.sync_helper
 def get_users_paginated(page=1, page_size=5):
     """Retrieve paginated list of users from the database."""
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_connection() as conn:
             with conn.cursor() as c:
                 offset = (page - 1) * page_size
                 c.execute('''
@@ -4118,7 +6879,7 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.warning(f"Unauthorized access attempt by user {user_id}")
             await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
             return ConversationHandler.END
-        user = get_user(user_id)
+        user = await get_context_user(context, user_id)
         lang = user[0] if user else "en"
         logger.info(f"Admin {user_id} opened view users menu with lang {lang}")
 
@@ -4130,7 +6891,7 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             page = int(context.user_data.get("users_page", 1))
         logger.info(f"Fetching users for page {page}")
 
-        users, total_users = get_users_paginated(page=page)
+        users, total_users = await adb.get_users_paginated(page=page)
         logger.info(f"Retrieved {len(users)} users, total users: {total_users}")
         total_pages = (total_users + 4) // 5  # محاسبه تعداد صفحات (هر صفحه ۵ کاربر)
 
@@ -4139,9 +6900,7 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text(
                 "📋 *هیچ کاربری یافت نشد!*" if lang == "fa" else "📋 *No users found!*",
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-                ])
+                reply_markup=keyboards.back(lang, "manage_users")
             )
             return MANAGE_USERS
 
@@ -4153,15 +6912,10 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
 
         # اضافه کردن دکمه‌های صفحه‌بندی
-        navigation_buttons = []
-        if page > 1:
-            navigation_buttons.append(InlineKeyboardButton("⬅️ قبلی" if lang == "fa" else "⬅️ Previous", callback_data=f"page_{page-1}"))
-        if page < total_pages:
-            navigation_buttons.append(InlineKeyboardButton("بعدی ➡️" if lang == "fa" else "Next ➡️", callback_data=f"page_{page+1}"))
+        navigation_buttons = keyboards.pager(lang, page, total_pages)
         if navigation_buttons:
             keyboard.append(navigation_buttons)
-        keyboard.append([InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")])
-        logger.info(f"Keyboard built with {len(keyboard)} rows")
+        logger.info(f"Keyboard built with {len(keyboard) + 1} rows")
 
         # لاگ قبل از ارسال پیام
         logger.info(f"Sending user list for page {page} to admin {user_id}")
@@ -4171,7 +6925,7 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📋 *User List (Page {page} of {total_pages})*\n"
             f"Total Users: {total_users}",
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=keyboards.build(lang, keyboard, back="manage_users")
         )
         logger.info(f"Successfully sent user list for page {page} to admin {user_id}")
         return VIEW_USERS
@@ -4181,15 +6935,30 @@ async def view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text(
                 messages[lang]["error"],
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="manage_users")]
-                ])
+                reply_markup=keyboards.back(lang, "manage_users")
             )
             logger.info(f"Sent error message to admin {user_id}")
         except Exception as reply_error:
             logger.error(f"Failed to send error message to admin {user_id}: {str(reply_error)}")
         return MANAGE_USERS
 
+@adb.sync_helper
+def get_referral_level_counts(user_id):
+    """Number of referrals per level (up to REFERRAL_MAX_DEPTH) below a user."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute('''
+                    SELECT level, COUNT(*)
+                    FROM referrals
+                    WHERE referrer_id = %s AND level <= %s
+                    GROUP BY level
+                ''', (user_id, REFERRAL_MAX_DEPTH))
+                return dict(c.fetchall())
+    except Exception as e:
+        logger.error(f"Error getting referral level counts for user {user_id}: {e}")
+        raise
+
 async def view_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display detailed information about a selected user."""
     query = update.callback_query
@@ -4198,68 +6967,33 @@ async def view_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id != DEFAULT_ADMIN_ID:
         await query.message.reply_text(messages["en"]["unauthorized"], parse_mode="Markdown")
         return ConversationHandler.END
-    user = get_user(user_id)
+    user = await get_context_user(context, user_id)
     lang = user[0] if user else "en"
     target_user_id = int(query.data.split("_")[2])  # گرفتن user_id از callback_data
     logger.info(f"Admin {user_id} viewing details for user {target_user_id}")
 
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as c:
-                # گرفتن اطلاعات کاربر
-                c.execute('''
-                    SELECT user_id, username, balance, created_at
-                    FROM users
-                    WHERE user_id = %s AND is_banned = FALSE
-                ''', (target_user_id,))
-                user_info = c.fetchone()
-                if not user_info:
-                    await query.message.reply_text(
-                        messages[lang]["invalid_user_id"],
-                        parse_mode="Markdown",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="view_users")]
-                        ])
-                    )
-                    return VIEW_USERS
+        summary = await adb.get_wallet_summary(target_user_id)
+        if not summary or summary["is_banned"]:
+            await query.message.reply_text(
+                messages[lang]["invalid_user_id"],
+                parse_mode="Markdown",
+                reply_markup=keyboards.back(lang, "view_users")
+            )
+            return VIEW_USERS
 
-                user_id, username, balance, created_at = user_info
+        user_id = target_user_id
+        username = summary["username"]
+        balance = summary["balance"]
+        created_at = summary["created_at"]
+        seeds = [name_fa if lang == "fa" else name for name, name_fa in summary["seeds"]]
+        seeds_text = ", ".join(seeds) if seeds else "هیچ بذری ندارد" if lang == "fa" else "No seeds yet"
+        total_profit = summary["total_profit"]
+        transaction_count = summary["transaction_count"]
+        last_transaction = summary["last_transaction"]
 
-                # گرفتن بذرها
-                c.execute('''
-                    SELECT s.name, s.name_fa
-                    FROM user_seeds us
-                    JOIN seeds s ON us.seed_id = s.seed_id
-                    WHERE us.user_id = %s
-                ''', (target_user_id,))
-                seeds = [row[1] if lang == "fa" else row[0] for row in c.fetchall()]
-                seeds_text = ", ".join(seeds) if seeds else "هیچ بذری ندارد" if lang == "fa" else "No seeds yet"
-
-                # گرفتن سود کل
-                c.execute('SELECT SUM(amount) FROM profits WHERE user_id = %s', (target_user_id,))
-                seed_profit = c.fetchone()[0] or 0.0
-                c.execute('SELECT SUM(profit_amount) FROM referral_profits WHERE referrer_id = %s', (target_user_id,))
-                referral_profit = c.fetchone()[0] or 0.0
-                total_profit = seed_profit + referral_profit
-
-                # گرفتن تعداد تراکنش‌های موفق
-                c.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s AND status = %s', (target_user_id, 'confirmed'))
-                transaction_count = c.fetchone()[0]
-
-                # گرفتن آخرین تراکنش
-                c.execute('SELECT created_at FROM transactions WHERE user_id = %s AND status = %s ORDER BY created_at DESC LIMIT 1', (target_user_id, 'confirmed'))
-                last_transaction = c.fetchone()[0] if c.rowcount > 0 else None
-
-                # گرفتن تعداد رفرال‌ها
-                c.execute('''
-                    SELECT level, COUNT(*)
-                    FROM referrals
-                    WHERE referrer_id = %s
-                    GROUP BY level
-                ''', (target_user_id,))
-                level_counts = {1: 0, 2: 0, 3: 0}
-                for level, count in c.fetchall():
-                    level_counts[level] = count
+        # گرفتن تعداد رفرال‌ها
+        level_counts = await adb.get_referral_level_counts(target_user_id)
 
         response = (
             f"👤 *جزئیات کاربر*\n"
@@ -4273,9 +7007,7 @@ async def view_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📝 *تراکنش‌های موفق*: `{transaction_count}`\n"
             f"⏰ *آخرین تراکنش*: {'ندارد' if not last_transaction else last_transaction}\n"
             f"🤝 *رفرال‌ها*:\n"
-            f"  📌 سطح ۱: `{level_counts[1]}` نفر\n"
-            f"  📌 سطح ۲: `{level_counts[2]}` نفر\n"
-            f"  📌 سطح ۳: `{level_counts[3]}` نفر\n"
+            f"{referral_level_lines(level_counts, 'fa', show_rates=False)}"
             f"╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌"
         ) if lang == "fa" else (
             f"👤 *User Details*\n"
@@ -4289,18 +7021,14 @@ async def view_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📝 *Successful Transactions*: `{transaction_count}`\n"
             f"⏰ *Last Transaction*: {'None' if not last_transaction else last_transaction}\n"
             f"🤝 *Referrals*:\n"
-            f"  📌 Level 1: `{level_counts[1]}` workers\n"
-            f"  📌 Level 2: `{level_counts[2]}` workers\n"
-            f"  📌 Level 3: `{level_counts[3]}` workers\n"
+            f"{referral_level_lines(level_counts, 'en', show_rates=False)}"
             f"╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌╌"
         )
 
         await query.message.reply_text(
             response,
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="view_users")]
-            ])
+            reply_markup=keyboards.back(lang, "view_users")
         )
         return VIEW_USERS
     except Exception as e:
@@ -4308,9 +7036,7 @@ async def view_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text(
             messages[lang]["error"],
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت" if lang == "fa" else "🔙 Back", callback_data="view_users")]
-            ])
+            reply_markup=keyboards.back(lang, "view_users")
         )
         return VIEW_USERS 
 
@@ -4335,22 +7061,800 @@ async def debug_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info(f"Debug: Handling callback query with data: {update.callback_query.data} in state {current_state}")
     return current_state              
 
+AUTO_HARVEST_TIME = dt.time(0, 0, 30, tzinfo=ZoneInfo("Asia/Tehran"))
+_accrual_lock = asyncio.Lock()
+_last_accrual_report = {}
+
+async def auto_harvest_job(context: ContextTypes.DEFAULT_TYPE):
+    """Credit every ready planting of opted-in users for today, resuming an interrupted run."""
+    if _accrual_lock.locked():
+        logger.info("Auto-harvest already running, skipping this trigger")
+        return
+    async with _accrual_lock:
+        run_date = datetime.now(pytz.timezone('Asia/Tehran')).date()
+        low = 0
+        try:
+            run = await adb.start_accrual_run(run_date)
+            if run["finished_at"] is not None:
+                logger.info(f"Auto-harvest for {run_date} already finished at {run['finished_at']}")
+                return
+            low = run["last_user_id"]
+            if low:
+                logger.info(f"Resuming auto-harvest for {run_date} after user {low}")
+            started = time.monotonic()
+            users = seeds = chunks = 0
+            amount = MONEY_ZERO
+            while True:
+                result = await adb.run_accrual_chunk(run_date, low)
+                if result is None:
+                    break
+                low, chunk_users, chunk_seeds, chunk_amount = result
+                users += chunk_users
+                seeds += chunk_seeds
+                amount += chunk_amount
+                chunks += 1
+            elapsed = time.monotonic() - started
+            run = await adb.finish_accrual_run(run_date)
+            _last_accrual_report.update(
+                run_date=run_date,
+                chunks=chunks,
+                users=users,
+                seeds=seeds,
+                amount=amount,
+                elapsed=elapsed,
+                rate=seeds / elapsed if elapsed else 0.0,
+                total_users=run["users_processed"],
+                total_seeds=run["seeds_harvested"],
+                total_amount=run["amount_credited"],
+            )
+            logger.info(
+                f"Auto-harvest for {run_date} finished: {users} users, {seeds} seeds, {amount} USDT "
+                f"in {chunks} chunks, {elapsed:.1f}s ({_last_accrual_report['rate']:.0f} rows/s)"
+            )
+        except Exception as e:
+            logger.error(f"Auto-harvest for {run_date} stopped after user {low}, will resume from there: {e}")
+
+def format_accrual_stats():
+    """Render the last auto-harvest run for the admin stats command."""
+    report = _last_accrual_report
+    if not report:
+        return "🤖 Auto-harvest\nNo run since startup"
+    return (
+        f"🤖 Auto-harvest ({report['run_date']})\n"
+        f"This run: {report['users']} users, {report['seeds']} seeds, {report['amount']} USDT "
+        f"in {report['chunks']} chunks\n"
+        f"Elapsed: {report['elapsed']:.1f}s ({report['rate']:.0f} rows/s)\n"
+        f"Day total: {report['total_users']} users, {report['total_seeds']} seeds, {report['total_amount']} USDT"
+    )
+
+_broadcast_tasks = {}
+
+def classify_delivery_error(error):
+    """Map a failed send to the outcome stored in broadcast_deliveries."""
+    text = str(error).lower()
+    if isinstance(error, telegram.error.Forbidden):
+        return "deleted" if "deactivated" in text else "blocked"
+    if isinstance(error, telegram.error.BadRequest) and "chat not found" in text:
+        return "deleted"
+    return "failed"
+
+def start_broadcast(broadcast_id, text, created_by, after_user_id=0):
+    """Run a broadcast in the background unless it is already running."""
+    if broadcast_id in _broadcast_tasks:
+        return
+    task = asyncio.create_task(run_broadcast(broadcast_id, text, created_by, after_user_id))
+    _broadcast_tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: _broadcast_tasks.pop(broadcast_id, None))
+
+async def run_broadcast(broadcast_id, text, created_by, after_user_id=0):
+    """Send a broadcast through the notification dispatcher, checkpointing outcomes as they arrive."""
+    in_flight = {}  # asyncio future -> user_id
+    outcomes = []
+    last_dispatched = after_user_id
+    started = time.monotonic()
+    sent = 0
+
+    def resume_point():
+        # user ids go out in ascending order, so everything below the oldest in-flight one is done
+        return min(in_flight.values()) - 1 if in_flight else last_dispatched
+
+    async def collect(return_when):
+        done, _ = await asyncio.wait(in_flight, return_when=return_when)
+        for future in done:
+            recipient = in_flight.pop(future)
+            error = future.exception()
+            if error is None:
+                outcomes.append((recipient, "delivered", None))
+            else:
+                outcomes.append((recipient, classify_delivery_error(error), str(error)[:200]))
+
+    async def flush():
+        batch = outcomes[:]
+        outcomes.clear()
+        await adb.record_broadcast_outcomes(broadcast_id, batch, resume_point())
+
+    try:
+        logger.info(f"Broadcast {broadcast_id} running after user {after_user_id}")
+        while True:
+            batch = await adb.get_broadcast_recipients(broadcast_id, last_dispatched)
+            if not batch:
+                break
+            for recipient in batch:
+                while len(in_flight) >= BROADCAST_WINDOW:
+                    await collect(asyncio.FIRST_COMPLETED)
+                future = asyncio.wrap_future(notifier.enqueue(recipient, text, parse_mode=None))
+                in_flight[future] = recipient
+                last_dispatched = recipient
+                sent += 1
+                if len(outcomes) >= BROADCAST_FLUSH_SIZE:
+                    await flush()
+        if in_flight:
+            await collect(asyncio.ALL_COMPLETED)
+        await flush()
+        result = await adb.finish_broadcast(broadcast_id)
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Broadcast {broadcast_id} finished: {sent} sent this run in {elapsed:.1f}s "
+            f"({sent / elapsed if elapsed else 0:.1f} msg/s), totals {result}"
+        )
+        notifier.enqueue(
+            created_by or DEFAULT_ADMIN_ID,
+            f"📢 *Broadcast #{broadcast_id} finished*\n"
+            f"✅ Delivered: {result['delivered']}\n"
+            f"🚫 Blocked: {result['blocked']}\n"
+            f"🗑️ Deleted: {result['deleted']}\n"
+            f"⚠️ Failed: {result['failed']}\n"
+            f"👥 Total: {result['total']} in {elapsed:.0f}s"
+        )
+    except asyncio.CancelledError:
+        # Keep what is already known; in-flight recipients are retried when the broadcast resumes
+        logger.info(f"Broadcast {broadcast_id} interrupted, saving progress")
+        if outcomes:
+            await flush()
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast {broadcast_id} stopped: {e}")
+
+async def resume_broadcasts_job(context: ContextTypes.DEFAULT_TYPE):
+    """Continue broadcasts that were interrupted by a restart."""
+    try:
+        for broadcast_id, text, created_by, last_user_id in await adb.get_unfinished_broadcasts():
+            logger.info(f"Resuming broadcast {broadcast_id} after user {last_user_id}")
+            start_broadcast(broadcast_id, text, created_by, last_user_id)
+    except Exception as e:
+        logger.error(f"Error resuming broadcasts: {e}")
+
+# Conversation and user_data persistence
+PERSIST_FLUSH_MS = int(os.getenv("PERSIST_FLUSH_MS", "1000"))  # how often PTB hands changed state over
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "500"))  # rows per write; a full batch is written early
+# Several workers sharing one database: reload a user's user_data and conversation state before
+# each of their updates and write both back as soon as the update is handled
+PERSIST_SHARED = os.getenv("PERSIST_SHARED", "false").lower() in ("1", "true", "yes")
+
+@adb.sync_helper
+def load_persisted_state(kind, key=None):
+    """Return {key: decoded value} for one persistence kind, or only the row for key."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                if key is None:
+                    c.execute('SELECT key, data FROM bot_persistence WHERE kind = %s', (kind,))
+                else:
+                    c.execute('SELECT key, data FROM bot_persistence WHERE kind = %s AND key = %s', (kind, key))
+                return {row_key: pickle.loads(data) for row_key, data in c.fetchall()}
+    except Exception as e:
+        logger.error(f"Error loading persisted {kind} state: {e}")
+        raise
+
+@adb.sync_helper
+def write_persisted_state(upserts, deletes):
+    """Apply batched persistence changes: upserts [(kind, key, bytes)], deletes [(kind, key)]."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as c:
+                for start in range(0, len(upserts), PERSIST_BATCH_SIZE):
+                    psycopg2.extras.execute_values(c, '''
+                        INSERT INTO bot_persistence (kind, key, data)
+                        VALUES %s
+                        ON CONFLICT (kind, key) DO UPDATE
+                        SET data = EXCLUDED.data, updated_at = now()
+                    ''', upserts[start:start + PERSIST_BATCH_SIZE])
+                for start in range(0, len(deletes), PERSIST_BATCH_SIZE):
+                    psycopg2.extras.execute_values(c, '''
+                        DELETE FROM bot_persistence p
+                        USING (VALUES %s) AS d (kind, key)
+                        WHERE p.kind = d.kind AND p.key = d.key
+                    ''', deletes[start:start + PERSIST_BATCH_SIZE])
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error writing {len(upserts)} persisted states and {len(deletes)} deletions: {e}")
+        raise
+
+class SharedConversationState:
+    """The one place that reaches into ConversationHandler internals for PERSIST_SHARED.
+
+    python-telegram-bot has no public API to read or load one conversation key, so this
+    uses _get_key() and the _conversations TrackingDict of 22.0 (pinned in requirements.txt).
+    supported() is checked at startup; if an upgrade drops them, shared mode refuses to
+    start instead of silently losing conversation state.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    @staticmethod
+    def supported():
+        try:
+            from telegram.ext._utils.trackingdict import TrackingDict
+        except ImportError:
+            return False
+        return (
+            callable(getattr(ConversationHandler, "_get_key", None))
+            and "_conversations" in getattr(ConversationHandler, "__slots__", ())
+            and isinstance(getattr(TrackingDict(), "data", None), dict)
+        )
+
+    @classmethod
+    def for_application(cls, application):
+        return [
+            cls(handler) for handlers in application.handlers.values() for handler in handlers
+            if isinstance(handler, ConversationHandler) and handler.persistent and handler.name
+        ]
+
+    @property
+    def name(self):
+        return self.handler.name
+
+    def key(self, update):
+        """Conversation key of the update, or None if the handler cannot key it."""
+        try:
+            return self.handler._get_key(update)
+        except RuntimeError:
+            return None
+
+    def get(self, key):
+        state = self.handler._conversations.get(key)
+        # A still-running non-blocking state is stored as its previous state, as PTB does
+        return getattr(state, "old_state", state)
+
+    def load(self, key, state):
+        """Install a stored state without write tracking, so it is not persisted again."""
+        if state == ConversationHandler.END:
+            self.handler._conversations.data.pop(key, None)
+        else:
+            self.handler._conversations.data[key] = state
+
+class PostgresPersistence(BasePersistence):
+    """PTB persistence for conversation states and user_data, stored in bot_persistence.
+
+    Values are pickled (highest protocol) into a BYTEA column, one row per user or
+    conversation key. Writes are behind: PTB hands over changed state every
+    PERSIST_FLUSH_MS, the changes collect in a pending map (later writes to the same
+    key replace earlier ones) and go to Postgres as a few multi-row statements, so a
+    burst of taps costs one write per interval rather than one per update. Once
+    PERSIST_BATCH_SIZE changes are pending they are written right away instead of
+    waiting for the end of the round.
+    Conversation states are loaded when the application starts. With PERSIST_SHARED
+    the update's user_data and conversation state are reloaded before each update and
+    written through after it, so the next update may land on any worker.
+    """
+
+    USER_KIND = "user"
+
+    def __init__(self, flush_interval=PERSIST_FLUSH_MS / 1000, shared=PERSIST_SHARED):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.shared = shared
+        self._pending = {}  # (kind, key) -> pickled bytes, or None to delete
+        self._batches = deque()  # full batches split off _pending, oldest first
+        self._writing = {}  # batch currently being written
+        self._write_lock = asyncio.Lock()
+        self._flush_task = None
+        self._early_flushes = 0
+        self._flushes = 0
+        self._rows_written = 0
+        self._bytes_written = 0
+        self._failures = 0
+        self._last_flush_ms = 0.0
+
+    @staticmethod
+    def conversation_kind(name):
+        return f"conversation:{name}"
+
+    @staticmethod
+    def encode_key(key):
+        return ",".join(str(part) for part in key)
+
+    @staticmethod
+    def decode_key(key):
+        return tuple(int(part) for part in key.split(","))
+
+    def _queue(self, kind, key, value):
+        self._pending[(kind, key)] = None if value is None else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(self._pending) >= PERSIST_BATCH_SIZE:
+            # Full batch: hand it to the writer now rather than at the end of the round
+            self._batches.append(self._pending)
+            self._pending = {}
+            self._early_flushes += 1
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_pending())
+
+    def _is_pending(self, item):
+        return item in self._pending or item in self._writing or any(item in batch for batch in self._batches)
+
+    async def _flush_pending(self):
+        if not self._batches:
+            # Let the rest of this persistence round queue its changes first
+            await asyncio.sleep(0)
+        while self._batches or self._pending:
+            if self._batches:
+                batch = self._batches.popleft()
+            else:
+                batch, self._pending = self._pending, {}
+            try:
+                await self._write(batch)
+            except Exception:
+                return
+
+    async def _write(self, batch):
+        """Write one batch; writes are serialised so a newer batch never lands before an older one."""
+        upserts = [(kind, key, data) for (kind, key), data in batch.items() if data is not None]
+        deletes = [(kind, key) for (kind, key), data in batch.items() if data is None]
+        async with self._write_lock:
+            started = time.monotonic()
+            self._writing = batch
+            try:
+                await adb.write_persisted_state(upserts, deletes)
+            except Exception:
+                self._writing = {}
+                self._failures += 1
+                # Keep the batch for the next round unless newer state was queued meanwhile
+                for item, data in batch.items():
+                    if not self._is_pending(item):
+                        self._pending[item] = data
+                raise
+            self._writing = {}
+            self._flushes += 1
+            self._rows_written += len(batch)
+            self._bytes_written += sum(len(data) for _, _, data in upserts)
+            self._last_flush_ms = (time.monotonic() - started) * 1000
+
+    async def get_user_data(self):
+        rows = await adb.load_persisted_state(self.USER_KIND)
+        logger.info(f"Loaded persisted user_data for {len(rows)} users")
+        return {int(key): data for key, data in rows.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        rows = await adb.load_persisted_state(self.conversation_kind(name))
+        logger.info(f"Loaded {len(rows)} persisted states for conversation {name}")
+        return {self.decode_key(key): state for key, state in rows.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        # In shared mode write_through already stored it; a late hand-over could overwrite
+        # a newer state written by another worker in the meantime
+        if self.shared:
+            return
+        self._queue(self.conversation_kind(name), self.encode_key(key), new_state)
+
+    async def update_user_data(self, user_id, data):
+        if self.shared:
+            return
+        # An emptied user_data (context.user_data.clear()) needs no row
+        self._queue(self.USER_KIND, str(user_id), data or None)
+
+    async def drop_user_data(self, user_id):
+        self._queue(self.USER_KIND, str(user_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not self.shared or self._is_pending((self.USER_KIND, str(user_id))):
+            return
+        rows = await adb.load_persisted_state(self.USER_KIND, str(user_id))
+        user_data.clear()
+        user_data.update(rows.get(str(user_id), {}))
+
+    async def refresh_conversations(self, application, update):
+        """Shared mode: load the stored state of this update's conversations into the handlers."""
+        if not self.shared:
+            return
+        for conversation in SharedConversationState.for_application(application):
+            key = conversation.key(update)
+            if key is None:
+                continue
+            kind, row_key = self.conversation_kind(conversation.name), self.encode_key(key)
+            if self._is_pending((kind, row_key)):
+                continue
+            rows = await adb.load_persisted_state(kind, row_key)
+            conversation.load(key, rows.get(row_key, ConversationHandler.END))
+
+    async def write_through(self, application, update):
+        """Shared mode: write this update's user_data and conversation state now, not at the next round."""
+        if not self.shared:
+            return
+        batch = {}
+        user = update.effective_user
+        if user is not None and user.id in application.user_data:
+            data = application.user_data[user.id]
+            batch[(self.USER_KIND, str(user.id))] = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL) if data else None
+        for conversation in SharedConversationState.for_application(application):
+            key = conversation.key(update)
+            if key is None:
+                continue
+            state = conversation.get(key)
+            item = (self.conversation_kind(conversation.name), self.encode_key(key))
+            batch[item] = None if state is None else pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        if not batch:
+            return
+        # These values supersede anything still queued for the same keys
+        for pending in (self._pending, *self._batches):
+            for item in batch:
+                pending.pop(item, None)
+        try:
+            await self._write(batch)
+        except Exception as e:
+            logger.error(f"Error writing through persisted state for update {update.update_id}: {e}")
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        """Write whatever is still pending; called by PTB on shutdown."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_pending()
+        lost = len(self._pending) + sum(len(batch) for batch in self._batches)
+        if lost:
+            logger.error(f"Lost {lost} persisted states on shutdown")
+        logger.info(f"Persistence flushed: {self._rows_written} rows in {self._flushes} writes")
+
+    def stats(self):
+        return {
+            "pending": len(self._pending) + sum(len(batch) for batch in self._batches),
+            "flushes": self._flushes,
+            "early_flushes": self._early_flushes,
+            "rows": self._rows_written,
+            "bytes": self._bytes_written,
+            "failures": self._failures,
+            "last_flush_ms": self._last_flush_ms,
+            "shared": self.shared,
+        }
+
+persistence = PostgresPersistence()
+
+async def load_shared_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pre-handler (PERSIST_SHARED): pick up conversation state written by other workers."""
+    await persistence.refresh_conversations(context.application, update)
+
+async def store_shared_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Post-handler (PERSIST_SHARED): make this update's state visible to other workers."""
+    await persistence.write_through(context.application, update)
+
+def format_persistence_stats():
+    """Render write-behind persistence stats for the admin stats command."""
+    stats = persistence.stats()
+    return (
+        f"💾 Persistence{' (shared)' if stats['shared'] else ''}\n"
+        f"Pending: {stats['pending']}, writes: {stats['flushes']} ({stats['early_flushes']} early), failures: {stats['failures']}\n"
+        f"Rows: {stats['rows']} ({stats['bytes']} bytes), last write {stats['last_flush_ms']:.1f} ms"
+    )
+
+# Concurrent update processing
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))  # updates running handlers at once
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1024"))  # admitted updates, including those waiting their turn
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Run updates concurrently while keeping each user's updates in arrival order.
+
+    The base class semaphore bounds how many updates are admitted (UPDATE_MAX_PENDING).
+    An admitted update first takes its user's lock and only then one of the
+    UPDATE_CONCURRENCY run slots, so a user tapping quickly queues behind their own
+    previous update without occupying a slot other users could run in. Updates for
+    one user therefore never overlap, which keeps ConversationHandler state, user_data
+    and the per-update request context consistent.
+    """
+
+    def __init__(self, concurrency, max_pending):
+        super().__init__(max(max_pending, concurrency, 2))
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._user_locks = {}  # user/chat id -> [lock, updates holding or waiting for it]
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.waiting = 0
+        self.processed = 0
+        self.serialized = 0
+        self.wait_time = 0.0
+
+    @staticmethod
+    def serialization_key(update):
+        """Updates sharing this key run one at a time; None means no ordering is needed."""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        key = self.serialization_key(update)
+        entry = None
+        if key is not None:
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            if entry[1] > 1:
+                self.serialized += 1
+        queued_at = time.monotonic()
+        self.waiting += 1
+        started = False
+        try:
+            async with entry[0] if entry else nullcontext():
+                async with self._slots:
+                    self.waiting -= 1
+                    started = True
+                    self.wait_time += time.monotonic() - queued_at
+                    self.in_flight += 1
+                    self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                    try:
+                        await coroutine
+                    finally:
+                        self.in_flight -= 1
+                        self.processed += 1
+        finally:
+            if not started:
+                # Cancelled while waiting (shutdown); the handler coroutine never ran
+                self.waiting -= 1
+                if hasattr(coroutine, "close"):
+                    coroutine.close()
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_locks[key]
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "max_pending": self.max_concurrent_updates,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "waiting": self.waiting,
+            "users": len(self._user_locks),
+            "processed": self.processed,
+            "serialized": self.serialized,
+            "avg_wait_ms": self.wait_time / self.processed * 1000 if self.processed else 0.0,
+        }
+
+update_processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+
+def format_update_stats():
+    """Render update processing stats for the admin stats command."""
+    stats = update_processor.stats()
+    return (
+        f"⚙️ Updates\n"
+        f"In flight: {stats['in_flight']}/{stats['concurrency']} (peak {stats['peak_in_flight']}), "
+        f"waiting: {stats['waiting']} across {stats['users']} users\n"
+        f"Processed: {stats['processed']}, queued behind same user: {stats['serialized']}, "
+        f"avg wait: {stats['avg_wait_ms']:.1f}ms"
+    )
+
+# Run mode: long polling (default) or a webhook endpoint that several workers can serve behind a load balancer
+BOT_RUN_MODE = os.getenv("BOT_RUN_MODE", "polling").lower()  # "polling" or "webhook"
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL of the load balancer
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# A full queue makes the webhook handler (or the poll loop) wait, so Telegram backs off instead of us buffering without limit
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_CAPTURE_FILE = os.getenv("UPDATE_CAPTURE_FILE")
+# Only one worker behind the load balancer should run the nightly harvest and resume broadcasts
+RUN_BACKGROUND_JOBS = os.getenv("RUN_BACKGROUND_JOBS", "true").lower() in ("1", "true", "yes")
+REPLAY_CONCURRENCY = int(os.getenv("REPLAY_CONCURRENCY", "10"))
+
+class UpdateCapture:
+    """Append every incoming update to a JSON-lines file for later replay against the webhook."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = None
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(update.to_dict(), ensure_ascii=False) + "\n")
+            self._file.flush()
+            self.count += 1
+        except OSError as e:
+            logger.error(f"Error capturing update {update.update_id} to {self.path}: {e}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"Captured {self.count} updates to {self.path}")
+
+update_capture = UpdateCapture(UPDATE_CAPTURE_FILE) if UPDATE_CAPTURE_FILE else None
+
+def webhook_endpoint(base_url):
+    return f"{base_url.rstrip('/')}/{WEBHOOK_PATH}"
+
+async def replay_updates(path, url, secret=None, concurrency=REPLAY_CONCURRENCY):
+    """Self-test: POST captured updates to a running webhook endpoint.
+
+    First checks that a request with a wrong secret token is rejected, then
+    replays every captured update with the configured token and reports status
+    codes and latency. Point it at a local or staging worker: handlers run for
+    real and reply to the captured chats. Returns True if everything passed.
+    """
+    with open(path, encoding="utf-8") as f:
+        bodies = [line.strip() for line in f if line.strip()]
+    if not bodies:
+        logger.error(f"No captured updates in {path}")
+        return False
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    statuses = {}
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    ok = True
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        if secret:
+            response = await client.post(
+                url, content=bodies[0],
+                headers={**headers, "X-Telegram-Bot-Api-Secret-Token": secret + "-wrong"}
+            )
+            if response.status_code != 403:
+                logger.error(f"Webhook accepted a wrong secret token (status {response.status_code})")
+                ok = False
+
+        async def post(body):
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    response = await client.post(url, content=body, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.monotonic() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(post(body) for body in bodies))
+        elapsed = time.monotonic() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+    logger.info(
+        f"Replayed {len(bodies)} updates to {url} in {elapsed:.2f}s "
+        f"({len(bodies) / elapsed:.1f}/s): statuses {statuses}, "
+        f"p50 {p50:.0f}ms, p95 {p95:.0f}ms, max {latencies[-1] * 1000:.0f}ms"
+    )
+    return ok and statuses.get(200, 0) == len(bodies)
+
+def run_replay(args):
+    """`python main.py replay <capture_file> [url]` - replay captured updates against a webhook worker."""
+    if not args:
+        logger.error("Usage: python main.py replay <capture_file> [url]")
+        exit(2)
+    url = args[1] if len(args) > 1 else webhook_endpoint(f"http://127.0.0.1:{WEBHOOK_PORT}")
+    passed = asyncio.run(replay_updates(args[0], url, WEBHOOK_SECRET))
+    exit(0 if passed else 1)
+
+async def start_services(application):
+    """Start background services once the application's bot is initialised."""
+    # Application.initialize() already called get_me(); bot.username is served from that result
+    logger.info(f"Running as @{application.bot.username} (id {application.bot.id})")
+    notifier.start(application.bot)
+
+async def shutdown_services(application):
+    """Stop running broadcasts, flush pending notifications, then release the database resources."""
+    tasks = list(_broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await notifier.stop()
+    if update_capture is not None:
+        update_capture.close()
+    await close_async_database(application)
+
+async def close_async_database(application):
+    """Close the async database pool and DB executor when the application shuts down."""
+    await async_db.close()
+    await lock_db.close()
+    db_executor.shutdown()
+
 def main():
     """Run the bot."""
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        run_replay(sys.argv[2:])
     token = os.getenv("BOT_TOKEN")
     if not token:
         logger.error("BOT_TOKEN not found in environment variables")
         exit(1)
+    if BOT_RUN_MODE not in ("polling", "webhook"):
+        logger.error(f"Unknown BOT_RUN_MODE {BOT_RUN_MODE!r}; expected 'polling' or 'webhook'")
+        exit(1)
+    if BOT_RUN_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL is required when BOT_RUN_MODE=webhook")
+        exit(1)
+    if not check_lock_pool_size():
+        exit(1)
+    if persistence.shared and not SharedConversationState.supported():
+        logger.error(
+            f"PERSIST_SHARED relies on ConversationHandler internals of python-telegram-bot 22.0, "
+            f"which version {telegram.__version__} does not have; pin the version from requirements.txt"
+        )
+        exit(1)
 
     # Initialize database and fix users table
     logger.info("Starting database initialization")
     init_db()
     fix_users_table()
+    migrate_column_types()
+    ensure_indexes()
+    extend_referral_closure()
+    backfill_ledger_openings()
+    seed_catalog.load()
     logger.info("Database initialization and users table fix completed")
 
     # Build the application
     logger.info("Building Telegram application")
-    app = ApplicationBuilder().token(token).build()
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .context_types(ContextTypes(context=BotContext))
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(update_processor)
+        .persistence(persistence)
+        .post_init(start_services)
+        .post_shutdown(shutdown_services)
+        .build()
+    )
+
+    # Nightly auto-harvest at the Tehran day boundary, plus a catch-up run shortly after
+    # startup in case the bot was down at midnight or a run was interrupted
+    if RUN_BACKGROUND_JOBS:
+        app.job_queue.run_daily(auto_harvest_job, time=AUTO_HARVEST_TIME, name="auto_harvest")
+        app.job_queue.run_once(auto_harvest_job, when=60, name="auto_harvest_catch_up")
+        app.job_queue.run_once(resume_broadcasts_job, when=10, name="resume_broadcasts")
+    else:
+        logger.info("Background jobs disabled on this worker (RUN_BACKGROUND_JOBS)")
 
     # Run fix_database for user 5664533861 at startup
     logger.info("Running fix_database for user 5664533861")
@@ -4363,13 +7867,13 @@ def main():
             CommandHandler("start", start),
             CallbackQueryHandler(
                 handle_menu_callback,
-                pattern=r"^(buy_seed|wallet|referral|language|support|withdraw|history|plant_seed|harvest_seed|referral_\d+)$"
+                pattern=r"^(buy_seed|wallet|referral|language|support|withdraw|history|plant_seed|harvest_seed|auto_harvest|referral_\d+)$"
             ),
             CallbackQueryHandler(handle_language_callback, pattern=r"^lang_.*$"),
             CallbackQueryHandler(handle_seed_selection, pattern=r"^(seed_\d+|confirm_seed_purchase|balance_purchase)$"),
             CallbackQueryHandler(handle_deposit_network, pattern=r"^network_.*$"),
-            CallbackQueryHandler(handle_plant_seed, pattern=r"^plant_\d+$"),
-            CallbackQueryHandler(handle_harvest_seed, pattern=r"^harvest_\d+$"),
+            CallbackQueryHandler(handle_plant_seed, pattern=r"^plant_(\d+|all)$"),
+            CallbackQueryHandler(handle_harvest_seed, pattern=r"^harvest_(\d+|all)$"),
             CallbackQueryHandler(handle_admin_action, pattern=r"^(approve|reject)_\d+$"),
             CallbackQueryHandler(handle_balance_purchase, pattern=r"^confirm_balance_purchase$"),
             CallbackQueryHandler(handle_back, pattern=r"^(back_to_menu|wallet)$"),
@@ -4424,14 +7928,14 @@ def main():
             PLANT_SEED: [
                 CallbackQueryHandler(
                     handle_plant_seed,
-                    pattern=r"^plant_\d+$"
+                    pattern=r"^plant_(\d+|all)$"
                 ),
                 CallbackQueryHandler(handle_back, pattern=r"^(back_to_menu|wallet)$"),
             ],
             HARVEST_SEED: [
                 CallbackQueryHandler(
                     handle_harvest_seed,
-                    pattern=r"^harvest_\d+$"
+                    pattern=r"^harvest_(\d+|all)$"
                 ),
                 CallbackQueryHandler(handle_back, pattern=r"^(back_to_menu|wallet)$"),
             ],
@@ -4496,11 +8000,21 @@ def main():
             MessageHandler(filters.TEXT & ~filters.COMMAND, handle_unexpected_message),
             CallbackQueryHandler(debug_conversation),
         ],
-        per_message=False
+        per_message=False,
+        name="main_conversation",
+        persistent=True,
     )
 
     # Add handlers to the application
     logger.info("Adding handlers to the application")
+    if update_capture is not None:
+        logger.info(f"Capturing incoming updates to {UPDATE_CAPTURE_FILE}")
+        app.add_handler(TypeHandler(Update, update_capture), group=-2)
+    # Load the sender's user row and seeds once per update, before any other handler runs
+    app.add_handler(TypeHandler(Update, load_request_context), group=-1)
+    if persistence.shared:
+        app.add_handler(TypeHandler(Update, load_shared_state), group=-3)
+        app.add_handler(TypeHandler(Update, store_shared_state), group=100)
     app.add_handler(conv_handler)
     app.add_handler(CommandHandler(
         "approve",
@@ -4520,13 +8034,33 @@ def main():
     app.add_handler(CommandHandler("cancel", cancel))
     app.add_handler(CommandHandler("debug_referrals", debug_referrals))
     app.add_handler(CommandHandler("debug_balance", debug_balance))
+    app.add_handler(CommandHandler("stats", runtime_stats))
+    app.add_handler(CommandHandler("rebuild_stats", rebuild_stats))
+    app.add_handler(CommandHandler("db_report", db_report))
+    app.add_handler(CommandHandler("broadcast", broadcast))
+    app.add_handler(CommandHandler("reload_seeds", reload_seeds))
+    app.add_handler(CommandHandler("verify_ledger", verify_ledger))
     app.add_handler(CallbackQueryHandler(debug_callback))
-    app.add_handler(CallbackQueryHandler(debug_callback))
-    app.add_handler(conv_handler)
 
     # Start the bot
-    logger.info("Starting bot")
-    app.run_polling()
+    logger.info(f"Starting bot in {BOT_RUN_MODE} mode")
+    try:
+        if BOT_RUN_MODE == "webhook":
+            if not WEBHOOK_SECRET:
+                logger.warning("WEBHOOK_SECRET is not set; webhook requests will not be authenticated")
+            # Every worker registers the same public URL, so set_webhook is idempotent across restarts
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=webhook_endpoint(WEBHOOK_URL),
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            app.run_polling()
+    finally:
+        db_pool.closeall()
 
 if __name__ == "__main__":
     main()